@@ -0,0 +1,229 @@
+'''
+Async counterparts of the building and signing paths.
+
+Signing is CPU-bound, and would stall the event loop and any Electrum
+connection on it. These run it in a process pool instead, with at most
+max_concurrency jobs queued at once, so a single service can sign on
+every core and talk to the network at the same time.
+
+Example:
+    signer = aio.Signer()
+    auctions = await signer.multidutch_as_hex(prevouts, addr, form, keys)
+    statuses = await signer.make_and_broadcast_btc_shutdown(...)
+'''
+import os
+import asyncio
+import functools
+
+import scripts.hd as hd
+import scripts.merkle as merkle
+import scripts.network as net
+import scripts.partial_tx as pt
+import scripts.broadcaster as bc
+import scripts.eth_auction_setup as eas
+
+from ether import transactions
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import (Any, Awaitable, Callable, Iterable, List, Optional,
+                    TypeVar)
+
+T = TypeVar('T')
+U = TypeVar('U')
+
+
+class Signer:
+    '''
+    Runs builders in an executor with bounded concurrency. Submitting
+    waits while max_concurrency jobs are in flight, so a large batch does
+    not queue everything at once.
+
+    ECDSA signing is pure Python and holds the GIL throughout, so a
+    thread pool would sign on one core at a time. The default executor
+    is a process pool of max_concurrency workers, made on first use and
+    shut down by close. Every builder here submits a module-level
+    function, so that jobs and results pickle. A thread pool may still be
+    passed in, to keep jobs off the loop without using more cores.
+
+    Args:
+        executor      (Executor): where to run jobs. a process pool owned
+                                  by the signer if None
+        max_concurrency    (int): jobs in flight at once. the cpu count if
+                                  None
+    '''
+
+    def __init__(
+            self,
+            executor: Optional[Executor] = None,
+            max_concurrency: Optional[int] = None) -> None:
+        self._executor = executor
+        self._owns_executor = executor is None
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_concurrency)
+        return self._executor
+
+    def close(self) -> None:
+        '''Shuts down the signer's own process pool, if it made one'''
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # NB: made lazily, so that it binds to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def run(self, f: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        '''Runs one job in the executor, once a slot is free'''
+        async with self.semaphore:
+            return await self._submit(f, *args, **kwargs)
+
+    def _submit(
+            self,
+            f: Callable[..., T],
+            *args: Any,
+            **kwargs: Any) -> 'asyncio.Future[T]':
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(f, *args, **kwargs))
+
+    async def map(
+            self,
+            f: Callable[[U], T],
+            items: Iterable[U]) -> List[T]:
+        '''
+        Runs f on each item, in the executor, and returns the results in
+        order. Waits for a free slot before submitting each item.
+        '''
+        semaphore = self.semaphore
+
+        async def job(item: U) -> T:
+            try:
+                return await self._submit(f, item)
+            finally:
+                semaphore.release()
+
+        tasks: List[Awaitable[T]] = []
+        try:
+            for item in items:
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(job(item)))
+        finally:
+            results = await asyncio.gather(*tasks)
+        return list(results)
+
+    async def multidutch(
+            self,
+            prevouts: List[pt.Prevout],
+            recipient_addr: str,
+            format_tuples: pt.Format,
+            keypair: hd.KeyRef,
+            network: net.NetworkLike = None) -> List[pt.Auction]:
+        '''Like partial_tx.multidutch. One job per prevout'''
+        dutch = functools.partial(
+            _dutch,
+            recipient_addr=recipient_addr,
+            format_tuples=format_tuples,
+            keypair=keypair,
+            network=network)
+        return await self.map(dutch, prevouts)
+
+    async def multidutch_as_hex(
+            self,
+            prevouts: List[pt.Prevout],
+            recipient_addr: str,
+            format_tuples: pt.Format,
+            keypair: hd.KeyRef,
+            network: net.NetworkLike = None) -> List[str]:
+        '''Like partial_tx.multidutch_as_hex. One job per prevout'''
+        dutch = functools.partial(
+            _dutch_as_hex,
+            recipient_addr=recipient_addr,
+            format_tuples=format_tuples,
+            keypair=keypair,
+            network=network)
+        return await self.map(dutch, prevouts)
+
+    async def sign_eth_txns(
+            self,
+            unsigned: Iterable[transactions.UnsignedEthTx],
+            eth_privkey: str) -> List[str]:
+        '''
+        Signs Ethereum txns. One job per tx
+
+        Args:
+            unsigned (list(UnsignedEthTx)): the txns to sign
+            eth_privkey            (str): the privkey as hex
+        Returns:
+            (list(str)): the serialized signed txns as hex, in order
+        '''
+        secret_key = bytes.fromhex(eth_privkey)
+        return await self.map(
+            functools.partial(_sign_eth_tx, secret_key=secret_key),
+            unsigned)
+
+    async def make_btc_shutdown_txns(self, **kwargs: Any) -> List[str]:
+        '''
+        Like eth_auction_setup.make_btc_shutdown_txns, and takes the same
+        arguments. The txns spend each other, so they are built as one job
+        '''
+        return await self.run(eas.make_btc_shutdown_txns, **kwargs)
+
+    async def make_and_broadcast_btc_shutdown(
+            self,
+            send: bc.Sender = merkle.broadcast,
+            **kwargs: Any) -> List[bc.BroadcastStatus]:
+        '''
+        Like eth_auction_setup.make_and_broadcast_btc_shutdown, but for a
+        running loop. Builds and signs in the executor, then broadcasts
+        from the loop
+
+        Args:
+            send (coroutine function): broadcasts one tx hex
+            kwargs                   : as for make_btc_shutdown_txns, plus
+                                       ledger
+        '''
+        ledger = kwargs.pop('ledger', None)
+        shutdown_txns = await self.make_btc_shutdown_txns(**kwargs)
+        statuses = await bc.broadcast_all(shutdown_txns, send=send)
+        if ledger is not None:
+            ledger.mark_closed(
+                kwargs['auction_tx_id'],
+                [i for i, s in zip(kwargs['idxs'], statuses)
+                 if s.status == bc.ACCEPTED])
+        return statuses
+
+
+# NB: jobs are module level, so they pickle for process pools
+
+def _dutch(
+        prevout: pt.Prevout,
+        recipient_addr: str,
+        format_tuples: pt.Format,
+        keypair: hd.KeyRef,
+        network: net.NetworkLike) -> pt.Auction:
+    return pt.dutch(prevout[0], prevout[1], prevout[2],
+                    recipient_addr, format_tuples, keypair, network)
+
+
+def _dutch_as_hex(
+        prevout: pt.Prevout,
+        recipient_addr: str,
+        format_tuples: pt.Format,
+        keypair: hd.KeyRef,
+        network: net.NetworkLike) -> str:
+    return pt.dutch_as_hex(prevout[0], prevout[1], prevout[2],
+                           recipient_addr, format_tuples, keypair, network)
+
+
+def _sign_eth_tx(
+        unsigned: transactions.UnsignedEthTx,
+        secret_key: bytes) -> str:
+    return bytes(unsigned.sign(secret_key).serialize()).hex()
@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+
+import scripts.utils as utils
+
+from typing import Any, Callable, Optional
+
+CACHE_PATH = os.path.join(utils.PATH, 'artifacts')
+
+
+def artifact_key(kind: str, **fields: Any) -> str:
+    '''
+    Makes a content address from everything that determines an artifact.
+    The same inputs always produce the same key.
+
+    Args:
+        kind      (str): the type of artifact, e.g. 'split_tx'
+        **fields:        JSON-serializable inputs to the artifact
+    Returns:
+        (str): the key as hex
+    '''
+    fields['kind'] = kind
+    preimage = json.dumps(fields, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(preimage.encode('utf-8')).hexdigest()
+
+
+def key_id(secret_hex: str) -> str:
+    '''
+    Makes a stable identifier for a private key without storing the key
+    Args:
+        secret_hex (str): the private key as hex
+    Returns:
+        (str): the identifier as hex
+    '''
+    preimage = b'integral-key-id' + bytes.fromhex(secret_hex)
+    return hashlib.sha256(preimage).hexdigest()[:32]
+
+
+def data_id(data: bytes) -> str:
+    '''Hashes a blob, e.g. calldata, for use in an artifact key'''
+    return hashlib.sha256(data).hexdigest()
+
+
+class ArtifactCache:
+    '''
+    A content-addressed store of signed artifacts on disk. Artifacts are
+    keyed by the hash of the inputs that determine them (see artifact_key),
+    so a rerun that asks for the same artifact gets the stored one back
+    instead of signing it again.
+
+    Args:
+        path (str): the cache directory
+    '''
+
+    def __init__(self, path: str = CACHE_PATH) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key: str) -> str:
+        # NB: fan out into subdirectories to keep directories small
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        '''Returns the artifact stored under key, or None'''
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        '''Stores an artifact under key'''
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        utils.write_to_file(data, filename)
+
+    def get_or_make(self, key: str, make: Callable[[], bytes]) -> bytes:
+        '''
+        Returns the artifact stored under key. If there is none, makes it,
+        stores it, and returns it.
+        '''
+        data = self.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = make()
+        self.put(key, data)
+        return data
+
+
+def cached(
+        cache: Optional[ArtifactCache],
+        key: str,
+        make: Callable[[], bytes]) -> bytes:
+    '''Like ArtifactCache.get_or_make, but makes the artifact if no cache'''
+    if cache is None:
+        return make()
+    return cache.get_or_make(key, make)
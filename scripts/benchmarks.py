@@ -0,0 +1,380 @@
+'''
+Benchmarks for the signing, building and proof paths.
+
+Run all cases and save a baseline:
+    python -m scripts.benchmarks --save bench_baseline.json
+
+After upgrading a dependency, compare against it. Without --scales, the
+baseline's scales are run:
+    python -m scripts.benchmarks --compare bench_baseline.json
+
+bench_baseline.json was saved with --scales 1,100,1000,10000.
+
+Keys, outpoints and proofs are fixed, so runs are comparable. Without a
+contract build, make_several_auctions encodes with OPEN_ABI, the ABI of
+open as interface_wrapper calls it. Encoding depends only on its types.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import statistics
+import platform
+import tracemalloc
+import contextlib
+
+import scripts.utils as utils
+import scripts.partial_tx as pt
+
+from typing import Any, Callable, Dict, List, Optional, TextIO, Tuple
+
+DEFAULT_SCALES = [1, 100, 10000]
+DEFAULT_THRESHOLD = 0.10
+DEFAULT_REPEAT = 5
+
+FORMAT = [(100000 - 5000 * i, 600000 + 6 * i) for i in range(10)]
+RECIPIENT = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+PASSPHRASE = 'integral-benchmark-passphrase'
+PROOF_DEPTH = 12
+
+OPEN_ABI: List[Dict[str, Any]] = [{
+    'type': 'function',
+    'name': 'open',
+    'constant': False,
+    'payable': True,
+    'stateMutability': 'payable',
+    'inputs': [{'name': name, 'type': t} for name, t in [
+        ('_partialTx', 'bytes'),
+        ('_reservePrice', 'uint256'),
+        ('_reqDiff', 'uint256'),
+        ('_asset', 'address'),
+        ('_value', 'uint256')]],
+    'outputs': [{'name': '', 'type': 'bytes32'}]}]
+
+Results = Dict[str, Dict[str, Dict[str, float]]]
+Case = Callable[[int], Callable[[], Any]]
+
+
+def _fixed_bytes(label: str, i: int = 0) -> bytes:
+    return hashlib.sha256('integral-bench-{}-{}'.format(label, i)
+                          .encode('utf-8')).digest()
+
+
+def _keypair() -> pt.KeyPair:
+    priv = _fixed_bytes('btc-key')
+    pub = utils.to_pubkey(utils.coerce_key(priv))
+    return priv.hex(), pub.hex()
+
+
+def _prevouts(n: int) -> List[pt.Prevout]:
+    tx_id = _fixed_bytes('split-tx').hex()
+    return [(tx_id, i, 550) for i in range(n)]
+
+
+def _proof(i: int) -> Tuple[bytes, int]:
+    '''Makes a proof of PROOF_DEPTH in the format verify_proof expects'''
+    leaf = _fixed_bytes('leaf', i)
+    position = int.from_bytes(_fixed_bytes('pos', i)[:4], 'big') \
+        % (2 ** PROOF_DEPTH)
+    index = position + 1  # NB: verify_proof is 1-indexed
+    proof = bytearray(leaf)
+    current = leaf
+    for level in range(PROOF_DEPTH):
+        sibling = _fixed_bytes('sibling-{}'.format(level), i)
+        proof.extend(sibling)
+        if index % 2 == 0:
+            current = hashlib.sha256(
+                hashlib.sha256(sibling + current).digest()).digest()
+            index = index // 2
+        else:
+            current = hashlib.sha256(
+                hashlib.sha256(current + sibling).digest()).digest()
+            index = index // 2 + 1
+    proof.extend(current)
+    return bytes(proof), position + 1
+
+
+def bench_dutch(scale: int) -> Callable[[], Any]:
+    keypair = _keypair()
+    prevouts = _prevouts(scale)
+
+    def run() -> None:
+        for p in prevouts:
+            pt.dutch(p[0], p[1], p[2], RECIPIENT, FORMAT, keypair)
+    return run
+
+
+def bench_multidutch(scale: int) -> Callable[[], Any]:
+    keypair = _keypair()
+    prevouts = _prevouts(scale)
+    return lambda: pt.multidutch(prevouts, RECIPIENT, FORMAT, keypair)
+
+
+def bench_make_several_auctions(scale: int) -> Callable[[], Any]:
+    import scripts.eth_auction_setup as eas
+    import scripts.interface_wrapper as iw
+    if iw.ABI is None and not os.path.exists(iw.BUILD_FILE):
+        iw.ABI = OPEN_ABI
+    keypair = _keypair()
+
+    def run() -> None:
+        eas.make_several_auctions(
+            tx_id=_fixed_bytes('funding-tx').hex(),
+            index=0,
+            control_addr=RECIPIENT,
+            control_addr_keypair=keypair,
+            prevout_value=550 * scale + 10 ** 8,
+            start_nonce=0,
+            contract_address='0x' + _fixed_bytes('contract')[:20].hex(),
+            reqDiff=1000,
+            eth_value=10 ** 18,
+            eth_privkey=_fixed_bytes('eth-key').hex(),
+            num_auctions=scale,
+            recipient=RECIPIENT,
+            form=FORMAT)
+    return run
+
+
+def _state(scale: int) -> bytes:
+    '''A JSON state file holding one serialized auction per auction'''
+    blob = _fixed_bytes('partial').hex() * 40  # ~2.5 KB, like 10 tiers
+    return json.dumps({str(i): blob for i in range(scale)}).encode('utf-8')
+
+
+def bench_encode_aes(scale: int) -> Callable[[], Any]:
+    state = _state(scale)
+    return lambda: utils.encode_aes(state, PASSPHRASE)
+
+
+def bench_decode_aes(scale: int) -> Callable[[], Any]:
+    encrypted = utils.encode_aes(_state(scale), PASSPHRASE)
+    return lambda: utils.decode_aes(encrypted, PASSPHRASE)
+
+
+def bench_encode_envelope(scale: int) -> Callable[[], Any]:
+    state = _state(scale)
+    return lambda: utils.encode_envelope(state, PASSPHRASE)
+
+
+def bench_decode_envelope(scale: int) -> Callable[[], Any]:
+    encrypted = utils.encode_envelope(_state(scale), PASSPHRASE)
+    return lambda: utils.decode_envelope(encrypted, PASSPHRASE)
+
+
+def bench_verify_proof(scale: int) -> Callable[[], Any]:
+    import scripts.merkle as merkle
+    proofs = [_proof(i) for i in range(scale)]
+
+    def run() -> None:
+        for proof, index in proofs:
+            assert merkle.verify_proof(proof, index)
+    return run
+
+
+def _block(scale: int) -> Tuple[bytes, List[Tuple[str, int]]]:
+    '''
+    Makes a block of scale segwit txns, and the outpoints to watch. Every
+    100th tx spends an auction outpoint, and every 7th is watched
+    '''
+    outpoints = [(_fixed_bytes('auction').hex(), i) for i in range(scale)]
+    txns = []
+    for i in range(scale):
+        prevout = bytes.fromhex(outpoints[i][0])[::-1] \
+            + i.to_bytes(4, 'little') if i % 100 == 0 \
+            else _fixed_bytes('prevout', i) + b'\x00' * 4
+        output = (550).to_bytes(8, 'little') + b'\x16\x00\x14' \
+            + _fixed_bytes('script', i)[:20]
+        witness = b'\x02\x48' + b'\x30' * 72 + b'\x21' + b'\x02' * 33
+        txns.append(b'\x01\x00\x00\x00\x00\x01\x01' + prevout
+                    + b'\x00\xff\xff\xff\xff\x02' + output * 2
+                    + witness + b'\x00' * 4)
+    count = len(txns)
+    count_bytes = bytes([count]) if count < 0xfd \
+        else b'\xfe' + count.to_bytes(4, 'little')
+    return b'\x00' * 80 + count_bytes + b''.join(txns), outpoints[::7]
+
+
+def bench_scan_block(scale: int) -> Callable[[], Any]:
+    # NB: imported here, as the scanner needs the ledger's dependencies
+    import scripts.scanner as scanner
+    block, outpoints = _block(scale)
+    s = scanner.Scanner(outpoints)
+    return lambda: s.scan_block(block)
+
+
+CASES: Dict[str, Case] = {
+    'dutch': bench_dutch,
+    'multidutch': bench_multidutch,
+    'make_several_auctions': bench_make_several_auctions,
+    'encode_aes': bench_encode_aes,
+    'decode_aes': bench_decode_aes,
+    'encode_envelope': bench_encode_envelope,
+    'decode_envelope': bench_decode_envelope,
+    'verify_proof': bench_verify_proof,
+    'scan_block': bench_scan_block,
+}
+
+
+def measure(
+        run: Callable[[], Any],
+        repeat: int = DEFAULT_REPEAT,
+        memory: bool = True) -> Dict[str, float]:
+    '''Times a benchmark, and optionally measures its peak memory
+
+    Args:
+        run     (callable): the benchmark body
+        repeat       (int): timing runs. the median is reported
+        memory      (bool): whether to do a separate run under tracemalloc
+    Returns:
+        (dict): seconds, and peak bytes allocated if measured
+    '''
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+            result = {'seconds': statistics.median(times)}
+
+            if memory:
+                tracemalloc.start()
+                try:
+                    run()
+                    result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+    return result
+
+
+def _versions() -> Dict[str, Optional[str]]:
+    versions: Dict[str, Optional[str]] = {'python': platform.python_version()}
+    try:
+        from importlib import metadata  # type: ignore
+    except ImportError:  # NB: python 3.7
+        return versions
+    for package in ['ecdsa', 'riemann-tx', 'riemann-ether', 'pycryptodomex']:
+        try:
+            versions[package] = metadata.version(package)
+        except Exception:
+            versions[package] = None
+    return versions
+
+
+def run_all(
+        cases: List[str],
+        scales: List[int],
+        repeat: int = DEFAULT_REPEAT,
+        memory: bool = True,
+        out: TextIO = sys.stderr) -> Results:
+    '''Runs each case at each scale, and logs progress to out'''
+    results: Results = {}
+    for name in cases:
+        results[name] = {}
+        for scale in scales:
+            try:
+                run = CASES[name](scale)
+            except (ImportError, OSError) as e:
+                print('{:<24} skipped: {!r}'.format(name, e), file=out)
+                break
+            result = measure(run, repeat, memory)
+            results[name][str(scale)] = result
+            print('{:<24}{:>8}{:>12.4f}s{:>14}'.format(
+                name, scale, result['seconds'],
+                result.get('peak_bytes', '')), file=out)
+    return results
+
+
+def compare(
+        results: Results,
+        baseline: Results,
+        threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    '''Finds measurements that regressed by more than threshold
+
+    Args:
+        results   (dict): the new measurements
+        baseline  (dict): the stored measurements
+        threshold (float): allowed fractional slowdown or memory growth
+    Returns:
+        (list(str)): a description of each regression
+    '''
+    regressions = []
+    for name, scales in results.items():
+        for scale, new in scales.items():
+            old = baseline.get(name, {}).get(scale)
+            if old is None:
+                continue
+            for metric in ['seconds', 'peak_bytes']:
+                if metric not in new or not old.get(metric):
+                    continue
+                change = new[metric] / old[metric] - 1
+                if change > threshold:
+                    regressions.append(
+                        '{} @ {}: {} {:.4g} -> {:.4g} (+{:.1%})'.format(
+                            name, scale, metric,
+                            old[metric], new[metric], change))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='comma-separated cases to run')
+    parser.add_argument('--scales',
+                        help='comma-separated numbers of auctions. '
+                             'defaults to the baseline\'s, or {}'.format(
+                                 ','.join(str(s) for s in DEFAULT_SCALES)))
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='timing runs per case. the median is kept')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc run')
+    parser.add_argument('--save', help='write results to this file')
+    parser.add_argument('--compare', help='baseline file to compare to')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='fractional regression to flag')
+    args = parser.parse_args()
+
+    cases = args.cases.split(',')
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error('unknown cases: {}'.format(', '.join(unknown)))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    if args.scales:
+        scales = [int(s) for s in args.scales.split(',')]
+    elif baseline is not None:
+        scales = sorted({int(scale) for case in baseline['results'].values()
+                         for scale in case})
+    else:
+        scales = DEFAULT_SCALES
+
+    results = run_all(
+        cases=cases,
+        scales=scales,
+        repeat=args.repeat,
+        memory=not args.no_memory)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'versions': _versions(), 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        print('baseline versions: {}'.format(baseline.get('versions')))
+        print('current versions:  {}'.format(_versions()))
+        regressions = compare(results, baseline['results'], args.threshold)
+        for r in regressions:
+            print('REGRESSION {}'.format(r))
+        if regressions:
+            sys.exit(1)
+        print('no regressions over {:.0%}'.format(args.threshold))
+
+
+if __name__ == '__main__':
+    main()
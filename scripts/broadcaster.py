@@ -0,0 +1,156 @@
+import asyncio
+import logging
+
+import scripts.merkle as merkle
+
+from riemann import tx
+
+from typing import (Any, Awaitable, Callable, Dict, List, Optional, Sequence,
+                    Union)
+
+# Per-tx broadcast states
+ACCEPTED = 'accepted'
+FAILED = 'failed'
+SKIPPED = 'skipped'  # an in-set parent was never accepted
+
+# Errors worth retrying. Anything else is a rejection by the server
+TRANSIENT_ERRORS = (asyncio.TimeoutError, OSError)
+
+# Rejections that mean the server already has the tx
+ALREADY_KNOWN = ('already in block chain', 'txn-already-in-mempool',
+                 'txn-already-known', 'transaction already exists')
+
+Sender = Callable[[str], Awaitable[Any]]
+
+
+class BroadcastStatus:
+    '''The outcome of broadcasting a single transaction
+
+    Attributes:
+        tx_id            (str): the txid, as hex
+        parents    (list(str)): the txids of in-set parents
+        status           (str): ACCEPTED, FAILED or SKIPPED
+        result             (*): the server response, if accepted
+        error      (Exception): the last error, if not accepted
+        attempts         (int): how many times we submitted the tx
+    '''
+
+    def __init__(self, tx_id: str, parents: List[str]) -> None:
+        self.tx_id = tx_id
+        self.parents = parents
+        self.status = SKIPPED
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.attempts = 0
+
+    def __repr__(self) -> str:
+        return 'BroadcastStatus({}, {}, attempts={})'.format(
+            self.tx_id, self.status, self.attempts)
+
+
+def _is_already_known(e: BaseException) -> bool:
+    msg = str(e).lower()
+    return any(s in msg for s in ALREADY_KNOWN)
+
+
+def dependency_graph(txns: Sequence[tx.Tx]) -> Dict[str, List[str]]:
+    '''Finds the parents of each tx within a set of txns
+
+    Args:
+        txns (list(riemann.tx.Tx)): the transactions
+    Returns:
+        (dict(str, list(str))): each txid mapped to its in-set parent txids
+    '''
+    tx_ids = [t.tx_id.hex() for t in txns]
+    known = set(tx_ids)
+    graph = {}
+    for tx_id, t in zip(tx_ids, txns):
+        # NB: outpoints hold the txid in little-endian
+        parents = {tx_in.outpoint.tx_id[::-1].hex() for tx_in in t.tx_ins}
+        graph[tx_id] = sorted(p for p in parents if p in known)
+    return graph
+
+
+async def _send_with_retries(
+        txhex: str,
+        status: BroadcastStatus,
+        send: Sender,
+        semaphore: asyncio.Semaphore,
+        retries: int,
+        backoff: float,
+        max_backoff: float) -> None:
+    delay = backoff
+    while True:
+        status.attempts += 1
+        try:
+            async with semaphore:
+                status.result = await send(txhex)
+            status.status = ACCEPTED
+            status.error = None
+            return
+        except TRANSIENT_ERRORS as e:
+            status.error = e
+            if status.attempts > retries:
+                status.status = FAILED
+                return
+            logging.warning('transient error broadcasting {}: {!r}. '
+                            'retrying in {}s'.format(status.tx_id, e, delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_backoff)
+        except Exception as e:
+            status.error = e
+            status.status = ACCEPTED if _is_already_known(e) else FAILED
+            return
+
+
+async def broadcast_all(
+        txns: Sequence[Union[tx.Tx, str]],
+        send: Sender = merkle.broadcast,
+        max_concurrency: int = 8,
+        retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30) -> List[BroadcastStatus]:
+    '''
+    Broadcasts a set of transactions, respecting dependencies among them.
+    Txns without in-set parents are sent concurrently. Each child is sent as
+    soon as all of its in-set parents are accepted. If a parent fails, its
+    descendants are skipped.
+
+    Args:
+        txns  (list(riemann.tx.Tx or str)): the transactions, objects or hex
+        send                  (coroutine): broadcasts a single tx hex
+        max_concurrency             (int): max number of in-flight requests
+        retries                     (int): retries per tx on transient errors
+        backoff                   (float): the first retry delay in seconds
+        max_backoff               (float): the largest retry delay in seconds
+    Returns:
+        (list(BroadcastStatus)): a status for each tx, in input order
+    '''
+    parsed = [tx.Tx.from_hex(t) if isinstance(t, str) else t for t in txns]
+    graph = dependency_graph(parsed)
+
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    statuses = {tx_id: BroadcastStatus(tx_id, parents)
+                for tx_id, parents in graph.items()}
+    finished: Dict[str, asyncio.Future] = {
+        tx_id: loop.create_future() for tx_id in graph}
+
+    async def run(t: tx.Tx) -> None:
+        tx_id = t.tx_id.hex()
+        status = statuses[tx_id]
+        try:
+            for parent in status.parents:
+                await finished[parent]
+            if all(statuses[p].status == ACCEPTED for p in status.parents):
+                await _send_with_retries(
+                    t.hex(), status, send, semaphore,
+                    retries, backoff, max_backoff)
+        finally:
+            if not finished[tx_id].done():
+                finished[tx_id].set_result(None)
+
+    # NB: a tx listed twice is only sent once
+    unique = {t.tx_id.hex(): t for t in parsed}
+    await asyncio.gather(*[run(t) for t in unique.values()])
+    return [statuses[t.tx_id.hex()] for t in parsed]
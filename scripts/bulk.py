@@ -0,0 +1,186 @@
+'''
+Generates auctions in bulk from JSONL auction specs.
+
+Each input line is a JSON object:
+    {
+        "prevouts": [["<txid>", <index>, <value>], ...],
+        "format": [[<value>, <lock_time>], ...],
+        "recipient": "<bitcoin address>",
+        "key": "<name of a keypair in the keyring>",
+        "network": "bitcoin_main",                      (optional)
+        "eth": {"reservePrice": <int>, "reqDiff": <int>,
+                "asset": "<address>", "value": <int>}   (optional)
+    }
+
+Each output line holds the dutch partial txns of each prevout as hex,
+and the open calldata for each if "eth" was given:
+    {"line": 1, "partial_txs": [...], "open_data": [...]}
+or the error that the spec produced:
+    {"line": 1, "error": "..."}
+
+Output is in input order. Memory use does not grow with input size.
+
+Usage:
+    python -m scripts.bulk --keyring keys.enc -i specs.jsonl -o out.jsonl
+'''
+import os
+import sys
+import json
+import getpass
+import argparse
+
+import scripts.utils as utils
+import scripts.partial_tx as pt
+
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import (Any, Deque, Dict, Iterable, Iterator, Optional, TextIO,
+                    Tuple)
+
+KEYRING_PASSPHRASE_ENV = 'INTEGRAL_PASSPHRASE'
+
+Keyring = Dict[str, pt.KeyPair]
+
+_KEYRING: Keyring = {}
+
+
+def load_keyring(filename: str, secret_phrase: str) -> Keyring:
+    '''Reads an encrypted keyring mapping names to [privkey, pubkey] hex'''
+    data = utils.read_encrypted_json_file(filename, secret_phrase)
+    return {name: (k[0], k[1]) for name, k in data.items()}
+
+
+def _init_worker(keyring: Keyring) -> None:
+    global _KEYRING
+    _KEYRING = keyring
+
+
+def process_spec(line_no: int, line: str) -> Tuple[bool, str]:
+    '''
+    Builds the auctions for one JSONL spec line
+
+    Args:
+        line_no  (int): the 1-indexed line number, echoed in the output
+        line     (str): the spec, as JSON
+    Returns:
+        (bool, str): whether it succeeded, and the result as a JSON line
+                     without the trailing newline
+    '''
+    try:
+        spec = json.loads(line)
+        keypair = _KEYRING[spec['key']]
+        format_tuples = [(f[0], f[1]) for f in spec['format']]
+        partial_txs = pt.multidutch_as_hex(
+            prevouts=[(p[0], p[1], p[2]) for p in spec['prevouts']],
+            recipient_addr=spec['recipient'],
+            format_tuples=format_tuples,
+            keypair=keypair,
+            network=spec.get('network'))
+        result: Dict[str, Any] = {'line': line_no, 'partial_txs': partial_txs}
+
+        eth = spec.get('eth')
+        if eth is not None:
+            # NB: imported here, as the interface wrapper needs the build
+            import scripts.interface_wrapper as iw
+            result['open_data'] = [iw.create_open_data(
+                partial_tx=p,
+                reservePrice=eth['reservePrice'],
+                reqDiff=eth['reqDiff'],
+                asset=eth['asset'],
+                value=eth['value']).hex() for p in partial_txs]
+    except KeyError as e:
+        return False, json.dumps(
+            {'line': line_no, 'error': 'missing {}'.format(e)})
+    except Exception as e:
+        return False, json.dumps({'line': line_no, 'error': repr(e)})
+    return True, json.dumps(result)
+
+
+def _specs(lines: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    for line_no, line in enumerate(lines, 1):
+        if line.strip():
+            yield line_no, line
+
+
+def run(
+        lines: Iterable[str],
+        out: TextIO,
+        keyring: Keyring,
+        workers: int = 1,
+        window: Optional[int] = None) -> int:
+    '''
+    Streams specs through the builders and writes results in input order.
+    At most window specs are in flight, so memory stays constant.
+
+    Args:
+        lines  (iterable(str)): JSONL spec lines
+        out         (TextIO): where to write result lines
+        keyring       (dict): key names mapped to keypairs
+        workers        (int): worker processes. 0 to run in this process
+        window         (int): max specs in flight. 4 per worker if None
+    Returns:
+        (int): the number of specs that failed
+    '''
+    failures = 0
+
+    def emit(result: Tuple[bool, str]) -> None:
+        nonlocal failures
+        if not result[0]:
+            failures += 1
+        out.write(result[1] + '\n')
+
+    if workers == 0:
+        _init_worker(keyring)
+        for line_no, line in _specs(lines):
+            emit(process_spec(line_no, line))
+        return failures
+
+    window = window or workers * 4
+    pending: Deque[Future] = deque()
+    executor: Executor = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(keyring,))
+    with executor:
+        for line_no, line in _specs(lines):
+            if len(pending) >= window:
+                emit(pending.popleft().result())
+            pending.append(executor.submit(process_spec, line_no, line))
+        while pending:
+            emit(pending.popleft().result())
+    out.flush()
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Generates auctions in bulk from JSONL auction specs')
+    parser.add_argument('-i', '--input', help='spec file. stdin if omitted')
+    parser.add_argument('-o', '--output', help='result file. stdout if '
+                                               'omitted')
+    parser.add_argument('--keyring', required=True,
+                        help='encrypted JSON file of name: [priv, pub]')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes. 0 to run in-process')
+    args = parser.parse_args()
+
+    secret_phrase = os.environ.get(KEYRING_PASSPHRASE_ENV) \
+        or getpass.getpass('Keyring passphrase: ')
+    keyring = load_keyring(args.keyring, secret_phrase)
+
+    infile = open(args.input, 'r') if args.input else sys.stdin
+    outfile = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        failures = run(infile, outfile, keyring, args.workers)
+    finally:
+        if args.input:
+            infile.close()
+        if args.output:
+            outfile.close()
+    if failures:
+        print('{} specs failed'.format(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,25 @@
+import scripts.hd as hd
+import scripts.gas as gas
+import scripts.fees as fees
+import scripts.network as net
 import scripts.utils as utils
+import scripts.sighash as sighash
 import scripts.utxo_setup as us
 import scripts.partial_tx as pt
 import scripts.interface_wrapper as iw
-import scripts.merkle as merkle
+import scripts.broadcaster as bc
+import scripts.artifact_cache as ac
+import scripts.ledger as ledger_db
 
 import asyncio
 
-import riemann
 import riemann.tx as tx
 import riemann.utils as rutils
 import riemann.simple as simple
 
 # from ether import transactions
 
-from typing import cast, List, Tuple
+from typing import cast, List, Optional, Sequence, Tuple, Union
 
 GWEI = 1000000000  # 1 GWEI
 ETH_ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
@@ -29,11 +35,102 @@ ETH_ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
 # 3. Make Ether data blobs
 
 
+def make_auctions(
+        prevouts: Sequence[Union[pt.Prevout, pt.CompactPrevout]],
+        auction_keys: hd.KeyRef,
+        start_nonce: int,
+        contract_address: str,
+        reqDiff: int,
+        eth_value: int,
+        eth_privkey: str,
+        recipient: str,
+        form: List[Tuple[int, int]],
+        network_id: int = 1,
+        cache: Optional[ac.ArtifactCache] = None) -> Tuple[
+            List[str], List[str], List[str]]:
+    '''
+    Signs a dutch auction of each prevout, and an Ethereum tx listing each.
+    The prevouts are e.g. a split tx's outputs, or split tree leaves
+
+    Args:
+        prevouts (list(tuple or CompactPrevout)): txid, index, value
+        auction_keys                  (KeyRef): the keys of the prevouts. a
+                                                template is filled with
+                                                each prevout's index
+        start_nonce                      (int): the nonce of the first
+                                                Ethereum tx
+        see make_several_auctions for the rest
+    Returns:
+        tuple(List(str), List(str), List(str)):
+            the partial txns,
+            the ether data blobs,
+            and the signed Ethereum txns
+    '''
+    network = net.for_eth_network(network_id).name
+    compact_form = pt.CompactFormat(form)
+    partial_txns = []
+    for p in prevouts:
+        prevout = p if isinstance(p, pt.CompactPrevout) \
+            else pt.CompactPrevout(*p)
+        auction_keypair = hd.resolve(auction_keys, prevout.index)
+        dutch_key = ac.artifact_key(
+            'dutch',
+            outpoint=[prevout.tx_id.hex(), prevout.index],
+            prevout_value=prevout.value,
+            recipient=recipient,
+            tiers=form,
+            pubkey=auction_keypair[1])
+        partial_txns.append(ac.cached(
+            cache,
+            dutch_key,
+            lambda: b''.join(t.raw for t in pt.dutch_compact(
+                prevout, recipient, compact_form, auction_keypair,
+                network))).hex())
+
+    ether_blobs = [iw.create_open_data(
+        partial_tx=p,
+        reservePrice=1000000,
+        reqDiff=reqDiff,
+        asset=ETH_ZERO_ADDRESS,
+        value=eth_value
+    ) for p in partial_txns]
+
+    secret_key = bytes.fromhex(eth_privkey)
+    eth_key_id = ac.key_id(eth_privkey)
+    signed_ether_txns = []
+    for nonce, blob in enumerate(ether_blobs, start_nonce):
+        start_gas = gas.estimate('open', blob)
+        unsigned = iw.create_unsigned_tx(
+            tx_data=blob,
+            value=eth_value,
+            nonce=nonce,
+            gas_price=15 * GWEI,
+            start_gas=start_gas,
+            contract_address=contract_address,
+            network_id=network_id)
+        eth_key = ac.artifact_key(
+            'eth_tx',
+            key_id=eth_key_id,
+            nonce=nonce,
+            calldata=ac.data_id(blob),
+            value=eth_value,
+            gas_price=15 * GWEI,
+            start_gas=start_gas,
+            contract_address=contract_address,
+            network_id=network_id)
+        signed_ether_txns.append(ac.cached(
+            cache,
+            eth_key,
+            lambda: bytes(unsigned.sign(secret_key).serialize())).hex())
+
+    return partial_txns, [b.hex() for b in ether_blobs], signed_ether_txns
+
+
 def make_several_auctions(
         tx_id: str,
         index: int,
         control_addr: str,
-        control_addr_keypair: Tuple[str, str],
+        control_addr_keypair: hd.KeyRef,
         prevout_value: int,
         start_nonce: int,
         contract_address: str,
@@ -43,7 +140,12 @@ def make_several_auctions(
         num_auctions: int,
         recipient: str,
         form: List[Tuple[int, int]],
-        network_id: int = 1) -> Tuple[tx.Tx, List[str], List[str]]:
+        network_id: int = 1,
+        feerate: int = fees.DEFAULT_FEERATE,
+        cache: Optional[ac.ArtifactCache] = None,
+        ledger: Optional[ledger_db.AuctionLedger] = None,
+        auction_keys: Optional[hd.KeyRef] = None) -> Tuple[
+            tx.Tx, List[str], List[str]]:
     '''
     Args:
         tx_id                            (str): A txid containing an output
@@ -51,7 +153,8 @@ def make_several_auctions(
         index                            (int): The index controlled
         control_addr                     (str): the addr controlling the
                                                 outpoint described above
-        control_addr_keypair (Tuple(str, str)): the keypair to the control addr
+        control_addr_keypair          (KeyRef): the keypair to the control
+                                                addr, or an hd.KeyPath to it
         prevout_value                    (int): The value of the prevout
         start_nonce                      (int): the ethereum account nonce to
                                                 use in the first tx
@@ -65,58 +168,84 @@ def make_several_auctions(
         form                       list(tuple): the price/timelock tuples for
                                                 the auctions
         network_id                       (int): ether network id, 1 for main,
-                                                3 for ropsten
+                                                3 for ropsten. bitcoin txns
+                                                use mainnet for 1 and
+                                                testnet otherwise
+        feerate                          (int): bitcoin fee rate in sat/vbyte
+        cache                  (ArtifactCache): stores signed artifacts, so
+                                                that a rerun only signs what
+                                                is missing
+        ledger                 (AuctionLedger): records the auctions and
+                                                their Ethereum txns
+        auction_keys                  (KeyRef): the keys that hold the
+                                                auctioned outputs. an
+                                                hd.KeyPath template gives
+                                                each auction its own key,
+                                                scoped to tx_id and index.
+                                                the control key if None
     Returns:
         tuple(riemann.tx.Tx, List(str), List(str)):
             the Bitcoin tx,
             the ether data blobs,
             and the signed Ethereum txns
     '''
-    if network_id != 1:
-        riemann.select_network('bitcoin_test')
-    split_tx = make_and_sign_split_tx(
-        tx_id=tx_id,
-        index=index,
+    # NB: pass the network down explicitly rather than selecting it
+    #     globally, so batches for different networks can run concurrently
+    network = net.for_eth_network(network_id).name
+    if auction_keys is None:
+        auction_keys = control_addr_keypair
+    auction_keys = hd.for_batch(auction_keys, tx_id, index)
+    split_key = ac.artifact_key(
+        'split_tx',
+        outpoint=[tx_id, index],
         prevout_value=prevout_value,
         control_addr=control_addr,
-        control_addr_keypair=control_addr_keypair,
+        pubkey=hd.key_id(control_addr_keypair),
+        auction_keys=hd.key_id(auction_keys),
         num_auctions=num_auctions,
-        change_addr=recipient)
+        change_addr=recipient,
+        feerate=feerate)
+    split_tx = tx.Tx.from_bytes(ac.cached(
+        cache,
+        split_key,
+        lambda: make_and_sign_split_tx(
+            tx_id=tx_id,
+            index=index,
+            prevout_value=prevout_value,
+            control_addr=control_addr,
+            control_addr_keypair=control_addr_keypair,
+            num_auctions=num_auctions,
+            change_addr=recipient,
+            feerate=feerate,
+            network=network,
+            auction_keys=auction_keys).to_bytes()))
 
     split_tx_id = split_tx.tx_id.hex()
-    prevout_tuples = [(split_tx_id, i, 550) for i in range(num_auctions)]
 
-    partial_txns = pt.multidutch_as_hex(
-        prevouts=prevout_tuples,
-        recipient_addr=recipient,
-        format_tuples=form,
-        keypair=control_addr_keypair)
-
-    ether_blobs = [iw.create_open_data(
-        partial_tx=p[0],
-        reservePrice=1000000,
-        reqDiff=reqDiff,
-        asset=ETH_ZERO_ADDRESS,
-        value=eth_value
-    ).hex() for p in zip(partial_txns, range(len(partial_txns)))]
-
-    unsigned_ether = [iw.create_open_tx(
-        partial_tx=p[0],
-        reservePrice=1000000,
-        reqDiff=reqDiff,
-        asset=ETH_ZERO_ADDRESS,
-        value=eth_value,
-        nonce=start_nonce + p[1],
-        gas_price=15 * GWEI,
-        start_gas=500000,
+    partial_txns, ether_blobs, signed_ether_txns = make_auctions(
+        prevouts=[pt.CompactPrevout(split_tx_id, i, 550)
+                  for i in range(num_auctions)],
+        auction_keys=auction_keys,
+        start_nonce=start_nonce,
         contract_address=contract_address,
-        network_id=network_id
-    ) for p in zip(partial_txns, range(len(partial_txns)))]
-
-    secret_key = bytes.fromhex(eth_privkey)
-    signed_ether_txns = [
-        tx.sign(secret_key).serialize().hex() for tx in unsigned_ether
-    ]
+        reqDiff=reqDiff,
+        eth_value=eth_value,
+        eth_privkey=eth_privkey,
+        recipient=recipient,
+        form=form,
+        network_id=network_id,
+        cache=cache)
+
+    if ledger is not None:
+        ledger.record_auctions(
+            split_tx_id,
+            ((i, 550, bytes.fromhex(p)) for i, p in enumerate(partial_txns)),
+            form)
+        ledger.record_eth_txns(
+            split_tx_id,
+            ((i, start_nonce + i,
+              utils.keccak256(bytes.fromhex(t)).hex())
+             for i, t in enumerate(signed_ether_txns)))
 
     return split_tx, ether_blobs, signed_ether_txns
 
@@ -126,9 +255,13 @@ def make_and_sign_split_tx(
         index: int,
         prevout_value: int,
         control_addr: str,
-        control_addr_keypair: Tuple[str, str],
+        control_addr_keypair: hd.KeyRef,
         num_auctions: int,
-        change_addr: str) -> tx.Tx:
+        change_addr: str,
+        fee: Optional[int] = None,
+        feerate: int = fees.DEFAULT_FEERATE,
+        network: net.NetworkLike = None,
+        auction_keys: Optional[hd.KeyRef] = None) -> tx.Tx:
     '''
     Makes and signs a transaction with several small outputs
     Args:
@@ -136,21 +269,40 @@ def make_and_sign_split_tx(
         index: the input prevout's index
         prevout_value: the input prevout's value
         control_addr: the input prevout's controlling address
-        control_addr_keypair: the priv/pub keypair as a tuple of hex
+        control_addr_keypair: the priv/pub keypair as a tuple of hex, or an
+            hd.KeyPath to it
         num_auctions: how many outputs to make
         change_addr: where to send leftover funds
+        fee: the tx fee to pay. computed from feerate if None
+        feerate: the fee rate in sat/vbyte
+        network: the bitcoin network name. riemann's current network if None
+        auction_keys: the keys to send the outputs to. an hd.KeyPath template
+            gives each output its own key, scoped to tx_id and index.
+            control_addr if None
     '''
+    if auction_keys is not None:
+        auction_keys = hd.for_batch(auction_keys, tx_id, index)
+    recipient: Union[str, List[str]] = control_addr
+    if isinstance(auction_keys, hd.KeyPath) and auction_keys.is_template:
+        recipient = [hd.address(auction_keys, i, network)
+                     for i in range(num_auctions)]
+    elif auction_keys is not None:
+        recipient = hd.address(auction_keys, network=network)
+
     # Split in 10, send SUMMA change
     split_tx = us.generate_small_utxos(
         tx_id=tx_id,
         index=index,
         prevout_value=prevout_value,
-        recipient_addr=control_addr,
+        recipient_addr=recipient,
         num_outputs=num_auctions,
         change_addr=change_addr,
-        fee=8000,
-        size=550)
+        fee=fee,
+        size=550,
+        feerate=feerate,
+        network=network)
 
+    control_addr_keypair = hd.resolve(control_addr_keypair, index)
     pubkeyhash = rutils.hash160(bytes.fromhex(control_addr_keypair[1]))
     prevout_script = b'\x19\x76\xa9\x14' + pubkeyhash + b'\x88\xac'
 
@@ -177,38 +329,56 @@ def undo_split(
         tx_id: str,
         num_auctions: int,
         change_addr: str,
-        control_addr_keypair: Tuple[str, str]) -> tx.Tx:
+        control_addr_keypair: hd.KeyRef,
+        feerate: int = fees.DEFAULT_FEERATE,
+        network: net.NetworkLike = None) -> tx.Tx:
     '''
     undoes a split tx. NOT FOR SHUTTING DOWN AUCTIONS
     Args:
         tx_id: the tx_id of the split tx
         num_auctions: the number of non-change outputs of the split tx
         change_addr: the address to send leftovers to
-        control_addr_keypair: the keypair of the controlling address
+        control_addr_keypair: the keypair of the controlling address, or an
+            hd.KeyPath to the keys of the split outputs. a template must
+            be scoped with hd.for_batch to the outpoint the split spent
+        feerate: the fee rate in sat/vbyte
+        network: the bitcoin network name. riemann's current network if None
     '''
     tx_ins = [simple.unsigned_input(simple.outpoint(tx_id, i))
               for i in range(num_auctions)]
-    tx_outs = [simple.output(600, change_addr)]
-    unsplit_tx = simple.unsigned_witness_tx(tx_ins, tx_outs)
+    total = 550 * num_auctions
 
-    pubkeyhash = rutils.hash160(bytes.fromhex(control_addr_keypair[1]))
-    prevout_script = b'\x19\x76\xa9\x14' + pubkeyhash + b'\x88\xac'
+    # NB: the output value does not affect the size of the tx
+    unfunded = simple.unsigned_witness_tx(
+        tx_ins, [net.output(total, change_addr, network)])
+    out_val = total - fees.fee_for(unfunded, feerate)
+    if out_val < us.DUST_LIMIT:
+        raise ValueError('Fee exceeds the value of the split outputs.')
+
+    tx_outs = [net.output(out_val, change_addr, network)]
+    unsplit_tx = simple.unsigned_witness_tx(tx_ins, tx_outs)
 
+    # NB: hash the prevouts, sequences and outputs once for all inputs
+    ctx = sighash.SighashContext(unsplit_tx)
     tx_witnesses = []
     for i in range(num_auctions):
-        sighash_bytes = unsplit_tx.sighash_all(
+        keypair = hd.resolve(control_addr_keypair, i)
+        pubkeyhash = rutils.hash160(bytes.fromhex(keypair[1]))
+        prevout_script = b'\x19\x76\xa9\x14' + pubkeyhash + b'\x88\xac'
+
+        sighash_bytes = ctx.sighash_all(
             index=i,
             script=prevout_script,
             prevout_value=rutils.i2le_padded(550, 8),
             anyone_can_pay=False)
 
-        sig = utils.sign_hash(sighash_bytes, control_addr_keypair[0])
+        sig = utils.sign_hash(sighash_bytes, keypair[0])
         sig = '{}{}'.format(sig, '01')
 
         # Build the witness
         wit = tx.make_witness(
             [bytes.fromhex(sig),
-             bytes.fromhex(control_addr_keypair[1])])
+             bytes.fromhex(keypair[1])])
         tx_witnesses.append(wit)
 
     return cast(tx.Tx, unsplit_tx.copy(tx_witnesses=tx_witnesses))
@@ -221,28 +391,40 @@ def make_btc_shutdown_txns(
         add_funds_idx: int,
         add_funds_value: int,
         control_addr: str,
-        control_addr_keypair: Tuple[str, str],
+        control_addr_keypair: hd.KeyRef,
         change_addr: str,
         eth_addr: str,
-        fee: int = 7700) -> List[str]:
+        fee: Optional[int] = None,
+        feerate: int = fees.DEFAULT_FEERATE,
+        network: net.NetworkLike = None,
+        auction_keys: Optional[hd.KeyRef] = None) -> List[str]:
     '''
     Shuts down an auction by winning them with the owner keypair
     Args:
         tx_id: the split tx for the auction set
-        idxs: the unpurchased indexes
+        idxs: the unpurchased indexes. see AuctionLedger.open_indexes
         add_funds_tx_id: a prevout tx id to fund these transactions
         add_funds_idx: the prevout index
         add_funds_value: the prevout value
         control_addr: the input prevout's controlling address
-        control_addr_keypair: the priv/pub keypair as a tuple of hex
+        control_addr_keypair: the priv/pub keypair as a tuple of hex, or an
+            hd.KeyPath to it. a path template is filled with add_funds_idx
         change_addr: where to send leftover funds
         eth_addr: where to deliver auction proceeds
-        fee: the tx fee to pay
+        fee: the fee to pay per tx. computed from feerate if None
+        feerate: the fee rate in sat/vbyte
+        network: the bitcoin network name. riemann's current network if None
+        auction_keys: the keys of the auctioned outputs, if not the control
+            keypair. a template must be scoped with hd.for_batch to the
+            outpoint the split tx spent. see make_several_auctions
     '''
     prev = (add_funds_tx_id, add_funds_idx)
     val = add_funds_value
     shutdown_txns = []
 
+    if auction_keys is None:
+        auction_keys = control_addr_keypair
+    control_addr_keypair = hd.resolve(control_addr_keypair, add_funds_idx)
     pubkeyhash = rutils.hash160(bytes.fromhex(control_addr_keypair[1]))
     prevout_script = b'\x19\x76\xa9\x14' + pubkeyhash + b'\x88\xac'
 
@@ -252,32 +434,41 @@ def make_btc_shutdown_txns(
             simple.unsigned_input(simple.outpoint(*prev))
         ]
 
-        out_val = val + 550 - fee
         addr = control_addr if i < len(idxs) - 1 else change_addr
-        tx_outs = [
-            simple.output(out_val, addr),
-            tx.make_op_return_output(bytes.fromhex(eth_addr[2:]))
-        ]
+        op_return = tx.make_op_return_output(bytes.fromhex(eth_addr[2:]))
+
+        tx_fee = fee
+        if tx_fee is None:
+            # NB: the output value does not affect the size of the tx
+            unfunded = simple.unsigned_witness_tx(
+                tx_ins, [net.output(val + 550, addr, network), op_return])
+            tx_fee = fees.fee_for(unfunded, feerate)
+
+        out_val = val + 550 - tx_fee
+        tx_outs = [net.output(out_val, addr, network), op_return]
 
         shutdown_tx = simple.unsigned_witness_tx(tx_ins, tx_outs)
 
         tx_witnesses = []
+        ctx = sighash.SighashContext(shutdown_tx)
 
-        sighash_bytes = shutdown_tx.sighash_all(
+        auction_keypair = hd.resolve(auction_keys, idxs[i])
+        auction_pkh = rutils.hash160(bytes.fromhex(auction_keypair[1]))
+        sighash_bytes = ctx.sighash_all(
             index=0,
-            script=prevout_script,
+            script=b'\x19\x76\xa9\x14' + auction_pkh + b'\x88\xac',
             prevout_value=rutils.i2le_padded(550, 8),
             anyone_can_pay=False)
-        sig = utils.sign_hash(sighash_bytes, control_addr_keypair[0])
+        sig = utils.sign_hash(sighash_bytes, auction_keypair[0])
         sig = '{}{}'.format(sig, '01')
 
         # Build the witness
         wit = tx.make_witness(
             [bytes.fromhex(sig),
-             bytes.fromhex(control_addr_keypair[1])])
+             bytes.fromhex(auction_keypair[1])])
         tx_witnesses.append(wit)
 
-        sighash_bytes_2 = shutdown_tx.sighash_all(
+        sighash_bytes_2 = ctx.sighash_all(
             index=1,
             script=prevout_script,
             prevout_value=rutils.i2le_padded(val, 8),
@@ -302,19 +493,24 @@ def make_and_broadcast_btc_shutdown(
         auction_tx_id: str,
         idxs: List[int],
         control_addr: str,
-        control_addr_keypair: Tuple[str, str],
+        control_addr_keypair: hd.KeyRef,
         add_funds_tx_id: str,
         add_funds_idx: int,
         add_funds_value: int,
         change_addr: str,
         eth_addr: str,
-        fee: int = 7700) -> List[str]:
+        fee: Optional[int] = None,
+        feerate: int = fees.DEFAULT_FEERATE,
+        network: net.NetworkLike = None,
+        ledger: Optional[ledger_db.AuctionLedger] = None,
+        auction_keys: Optional[hd.KeyRef] = None) -> List[
+            bc.BroadcastStatus]:
 
     '''
     Does make_btc_shutdown_txns and then broadcasts
     Args:
         auction_tx_id: the split tx for the auction set
-        idxs: the unpurchased indexes
+        idxs: the unpurchased indexes. see AuctionLedger.open_indexes
         add_funds_tx_id: a prevout tx id to fund these transactions
         add_funds_idx: the prevout index
         add_funds_value: the prevout value
@@ -322,7 +518,16 @@ def make_and_broadcast_btc_shutdown(
         control_addr_keypair: the priv/pub keypair as a tuple of hex
         change_addr: where to send leftover funds
         eth_addr: where to deliver auction proceeds
-        fee: the tx fee to pay
+        fee: the fee to pay per tx. computed from feerate if None
+        feerate: the fee rate in sat/vbyte
+        network: the bitcoin network name. riemann's current network if None
+        ledger: if given, marks the auctions whose shutdown tx was accepted
+                as closed
+        auction_keys: the keys of the auctioned outputs, if not the control
+            keypair. a template must be scoped with hd.for_batch to the
+            outpoint the split tx spent. see make_several_auctions
+    Returns:
+        a broadcast status for each shutdown tx, in chain order
     '''
 
     shutdown_txns = make_btc_shutdown_txns(
@@ -335,14 +540,19 @@ def make_and_broadcast_btc_shutdown(
         add_funds_value=add_funds_value,
         change_addr=change_addr,
         eth_addr=eth_addr,
-        fee=fee)
-
-    async def do() -> List[str]:
-        ret = [await merkle.broadcast(t) for t in shutdown_txns]
-        return ret
-
-    task = asyncio.ensure_future(do())
-    return asyncio.get_event_loop().run_until_complete(task)
+        fee=fee,
+        feerate=feerate,
+        network=network,
+        auction_keys=auction_keys)
+
+    task = asyncio.ensure_future(bc.broadcast_all(shutdown_txns))
+    statuses = asyncio.get_event_loop().run_until_complete(task)
+
+    if ledger is not None:
+        ledger.mark_closed(
+            auction_tx_id,
+            [i for i, s in zip(idxs, statuses) if s.status == bc.ACCEPTED])
+    return statuses
 
 # def make_ethereum_settlement_transactions(
 #         bitcoin_txids: List[str],
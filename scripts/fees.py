@@ -0,0 +1,100 @@
+from riemann.tx import Tx
+from typing import List, Optional
+
+# sat/vbyte. Callers should pass a rate suited to the current mempool
+DEFAULT_FEERATE = 20
+
+WITNESS_SCALE_FACTOR = 4
+
+# NB: Outpoint (36), empty script sig (1), sequence (4)
+TX_IN_SIZE = 41
+# NB: Segwit marker and flag
+WITNESS_FLAG_SIZE = 2
+# NB: item count (1), DER sig + sighash byte (1 + 72), pubkey (1 + 33)
+#     72 bytes is the largest low-S signature, so we never underestimate
+P2WPKH_WITNESS_SIZE = 108
+
+
+def _varint_size(n: int) -> int:
+    if n < 0xfd:
+        return 1
+    if n <= 0xffff:
+        return 3
+    return 5 if n <= 0xffffffff else 9
+
+
+def _vsize(base_size: int, witness_size: int) -> int:
+    '''
+    Computes vsize from the non-witness and witness byte counts.
+    Rounds up, as Bitcoin Core does.
+    '''
+    weight = base_size * WITNESS_SCALE_FACTOR + witness_size
+    return -(-weight // WITNESS_SCALE_FACTOR)
+
+
+def vsize(t: Tx) -> int:
+    '''Computes the witness-discounted virtual size of a signed tx
+
+    Args:
+        t (riemann.tx.Tx): the transaction
+    Returns:
+        (int): the vsize in vbytes
+    '''
+    base_size = len(t.no_witness())
+    return _vsize(base_size, len(t.to_bytes()) - base_size)
+
+
+def estimate_vsize(
+        t: Tx,
+        witness_sizes: Optional[List[int]] = None) -> int:
+    '''
+    Estimates the vsize a tx will have once signed. Existing witnesses are
+    ignored.
+
+    Args:
+        t           (riemann.tx.Tx): the (usually unsigned) transaction
+        witness_sizes   (list(int)): the serialized size of each input's
+                                     witness. P2WPKH for all if None
+    Returns:
+        (int): the estimated vsize in vbytes
+    '''
+    if witness_sizes is None:
+        witness_sizes = [P2WPKH_WITNESS_SIZE] * len(t.tx_ins)
+    return _vsize(len(t.no_witness()),
+                  WITNESS_FLAG_SIZE + sum(witness_sizes))
+
+
+def estimate_p2wpkh_vsize(num_inputs: int, output_sizes: List[int]) -> int:
+    '''
+    Estimates the vsize of a tx spending P2WPKH inputs, without building it
+
+    Args:
+        num_inputs         (int): the number of inputs
+        output_sizes (list(int)): the serialized size of each output
+    Returns:
+        (int): the estimated vsize in vbytes
+    '''
+    base_size = (4  # version
+                 + _varint_size(num_inputs)
+                 + TX_IN_SIZE * num_inputs
+                 + _varint_size(len(output_sizes))
+                 + sum(output_sizes)
+                 + 4)  # lock_time
+    return _vsize(base_size,
+                  WITNESS_FLAG_SIZE + P2WPKH_WITNESS_SIZE * num_inputs)
+
+
+def fee_for(
+        t: Tx,
+        feerate: int = DEFAULT_FEERATE,
+        witness_sizes: Optional[List[int]] = None) -> int:
+    '''Computes the fee for a tx once it is signed
+
+    Args:
+        t           (riemann.tx.Tx): the (usually unsigned) transaction
+        feerate               (int): fee rate in sat/vbyte
+        witness_sizes   (list(int)): the size of each input's witness
+    Returns:
+        (int): the fee in satoshi
+    '''
+    return feerate * estimate_vsize(t, witness_sizes)
@@ -0,0 +1,313 @@
+'''
+Estimates gas limits for open and claim calls, without a node.
+
+A transaction's gas is its intrinsic gas, which depends only on its
+calldata, plus the gas its call uses. The intrinsic gas is computed
+exactly. The call's gas is a linear model of the call's arguments: the
+partial tx length for open, and the tx length, proof depth and header
+count for claim.
+
+The model is fitted by least squares, once, against calls made on a dev
+chain, and stored as JSON. Estimates add the worst residual seen while
+fitting and a safety margin. Without a fitted model, estimates fall back
+to the fixed limits we used before.
+
+Calibrate after running some opens and claims on a dev chain:
+    python -m scripts.gas --rpc http://localhost:8545 --contract 0x...
+'''
+import os
+import json
+import math
+import argparse
+
+import scripts.utils as utils
+
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+GAS_MODEL_PATH = os.path.join(utils.PATH, 'gas_model.json')
+MODEL_VERSION = 1
+
+TX_BASE_GAS = 21000
+CALLDATA_ZERO_BYTE_GAS = 4
+CALLDATA_NONZERO_BYTE_GAS = 16  # NB: since EIP-2028. 68 before Istanbul
+
+SAFETY_MARGIN = 0.1
+
+# The limits used when no model has been fitted
+DEFAULT_GAS = {
+    'open': 500000,
+    'claim': 1000000
+}
+
+# The methods, in interface_wrapper's argument order
+SIGNATURES = {
+    'open': 'open(bytes,uint256,uint256,address,uint256)',
+    'claim': 'claim(bytes,bytes,uint256,bytes)'
+}
+
+HEADER_SIZE = 80
+HASH_SIZE = 32
+
+
+def calldata_gas(data: bytes) -> int:
+    '''Computes the gas charged for calldata'''
+    zeros = data.count(0)
+    return (zeros * CALLDATA_ZERO_BYTE_GAS
+            + (len(data) - zeros) * CALLDATA_NONZERO_BYTE_GAS)
+
+
+def intrinsic_gas(data: bytes) -> int:
+    '''Computes the gas a tx costs before its call runs'''
+    return TX_BASE_GAS + calldata_gas(data)
+
+
+def bytes_arg(data: bytes, slot: int) -> bytes:
+    '''Reads the dynamic bytes argument whose offset is in a head slot'''
+    head = 4 + slot * 32
+    offset = 4 + int.from_bytes(data[head:head + 32], 'big')
+    length = int.from_bytes(data[offset:offset + 32], 'big')
+    return data[offset + 32:offset + 32 + length]
+
+
+def features(method: str, data: bytes) -> List[float]:
+    '''
+    Extracts the model's inputs from a call's calldata
+
+    Args:
+        method  (str): 'open' or 'claim'
+        data  (bytes): the calldata, e.g. from create_open_data
+    Returns:
+        (list(float)): the features
+    '''
+    if method == 'open':
+        return [float(len(bytes_arg(data, 0)))]
+    if method == 'claim':
+        proof = bytes_arg(data, 1)
+        headers = bytes_arg(data, 3)
+        return [float(len(bytes_arg(data, 0))),
+                float(len(proof) // HASH_SIZE),
+                float(len(headers) // HEADER_SIZE)]
+    raise ValueError('Unknown method: {}'.format(method))
+
+
+class LinearModel(NamedTuple):
+    '''The call gas of one method, as a linear function of its features'''
+    intercept: float
+    coefficients: Tuple[float, ...]
+    max_residual: float
+    samples: int
+
+    def predict(self, xs: Sequence[float]) -> float:
+        return self.intercept + sum(
+            c * x for c, x in zip(self.coefficients, xs))
+
+
+def _solve(a: List[List[float]], b: List[float]) -> List[float]:
+    '''
+    Solves a small linear system by Gaussian elimination. Unknowns with
+    no support in the data, e.g. a feature that never varied, are 0
+    '''
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    scale = max((abs(v) for row in a for v in row), default=1.0) or 1.0
+    pivots: List[Optional[int]] = [None] * n
+    row = 0
+    for col in range(n):
+        best = max(range(row, n), key=lambda r: abs(m[r][col]), default=None)
+        if best is None or abs(m[best][col]) <= 1e-9 * scale:
+            continue
+        m[row], m[best] = m[best], m[row]
+        for r in range(n):
+            if r != row and m[r][col] != 0:
+                f = m[r][col] / m[row][col]
+                m[r] = [v - f * p for v, p in zip(m[r], m[row])]
+        pivots[col] = row
+        row += 1
+    return [0.0 if p is None else m[p][n] / m[p][col]
+            for col, p in enumerate(pivots)]
+
+
+def fit(samples: Sequence[Tuple[Sequence[float], float]]) -> LinearModel:
+    '''
+    Fits a model by least squares
+
+    Args:
+        samples (list(tuple)): each call's features and its call gas
+    Returns:
+        (LinearModel): the fitted model
+    '''
+    if not samples:
+        raise ValueError('No samples to fit')
+    rows = [[1.0] + list(xs) for xs, _ in samples]
+    ys = [y for _, y in samples]
+    n = len(rows[0])
+    # NB: the normal equations. small enough to solve directly
+    xtx = [[sum(r[i] * r[j] for r in rows) for j in range(n)]
+           for i in range(n)]
+    xty = [sum(r[i] * y for r, y in zip(rows, ys)) for i in range(n)]
+    beta = _solve(xtx, xty)
+    model = LinearModel(beta[0], tuple(beta[1:]), 0.0, len(samples))
+    max_residual = max(0.0, max(y - model.predict(xs) for xs, y in samples))
+    return model._replace(max_residual=max_residual)
+
+
+class GasModel:
+    '''
+    Fitted models by method, stored as JSON
+
+    Args:
+        models (dict(str, LinearModel)): the model for each method
+    '''
+
+    def __init__(self, models: Optional[Dict[str, LinearModel]] = None
+                 ) -> None:
+        self.models = models or {}
+
+    @classmethod
+    def load(cls, path: str = GAS_MODEL_PATH) -> 'GasModel':
+        '''Loads a model file. Missing files give an unfitted model'''
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as f:
+            j = json.load(f)
+        if j.get('version') != MODEL_VERSION:
+            raise ValueError('Unknown gas model version: {}'.format(
+                j.get('version')))
+        return cls({
+            method: LinearModel(
+                m['intercept'], tuple(m['coefficients']),
+                m['max_residual'], m['samples'])
+            for method, m in j['models'].items()})
+
+    def save(self, path: str = GAS_MODEL_PATH) -> None:
+        j = {
+            'version': MODEL_VERSION,
+            'models': {method: {
+                'intercept': m.intercept,
+                'coefficients': list(m.coefficients),
+                'max_residual': m.max_residual,
+                'samples': m.samples}
+                for method, m in self.models.items()}}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        utils.write_to_file(json.dumps(j, indent=2).encode('utf-8'), path)
+
+    def estimate(
+            self,
+            method: str,
+            data: bytes,
+            margin: float = SAFETY_MARGIN) -> int:
+        '''
+        Estimates a gas limit for a call
+
+        Args:
+            method  (str): 'open' or 'claim'
+            data  (bytes): the calldata
+            margin (float): the fraction to add on top of the estimate
+        Returns:
+            (int): the gas limit
+        '''
+        model = self.models.get(method)
+        if model is None:
+            return DEFAULT_GAS[method]
+        call_gas = max(0.0, model.predict(features(method, data)))
+        return math.ceil(
+            (intrinsic_gas(data) + call_gas + model.max_residual)
+            * (1 + margin))
+
+
+_MODEL: Optional[GasModel] = None
+
+
+def get_model() -> GasModel:
+    '''Gets the stored model, loading it on first use'''
+    global _MODEL
+    if _MODEL is None:
+        _MODEL = GasModel.load()
+    return _MODEL
+
+
+def estimate(method: str, data: bytes) -> int:
+    '''Estimates a gas limit for a call with the stored model'''
+    return get_model().estimate(method, data)
+
+
+def selectors() -> Dict[bytes, str]:
+    '''Maps each method's 4-byte selector to its name'''
+    return {utils.keccak256(sig.encode('utf-8'))[:4]: method
+            for method, sig in SIGNATURES.items()}
+
+
+def samples_from_chain(
+        rpc: Any,
+        contract: str,
+        from_block: int,
+        to_block: int) -> Dict[str, List[Tuple[List[float], float]]]:
+    '''
+    Collects the successful open and claim calls to a contract
+
+    Args:
+        rpc   (indexer.JsonRpc): the dev chain
+        contract          (str): the contract address
+        from_block        (int): the first block to read
+        to_block          (int): the last block to read
+    Returns:
+        (dict): each method's samples, as features and call gas
+    '''
+    by_selector = selectors()
+    samples: Dict[str, List[Tuple[List[float], float]]] = {
+        method: [] for method in SIGNATURES}
+    for number in range(from_block, to_block + 1):
+        block = rpc.call('eth_getBlockByNumber', [hex(number), True])
+        for t in (block or {}).get('transactions', []):
+            if (t.get('to') or '').lower() != contract.lower():
+                continue
+            data = bytes.fromhex(t['input'][2:])
+            method = by_selector.get(data[:4])
+            if method is None:
+                continue
+            receipt = rpc.call('eth_getTransactionReceipt', [t['hash']])
+            if int(receipt.get('status', '0x1'), 16) != 1:
+                continue
+            call_gas = int(receipt['gasUsed'], 16) - intrinsic_gas(data)
+            samples[method].append((features(method, data), call_gas))
+    return samples
+
+
+def main() -> None:
+    # NB: imported here, so estimating does not need the indexer
+    import scripts.indexer as indexer
+
+    parser = argparse.ArgumentParser(
+        description='Fits the gas model to calls made on a dev chain')
+    parser.add_argument('--rpc', default='http://localhost:8545')
+    parser.add_argument('--contract', required=True)
+    parser.add_argument('--from-block', type=int, default=0)
+    parser.add_argument('--to-block', type=int)
+    parser.add_argument('--out', default=GAS_MODEL_PATH)
+    args = parser.parse_args()
+
+    rpc = indexer.JsonRpc(args.rpc)
+    to_block = args.to_block
+    if to_block is None:
+        to_block = int(rpc.call('eth_blockNumber', []), 16)
+    samples = samples_from_chain(
+        rpc, args.contract, args.from_block, to_block)
+
+    model = GasModel()
+    for method, method_samples in samples.items():
+        if not method_samples:
+            print('{}: no calls found, keeping the default limit'.format(
+                method))
+            continue
+        m = fit(method_samples)
+        model.models[method] = m
+        print('{}: {} calls, intercept {:.0f}, coefficients {}, '
+              'max residual {:.0f}'.format(
+                  method, m.samples, m.intercept,
+                  ['{:.2f}'.format(c) for c in m.coefficients],
+                  m.max_residual))
+    model.save(args.out)
+
+
+if __name__ == '__main__':
+    main()
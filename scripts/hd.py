@@ -0,0 +1,209 @@
+import hmac
+import hashlib
+
+import scripts.utils as utils
+import scripts.network as net
+
+from ecdsa import SECP256k1
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+HARDENED = 0x80000000
+CURVE_ORDER = SECP256k1.order
+BIP32_SEED_KEY = b'Bitcoin seed'
+
+KeyPair = Tuple[str, str]  # privkey as hex, pubkey as hex
+Path = Tuple[int, ...]
+
+
+class Node(NamedTuple):
+    privkey: bytes
+    chain_code: bytes
+    pubkey: bytes
+
+
+def parse_path(path: str) -> Path:
+    '''Parses a path like "m/84'/0'/0'/0/7" to child indexes
+
+    Args:
+        path (str): the derivation path. h and ' both mark hardened steps
+    Returns:
+        (tuple(int)): the child index at each step
+    '''
+    parts = path.split('/')
+    if parts[0] != 'm':
+        raise ValueError('Path must start with m: {}'.format(path))
+    indexes = []
+    for part in parts[1:]:
+        hardened = part[-1:] in ("'", 'h')
+        i = int(part[:-1] if hardened else part)
+        if not 0 <= i < HARDENED:
+            raise ValueError('Bad path step: {}'.format(part))
+        indexes.append(i + HARDENED if hardened else i)
+    return tuple(indexes)
+
+
+def _make_node(privkey: bytes, chain_code: bytes) -> Node:
+    return Node(privkey, chain_code,
+                utils.to_pubkey(utils.coerce_key(privkey)))
+
+
+def _ckd_priv(parent: Node, i: int) -> Node:
+    '''BIP32 private child key derivation'''
+    if i >= HARDENED:
+        data = b'\x00' + parent.privkey + i.to_bytes(4, 'big')
+    else:
+        data = parent.pubkey + i.to_bytes(4, 'big')
+    digest = hmac.new(parent.chain_code, data, hashlib.sha512).digest()
+    tweak = int.from_bytes(digest[:32], 'big')
+    k = (tweak + int.from_bytes(parent.privkey, 'big')) % CURVE_ORDER
+    if tweak >= CURVE_ORDER or k == 0:
+        # NB: probability below 2^-127. BIP32 says to skip to the next index
+        raise ValueError('Invalid child at index {}'.format(i))
+    return _make_node(k.to_bytes(32, 'big'), digest[32:])
+
+
+class Keychain:
+    '''
+    A BIP32 private key tree. Interior nodes are cached, so deriving many
+    siblings costs one HMAC and one pubkey each.
+
+    Args:
+        privkey     (bytes): the 32-byte master private key
+        chain_code  (bytes): the 32-byte master chain code
+    '''
+
+    def __init__(self, privkey: bytes, chain_code: bytes) -> None:
+        self._nodes: Dict[Path, Node] = {(): _make_node(privkey, chain_code)}
+
+    @classmethod
+    def from_seed(cls, seed: bytes) -> 'Keychain':
+        '''Makes the master node of a BIP32 seed'''
+        digest = hmac.new(BIP32_SEED_KEY, seed, hashlib.sha512).digest()
+        return cls(digest[:32], digest[32:])
+
+    def _node(self, path: Path) -> Node:
+        '''Derives a node, and caches it and its ancestors'''
+        node = self._nodes.get(path)
+        if node is None:
+            node = _ckd_priv(self._node(path[:-1]), path[-1])
+            self._nodes[path] = node
+        return node
+
+    @property
+    def master_pubkey(self) -> bytes:
+        return self._nodes[()].pubkey
+
+    def derive(self, path: str) -> Node:
+        '''
+        Derives the node at a path. Caches its ancestors but not the node
+        itself, so deriving a million leaves keeps one parent in memory.
+        '''
+        steps = parse_path(path)
+        if not steps:
+            return self._nodes[()]
+        return _ckd_priv(self._node(steps[:-1]), steps[-1])
+
+    def keypair(self, path: str) -> KeyPair:
+        '''The keypair at a path, as the builders expect it'''
+        node = self.derive(path)
+        return node.privkey.hex(), node.pubkey.hex()
+
+    def address(self, path: str, network: net.NetworkLike = None) -> str:
+        '''The P2WPKH address of the key at a path'''
+        return net.make_p2wpkh_address(self.derive(path).pubkey, network)
+
+
+def batch_steps(tx_id: str, index: int) -> Path:
+    '''
+    Two non-hardened path steps derived from the outpoint a split tx
+    spends. Known before the split tx is made, unlike its txid
+    '''
+    digest = hashlib.sha256(
+        bytes.fromhex(tx_id)[::-1] + index.to_bytes(4, 'little')).digest()
+    return (int.from_bytes(digest[:4], 'big') % HARDENED,
+            int.from_bytes(digest[4:8], 'big') % HARDENED)
+
+
+class KeyPath(NamedTuple):
+    '''
+    A key in a keychain. The path may hold one "{}", which is filled with
+    the output index of the prevout being spent, giving each auction its
+    own key. e.g. "m/84'/0'/0'/0/{}"
+
+    Output indexes repeat in every split tx, so a template is scoped to a
+    batch before use. The batch's steps go before the output index, e.g.
+    "m/84'/0'/0'/0/<batch>/<batch>/{}"
+    '''
+    keychain: Keychain
+    path: str
+    batch: Path = ()
+
+    @property
+    def is_template(self) -> bool:
+        return '{}' in self.path
+
+    @property
+    def scoped_path(self) -> str:
+        '''The path with its batch steps, still holding the "{}"'''
+        steps = ''.join('{}/'.format(s) for s in self.batch)
+        return self.path.replace('{}', steps + '{}')
+
+    def for_batch(self, tx_id: str, index: int) -> 'KeyPath':
+        '''
+        Scopes a template to the outpoint a split tx spends. Paths that
+        are not templates, or are already scoped, are returned unchanged
+        '''
+        if not self.is_template or self.batch:
+            return self
+        return self._replace(batch=batch_steps(tx_id, index))
+
+
+KeyRef = Union[KeyPair, KeyPath]
+
+
+def for_batch(key: KeyRef, tx_id: str, index: int) -> KeyRef:
+    '''Scopes a key path template to a batch. Keypairs are unchanged'''
+    if isinstance(key, KeyPath):
+        return key.for_batch(tx_id, index)
+    return key
+
+
+def resolve(key: KeyRef, index: Optional[int] = None) -> KeyPair:
+    '''
+    Turns a keypair or a key path into a keypair
+
+    Args:
+        key (tuple(str, str) or KeyPath): a keypair, or a path to one
+        index                      (int): the output index to fill a path
+                                          template with
+    Returns:
+        (tuple(str, str)): privkey as hex, pubkey as hex
+    '''
+    if not isinstance(key, KeyPath):
+        return key
+    if key.is_template:
+        if index is None:
+            raise ValueError(
+                'Path template {} needs an output index'.format(key.path))
+        return key.keychain.keypair(key.scoped_path.format(index))
+    return key.keychain.keypair(key.path)
+
+
+def key_id(key: KeyRef) -> str:
+    '''
+    Identifies a keypair or key path without revealing the private key.
+    Suitable for cache keys.
+    '''
+    if isinstance(key, KeyPath):
+        return '{}:{}'.format(
+            key.keychain.master_pubkey.hex(), key.scoped_path)
+    return key[1]
+
+
+def address(
+        key: KeyRef,
+        index: Optional[int] = None,
+        network: net.NetworkLike = None) -> str:
+    '''The P2WPKH address of a keypair or key path'''
+    pub = bytes.fromhex(resolve(key, index)[1])
+    return net.make_p2wpkh_address(pub, network)
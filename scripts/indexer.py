@@ -0,0 +1,545 @@
+'''
+Indexes swap contract listings from Ethereum logs into a local table.
+
+Pulls ListingActive and ListingClosed logs in block-range batches,
+decodes them, and keeps one row per listing with its current state.
+Syncs are incremental. Before each sync, the last indexed block hash is
+checked against the chain, and a reorg rolls back to the fork point.
+
+Sync, then find a seller's open listings:
+    python -m scripts.indexer --rpc http://localhost:8545 \\
+        --contract 0x... --from-block 9000000 --seller 0x...
+
+Work offline against recorded logs with --recorded chain.json, a file
+holding {"blocks": {"<number>": "<hash>"}, "logs": [<eth_getLogs logs>]}.
+'''
+import os
+import json
+import sqlite3
+import argparse
+import urllib.request
+
+import scripts.utils as utils
+import scripts.interface_wrapper as iw
+
+from typing import (Any, Dict, Iterable, List, NamedTuple, Optional,
+                    Sequence, Tuple)
+
+INDEX_PATH = os.path.join(utils.PATH, 'indexer.sqlite')
+DEFAULT_BATCH_SIZE = 2000
+MAX_REORG_DEPTH = 128
+
+# Listing states
+ACTIVE = 'active'
+CLOSED = 'closed'
+
+# The events of the StatelessSwap and CallbackSwap interfaces, in the
+# same ABI JSON format that interface_wrapper loads. Only used when there
+# is no contract build. see default_abi
+SWAP_EVENTS_ABI: List[Dict[str, Any]] = [
+    {'type': 'event', 'name': 'ListingActive', 'anonymous': False,
+     'inputs': [
+         {'name': '_listingID', 'type': 'bytes32', 'indexed': True},
+         {'name': '_seller', 'type': 'address', 'indexed': True},
+         {'name': '_asset', 'type': 'address', 'indexed': True},
+         {'name': '_value', 'type': 'uint256', 'indexed': False},
+         {'name': '_partialTx', 'type': 'bytes', 'indexed': False},
+         {'name': '_reqDiff', 'type': 'uint256', 'indexed': False}]},
+    {'type': 'event', 'name': 'ListingActive', 'anonymous': False,
+     'inputs': [
+         {'name': '_listingID', 'type': 'bytes32', 'indexed': True},
+         {'name': '_seller', 'type': 'address', 'indexed': True},
+         {'name': '_asset', 'type': 'address', 'indexed': True},
+         {'name': '_value', 'type': 'uint256', 'indexed': False},
+         {'name': '_partialTx', 'type': 'bytes', 'indexed': False}]},
+    {'type': 'event', 'name': 'ListingClosed', 'anonymous': False,
+     'inputs': [
+         {'name': '_listingID', 'type': 'bytes32', 'indexed': True},
+         {'name': '_seller', 'type': 'address', 'indexed': False},
+         {'name': '_bidder', 'type': 'address', 'indexed': True},
+         {'name': '_asset', 'type': 'address', 'indexed': True},
+         {'name': '_value', 'type': 'uint256', 'indexed': False}]},
+]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    contract        TEXT NOT NULL,
+    listing_id      TEXT NOT NULL,
+    seller          TEXT NOT NULL,
+    asset           TEXT NOT NULL,
+    value           TEXT NOT NULL,
+    partial_tx      BLOB,
+    req_diff        TEXT,
+    status          TEXT NOT NULL,
+    bidder          TEXT,
+    opened_block    INTEGER NOT NULL,
+    opened_tx       TEXT NOT NULL,
+    closed_block    INTEGER,
+    closed_tx       TEXT,
+    PRIMARY KEY (contract, listing_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS listings_by_seller
+    ON listings (seller, status);
+CREATE INDEX IF NOT EXISTS listings_by_asset
+    ON listings (asset, status);
+CREATE INDEX IF NOT EXISTS listings_by_bidder
+    ON listings (bidder);
+
+CREATE TABLE IF NOT EXISTS blocks (
+    number          INTEGER PRIMARY KEY,
+    hash            TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sync (
+    contract        TEXT PRIMARY KEY,
+    last_block      INTEGER NOT NULL
+);
+'''
+
+
+class RPCError(Exception):
+    pass
+
+
+class JsonRpc:
+    '''
+    A minimal Ethereum JSON-RPC client over HTTP
+
+    Args:
+        url      (str): the node's endpoint
+        timeout  (int): seconds to wait for each response
+    '''
+
+    def __init__(self, url: str, timeout: int = 30) -> None:
+        self.url = url
+        self.timeout = timeout
+        self._id = 0
+
+    def call(self, method: str, params: Sequence[Any]) -> Any:
+        self._id += 1
+        body = json.dumps({'jsonrpc': '2.0', 'id': self._id,
+                           'method': method, 'params': list(params)})
+        request = urllib.request.Request(
+            self.url, data=body.encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as res:
+            response = json.loads(res.read().decode('utf-8'))
+        if 'error' in response:
+            raise RPCError(response['error'].get('message', response['error']))
+        return response['result']
+
+
+class RecordedChain:
+    '''
+    Stands in for a node, serving recorded blocks and logs. For working
+    offline, and for replaying a recorded reorg
+
+    Args:
+        blocks (dict(int, str)): block numbers mapped to block hashes
+        logs       (list(dict)): raw logs, as eth_getLogs returns them
+    '''
+
+    def __init__(self, blocks: Dict[int, str], logs: List[Dict]) -> None:
+        self.blocks = blocks
+        self.logs = logs
+
+    @classmethod
+    def from_file(cls, filename: str) -> 'RecordedChain':
+        with open(filename, 'r') as f:
+            recorded = json.load(f)
+        return cls({int(k): v for k, v in recorded['blocks'].items()},
+                   recorded['logs'])
+
+    def call(self, method: str, params: Sequence[Any]) -> Any:
+        if method == 'eth_blockNumber':
+            return hex(max(self.blocks))
+        if method == 'eth_getBlockByNumber':
+            block_hash = self.blocks.get(int(params[0], 16))
+            return None if block_hash is None else {'hash': block_hash}
+        if method == 'eth_getLogs':
+            f = params[0]
+            start, end = int(f['fromBlock'], 16), int(f['toBlock'], 16)
+            addresses = f['address']
+            if isinstance(addresses, str):
+                addresses = [addresses]
+            addresses = {a.lower() for a in addresses}
+            topics = {t.lower() for t in f.get('topics', [[]])[0]}
+            return [log for log in self.logs
+                    if start <= int(log['blockNumber'], 16) <= end
+                    and log['address'].lower() in addresses
+                    and (not topics or log['topics'][0].lower() in topics)]
+        raise RPCError('Unsupported method: {}'.format(method))
+
+
+# Event decoding
+
+class Event(NamedTuple):
+    name: str
+    signature: str
+    topic: str
+    inputs: List[Dict[str, Any]]
+
+
+def _canonical_type(t: str) -> str:
+    if t in ('uint', 'int'):
+        return t + '256'
+    return t
+
+
+def events_from_abi(abi: Iterable[Dict[str, Any]]) -> Dict[str, Event]:
+    '''Maps each event's topic0 to its description'''
+    events = {}
+    for entry in abi:
+        if entry.get('type') != 'event' or entry.get('anonymous'):
+            continue
+        signature = '{}({})'.format(
+            entry['name'],
+            ','.join(_canonical_type(i['type']) for i in entry['inputs']))
+        topic = '0x' + utils.keccak256(signature.encode('utf-8')).hex()
+        events[topic] = Event(entry['name'], signature, topic,
+                              entry['inputs'])
+    return events
+
+
+def default_abi() -> List[Dict[str, Any]]:
+    '''
+    The events of the contract build that interface_wrapper uses, so the
+    index follows the contracts as compiled. SWAP_EVENTS_ABI if there is
+    no build
+    '''
+    if not os.path.exists(iw.BUILD_FILE):
+        return SWAP_EVENTS_ABI
+    return [e for e in iw.abi() if e.get('type') == 'event']
+
+
+def load_abi(filename: str) -> List[Dict[str, Any]]:
+    '''Loads an ABI from a solc build (as interface_wrapper does) or truffle'''
+    with open(filename, 'r') as f:
+        j = json.load(f)
+    if 'abi' in j:
+        return list(j['abi'])
+    return list(json.loads(j['interface']))
+
+
+def _decode_static(t: str, word: bytes) -> Any:
+    if t == 'address':
+        return '0x' + word[12:].hex()
+    if t == 'bool':
+        return word[-1] == 1
+    if t.startswith('uint'):
+        return int.from_bytes(word, 'big')
+    if t.startswith('int'):
+        return int.from_bytes(word, 'big', signed=True)
+    if t.startswith('bytes'):
+        return word[:int(t[5:])]
+    raise ValueError('Unsupported type: {}'.format(t))
+
+
+def _decode_data(types: List[str], data: bytes) -> List[Any]:
+    values = []
+    for i, t in enumerate(types):
+        word = data[i * 32:(i + 1) * 32]
+        if t in ('bytes', 'string'):
+            offset = int.from_bytes(word, 'big')
+            length = int.from_bytes(data[offset:offset + 32], 'big')
+            raw = data[offset + 32:offset + 32 + length]
+            values.append(raw.decode('utf-8') if t == 'string' else raw)
+        else:
+            values.append(_decode_static(t, word))
+    return values
+
+
+def decode_log(event: Event, log: Dict[str, Any]) -> Dict[str, Any]:
+    '''Decodes a raw log's topics and data into named arguments'''
+    topics = log['topics'][1:]
+    indexed = [i for i in event.inputs if i['indexed']]
+    unindexed = [i for i in event.inputs if not i['indexed']]
+
+    args = {}
+    for i, topic in zip(indexed, topics):
+        t = _canonical_type(i['type'])
+        word = bytes.fromhex(topic[2:])
+        # NB: dynamic indexed args are hashed, so only the hash is known
+        args[i['name']] = word if t in ('bytes', 'string') \
+            else _decode_static(t, word)
+    values = _decode_data(
+        [_canonical_type(i['type']) for i in unindexed],
+        bytes.fromhex(log['data'][2:]))
+    for i, value in zip(unindexed, values):
+        args[i['name']] = value
+    return args
+
+
+class Listing(NamedTuple):
+    contract: str
+    listing_id: str
+    seller: str
+    asset: str
+    value: int
+    partial_tx: Optional[bytes]
+    req_diff: Optional[int]
+    status: str
+    bidder: Optional[str]
+    opened_block: int
+    opened_tx: str
+    closed_block: Optional[int]
+    closed_tx: Optional[str]
+
+
+_COLUMNS = ', '.join(Listing._fields)
+
+
+def _listing(row: Tuple) -> Listing:
+    values = list(row)
+    values[4] = int(values[4])
+    values[6] = None if values[6] is None else int(values[6])
+    return Listing(*values)
+
+
+class Indexer:
+    '''
+    Keeps a local table of listings in sync with one or more contracts
+
+    Args:
+        rpc   (JsonRpc or RecordedChain): where to read the chain from
+        path                        (str): the database file
+        abi                  (list(dict)): the event ABI. default_abi()
+                                           if None
+        batch_size                  (int): blocks per eth_getLogs call
+        confirmations               (int): blocks to stay behind the tip
+    '''
+
+    def __init__(
+            self,
+            rpc: Any,
+            path: str = INDEX_PATH,
+            abi: Optional[List[Dict[str, Any]]] = None,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            confirmations: int = 0) -> None:
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.rpc = rpc
+        self.events = events_from_abi(abi or default_abi())
+        self.batch_size = batch_size
+        self.confirmations = confirmations
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _block_hash(self, number: int) -> Optional[str]:
+        block = self.rpc.call('eth_getBlockByNumber', [hex(number), False])
+        return None if block is None else block['hash']
+
+    def last_block(self, contract: str) -> Optional[int]:
+        row = self.conn.execute(
+            'SELECT last_block FROM sync WHERE contract = ?',
+            (contract.lower(),)).fetchone()
+        return None if row is None else row[0]
+
+    def check_reorg(self) -> Optional[int]:
+        '''
+        Compares stored block hashes to the chain, newest first. Rolls
+        back anything above the newest match
+
+        Returns:
+            (int): the block rolled back to, or None if there was no reorg
+        '''
+        stored = self.conn.execute(
+            'SELECT number, hash FROM blocks ORDER BY number DESC LIMIT ?',
+            (MAX_REORG_DEPTH,)).fetchall()
+        for i, (number, block_hash) in enumerate(stored):
+            if self._block_hash(number) == block_hash:
+                if i == 0:
+                    return None
+                self.rollback(number)
+                return int(number)
+        if stored:
+            raise RPCError('Reorg deeper than {} stored blocks'.format(
+                MAX_REORG_DEPTH))
+        return None
+
+    def rollback(self, to_block: int) -> None:
+        '''Forgets everything indexed above a block'''
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM listings WHERE opened_block > ?', (to_block,))
+            self.conn.execute(
+                'UPDATE listings SET status = ?, bidder = NULL, '
+                'closed_block = NULL, closed_tx = NULL '
+                'WHERE closed_block > ?', (ACTIVE, to_block))
+            self.conn.execute(
+                'DELETE FROM blocks WHERE number > ?', (to_block,))
+            self.conn.execute(
+                'UPDATE sync SET last_block = ? WHERE last_block > ?',
+                (to_block, to_block))
+
+    def _get_logs(
+            self,
+            contracts: List[str],
+            start: int,
+            end: int) -> List[Dict[str, Any]]:
+        '''Gets logs, splitting the range if the node refuses it'''
+        try:
+            return list(self.rpc.call('eth_getLogs', [{
+                'address': contracts,
+                'fromBlock': hex(start),
+                'toBlock': hex(end),
+                'topics': [list(self.events)]}]))
+        except RPCError:
+            if start == end:
+                raise
+            mid = (start + end) // 2
+            return self._get_logs(contracts, start, mid) \
+                + self._get_logs(contracts, mid + 1, end)
+
+    def _apply(self, log: Dict[str, Any]) -> None:
+        event = self.events[log['topics'][0].lower()]
+        args = decode_log(event, log)
+        contract = log['address'].lower()
+        listing_id = '0x' + args['_listingID'].hex()
+        block = int(log['blockNumber'], 16)
+        tx_hash = log['transactionHash']
+        if event.name == 'ListingActive':
+            req_diff = args.get('_reqDiff')
+            self.conn.execute(
+                'INSERT OR REPLACE INTO listings ({}) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                    _COLUMNS),
+                (contract, listing_id, args['_seller'], args['_asset'],
+                 str(args['_value']), args['_partialTx'],
+                 None if req_diff is None else str(req_diff), ACTIVE,
+                 None, block, tx_hash, None, None))
+        elif event.name == 'ListingClosed':
+            self.conn.execute(
+                'UPDATE listings SET status = ?, bidder = ?, '
+                'closed_block = ?, closed_tx = ? '
+                'WHERE contract = ? AND listing_id = ?',
+                (CLOSED, args['_bidder'], block, tx_hash,
+                 contract, listing_id))
+
+    def sync(
+            self,
+            contracts: List[str],
+            from_block: int = 0,
+            to_block: Optional[int] = None) -> int:
+        '''
+        Indexes new logs of some contracts, after checking for a reorg.
+        Contracts that have synced before resume after their last block
+
+        Args:
+            contracts (list(str)): the contract addresses
+            from_block      (int): the first block for new contracts
+            to_block        (int): the last block. the tip less
+                                   confirmations if None
+        Returns:
+            (int): the number of logs indexed
+        '''
+        contracts = [c.lower() for c in contracts]
+        self.check_reorg()
+        if to_block is None:
+            tip = int(self.rpc.call('eth_blockNumber', []), 16)
+            to_block = tip - self.confirmations
+
+        lasts = [self.last_block(c) for c in contracts]
+        start = min(from_block if last is None else last + 1
+                    for last in lasts)
+        count = 0
+        while start <= to_block:
+            end = min(start + self.batch_size - 1, to_block)
+            logs = self._get_logs(contracts, start, end)
+            logs.sort(key=lambda log: (int(log['blockNumber'], 16),
+                                       int(log['logIndex'], 16)))
+            end_hash = self._block_hash(end)
+            with self.conn:
+                for log in logs:
+                    if log.get('removed'):
+                        continue
+                    self._apply(log)
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO blocks VALUES (?, ?)',
+                        (int(log['blockNumber'], 16), log['blockHash']))
+                if end_hash is not None:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO blocks VALUES (?, ?)',
+                        (end, end_hash))
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO sync VALUES (?, ?)',
+                    ((c, end) for c in contracts))
+            count += len(logs)
+            start = end + 1
+        return count
+
+    def open_listings(
+            self,
+            seller: Optional[str] = None,
+            asset: Optional[str] = None,
+            contract: Optional[str] = None) -> List[Listing]:
+        '''The active listings, optionally of one seller, asset or contract'''
+        clauses = ['status = ?']
+        args: List[Any] = [ACTIVE]
+        for column, value in (('seller', seller), ('asset', asset),
+                              ('contract', contract)):
+            if value is not None:
+                clauses.append('{} = ?'.format(column))
+                args.append(value.lower())
+        cur = self.conn.execute(
+            'SELECT {} FROM listings WHERE {} ORDER BY opened_block'.format(
+                _COLUMNS, ' AND '.join(clauses)), args)
+        return [_listing(row) for row in cur]
+
+    def get(self, contract: str, listing_id: str) -> Optional[Listing]:
+        row = self.conn.execute(
+            'SELECT {} FROM listings WHERE contract = ? AND listing_id = ?'
+            .format(_COLUMNS), (contract.lower(), listing_id.lower())
+        ).fetchone()
+        return None if row is None else _listing(row)
+
+    def find(self, listing_id: str) -> List[Listing]:
+        '''Every indexed listing with an id, in any contract, newest first'''
+        cur = self.conn.execute(
+            'SELECT {} FROM listings WHERE listing_id = ? '
+            'ORDER BY opened_block DESC'.format(_COLUMNS),
+            (listing_id.lower(),))
+        return [_listing(row) for row in cur]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Indexes swap listings from Ethereum logs')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--rpc', help='Ethereum JSON-RPC endpoint')
+    source.add_argument('--recorded', help='recorded chain JSON file')
+    parser.add_argument('--contract', action='append', required=True,
+                        help='a swap contract address. may repeat')
+    parser.add_argument('--from-block', type=int, default=0)
+    parser.add_argument('--confirmations', type=int, default=0)
+    parser.add_argument('--abi', help='a build file to read events from')
+    parser.add_argument('--db', default=INDEX_PATH)
+    parser.add_argument('--seller', help='print this seller\'s open listings')
+    args = parser.parse_args()
+
+    rpc = JsonRpc(args.rpc) if args.rpc \
+        else RecordedChain.from_file(args.recorded)
+    indexer = Indexer(
+        rpc, args.db,
+        abi=load_abi(args.abi) if args.abi else None,
+        confirmations=args.confirmations)
+    count = indexer.sync(args.contract, from_block=args.from_block)
+    print('indexed {} logs'.format(count))
+    if args.seller:
+        for listing in indexer.open_listings(seller=args.seller):
+            print(json.dumps({
+                'contract': listing.contract,
+                'listing_id': listing.listing_id,
+                'asset': listing.asset,
+                'value': listing.value,
+                'partial_tx': (listing.partial_tx or b'').hex()}))
+    indexer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,30 @@
 import json
 
+import scripts.gas as gas
+import scripts.metrics as metrics
+
 from ether import calldata, transactions
 
-from typing import Any
+from typing import Any, cast, Dict, List, Optional
+
+
+BUILD_FILE = 'build/IntegralAuction.json'
 
+# NB: loaded on first use, so that importing needs no contract build
+ABI: Optional[List[Dict[str, Any]]] = None
 
-# Loads the abi from the file
-# For some reason solc generates json stored as a string inside json
-# So we have to call .loads twice
-with open('build/IntegralAuction.json', 'r') as jsonfile:
-    j = json.loads(jsonfile.read())
-    ABI = json.loads(j['interface'])
+
+def abi() -> List[Dict[str, Any]]:
+    '''The contract ABI, loaded from the build on first use'''
+    global ABI
+    if ABI is None:
+        # Loads the abi from the file
+        # For some reason solc generates json stored as a string inside json
+        # So we have to call .loads twice
+        with open(BUILD_FILE, 'r') as jsonfile:
+            j = json.loads(jsonfile.read())
+            ABI = cast(List[Dict[str, Any]], json.loads(j['interface']))
+    return ABI
 
 
 def create_unsigned_tx(
@@ -73,7 +87,10 @@ def create_open_data(
         reqDiff,
         asset,
         value]
-    return calldata.call('open', contract_method_args, ABI)
+    with metrics.span('abi_encode', method='open'):
+        data = calldata.call('open', contract_method_args, abi())
+    metrics.incr('abi_bytes_encoded', len(data), method='open')
+    return cast(bytes, data)
 
 
 def create_claim_data(
@@ -94,7 +111,10 @@ def create_claim_data(
         proof,
         index,
         headers]
-    return calldata.call('claim', contract_method_args, ABI)
+    with metrics.span('abi_encode', method='claim'):
+        data = calldata.call('claim', contract_method_args, abi())
+    metrics.incr('abi_bytes_encoded', len(data), method='claim')
+    return cast(bytes, data)
 
 
 def create_open_tx(
@@ -118,7 +138,7 @@ def create_open_tx(
             nonce            (int): number of transactions already sent by
                                     signing account
             gas_price        (int): gas price
-            start_gas        (int): gas limit
+            start_gas        (int): gas limit. estimated if not given
             network_id       (int): ethereum network id
 
     Returns:
@@ -126,6 +146,7 @@ def create_open_tx(
     '''
     tx_data = create_open_data(
         partial_tx, reservePrice, reqDiff, asset, value)
+    kwargs.setdefault('start_gas', gas.estimate('open', tx_data))
     return create_unsigned_tx(
         tx_data=tx_data,
         value=value,
@@ -142,22 +163,23 @@ def create_claim_tx(
 
     Args:
         tx         (bytes): the fully signed tx
-        proof        (str): the merkle inclusion proof
+        proof      (bytes): the merkle inclusion proof
         index        (int): the index of the tx for merkle verification
-        headers      (str): the header chain containing work
+        headers    (bytes): the header chain containing work
         **kwargs:
             contract_address (str): address of the contract to call
             value            (int): amount of ether (in wei) to include
             nonce            (int): number of transactions already sent by
                                     signing account
             gas_price        (int): gas price
-            start_gas        (int): gas limit
+            start_gas        (int): gas limit. estimated if not given
             network_id       (int): ethereum network id
 
     Returns:
         (ethereum.transactions.Transaction): the unsigned tx
     '''
     tx_data = create_claim_data(tx, proof, index, headers)
+    kwargs.setdefault('start_gas', gas.estimate('claim', tx_data))
     return create_unsigned_tx(
         tx_data=tx_data,
         **kwargs)
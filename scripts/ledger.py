@@ -0,0 +1,272 @@
+import os
+import sqlite3
+
+import scripts.utils as utils
+
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+LEDGER_PATH = os.path.join(utils.PATH, 'ledger.sqlite')
+
+# Auction states
+OPEN = 'open'          # listed, not yet purchased
+FILLED = 'filled'      # a bidder's tx spent the outpoint, not yet claimed
+CLAIMED = 'claimed'    # the claim tx was submitted to Ethereum
+CLOSED = 'closed'      # shut down by the owner
+
+# The states each state may be entered from. Marking an auction that is
+# in any other state leaves it as it is
+PRIOR_STATES = {
+    FILLED: (OPEN,),
+    CLAIMED: (FILLED,),
+    CLOSED: (OPEN,),
+}
+
+
+def _status_guard(status: str) -> str:
+    '''An SQL condition that an auction may move to a status'''
+    return 'status IN ({})'.format(
+        ', '.join("'{}'".format(s) for s in PRIOR_STATES[status]))
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS auctions (
+    split_tx_id     TEXT NOT NULL,
+    output_index    INTEGER NOT NULL,
+    prevout_value   INTEGER NOT NULL,
+    partial_txs     BLOB NOT NULL,
+    expiry          INTEGER NOT NULL,
+    eth_nonce       INTEGER,
+    eth_tx_hash     TEXT,
+    status          TEXT NOT NULL DEFAULT 'open',
+    fill_tx_id      TEXT,
+    claim_tx_hash   TEXT,
+    PRIMARY KEY (split_tx_id, output_index)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS tiers (
+    split_tx_id     TEXT NOT NULL,
+    output_index    INTEGER NOT NULL,
+    tier            INTEGER NOT NULL,
+    value           INTEGER NOT NULL,
+    lock_time       INTEGER NOT NULL,
+    PRIMARY KEY (split_tx_id, output_index, tier)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS auctions_by_status
+    ON auctions (status, split_tx_id);
+CREATE INDEX IF NOT EXISTS auctions_by_expiry
+    ON auctions (status, expiry);
+CREATE INDEX IF NOT EXISTS auctions_by_nonce
+    ON auctions (eth_nonce);
+'''
+
+Tier = Tuple[int, int]  # sale value, block height
+
+
+class AuctionRecord(NamedTuple):
+    split_tx_id: str
+    output_index: int
+    prevout_value: int
+    partial_txs: bytes
+    expiry: int
+    eth_nonce: Optional[int]
+    eth_tx_hash: Optional[str]
+    status: str
+    fill_tx_id: Optional[str]
+    claim_tx_hash: Optional[str]
+
+
+_COLUMNS = ', '.join(AuctionRecord._fields)
+
+
+class AuctionLedger:
+    '''
+    An embedded SQLite record of every auction we have made, and where it
+    is in its life. Builders record auctions as they make them. The
+    shutdown and settlement paths read open auctions and unclaimed fills.
+
+    Args:
+        path (str): the database file. ':memory:' for a throwaway ledger
+    '''
+
+    def __init__(self, path: str = LEDGER_PATH) -> None:
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _records(self, query: str, args: Sequence) -> List[AuctionRecord]:
+        cur = self.conn.execute(
+            'SELECT {} FROM auctions {}'.format(_COLUMNS, query), args)
+        return [AuctionRecord(*row) for row in cur]
+
+    def record_auctions(
+            self,
+            split_tx_id: str,
+            auctions: Iterable[Tuple[int, int, bytes]],
+            tiers: Sequence[Tier]) -> None:
+        '''Records a set of auctions that share a split tx and a format.
+        Auctions already recorded keep their status, e.g. when a batch is
+        rerun from the artifact cache
+
+        Args:
+            split_tx_id                   (str): the split tx's txid
+            auctions (list(tuple(int, int, bytes))): the output index, value
+                                                 and serialized partial txns
+                                                 of each auction
+            tiers       (list(tuple(int, int))): the value and lock_time
+                                                 of each tier
+        '''
+        expiry = max(t[1] for t in tiers)
+        auctions = list(auctions)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO auctions '
+                '(split_tx_id, output_index, prevout_value, partial_txs, '
+                'expiry) VALUES (?, ?, ?, ?, ?)',
+                ((split_tx_id, a[0], a[1], a[2], expiry) for a in auctions))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO tiers VALUES (?, ?, ?, ?, ?)',
+                ((split_tx_id, a[0], i, t[0], t[1])
+                 for a in auctions for i, t in enumerate(tiers)))
+
+    def record_eth_txns(
+            self,
+            split_tx_id: str,
+            txns: Iterable[Tuple[int, int, str]]) -> None:
+        '''Records the Ethereum txns that list a set of auctions
+
+        Args:
+            split_tx_id                   (str): the split tx's txid
+            txns (list(tuple(int, int, str))): the output index, eth nonce
+                                               and eth tx hash of each
+        '''
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE auctions SET eth_nonce = ?, eth_tx_hash = ? '
+                'WHERE split_tx_id = ? AND output_index = ?',
+                ((t[1], t[2], split_tx_id, t[0]) for t in txns))
+
+    def _set_status(
+            self,
+            split_tx_id: str,
+            idxs: Iterable[int],
+            status: str) -> None:
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE auctions SET status = ? '
+                'WHERE split_tx_id = ? AND output_index = ? AND '
+                + _status_guard(status),
+                ((status, split_tx_id, i) for i in idxs))
+
+    def mark_filled(
+            self,
+            split_tx_id: str,
+            output_index: int,
+            fill_tx_id: str) -> bool:
+        '''
+        Records that a bidder's tx spent an open auction's outpoint
+
+        Returns:
+            (bool): False if the auction was not open
+        '''
+        with self.conn:
+            cur = self.conn.execute(
+                'UPDATE auctions SET status = ?, fill_tx_id = ? '
+                'WHERE split_tx_id = ? AND output_index = ? AND '
+                + _status_guard(FILLED),
+                (FILLED, fill_tx_id, split_tx_id, output_index))
+        return cur.rowcount == 1
+
+    def mark_claimed(
+            self,
+            split_tx_id: str,
+            output_index: int,
+            claim_tx_hash: str) -> bool:
+        '''
+        Records that we submitted the Ethereum claim for a fill
+
+        Returns:
+            (bool): False if the auction was not filled
+        '''
+        with self.conn:
+            cur = self.conn.execute(
+                'UPDATE auctions SET status = ?, claim_tx_hash = ? '
+                'WHERE split_tx_id = ? AND output_index = ? AND '
+                + _status_guard(CLAIMED),
+                (CLAIMED, claim_tx_hash, split_tx_id, output_index))
+        return cur.rowcount == 1
+
+    def mark_closed(self, split_tx_id: str, idxs: Iterable[int]) -> None:
+        '''Records that the owner shut down a set of open auctions'''
+        self._set_status(split_tx_id, idxs, CLOSED)
+
+    def get(
+            self,
+            split_tx_id: str,
+            output_index: int) -> Optional[AuctionRecord]:
+        '''Looks up a single auction by its outpoint'''
+        records = self._records(
+            'WHERE split_tx_id = ? AND output_index = ?',
+            (split_tx_id, output_index))
+        return records[0] if records else None
+
+    def open_auctions(self, split_tx_id: str) -> List[AuctionRecord]:
+        '''The open auctions of a split tx, by output index'''
+        return self._records(
+            'WHERE status = ? AND split_tx_id = ? ORDER BY output_index',
+            (OPEN, split_tx_id))
+
+    def open_indexes(self, split_tx_id: str) -> List[int]:
+        '''
+        The output indexes of a split tx that are still open. Suitable as
+        idxs for make_btc_shutdown_txns
+        '''
+        cur = self.conn.execute(
+            'SELECT output_index FROM auctions '
+            'WHERE status = ? AND split_tx_id = ? ORDER BY output_index',
+            (OPEN, split_tx_id))
+        return [row[0] for row in cur]
+
+    def open_outpoints(self) -> List[Tuple[str, int]]:
+        '''The outpoints of every open auction, for watching for fills'''
+        cur = self.conn.execute(
+            'SELECT split_tx_id, output_index FROM auctions '
+            'WHERE status = ?', (OPEN,))
+        return [(row[0], row[1]) for row in cur]
+
+    def open_tiers(self) -> Iterable[Tuple[str, int, int, int]]:
+        '''
+        The split txid, output index, value and lock_time of every tier of
+        every open auction, grouped by auction and ordered by tier
+        '''
+        return self.conn.execute(
+            'SELECT t.split_tx_id, t.output_index, t.value, t.lock_time '
+            'FROM tiers t JOIN auctions a '
+            'ON a.split_tx_id = t.split_tx_id '
+            'AND a.output_index = t.output_index '
+            'WHERE a.status = ? '
+            'ORDER BY t.split_tx_id, t.output_index, t.tier', (OPEN,))
+
+    def expiring(self, height: int) -> List[AuctionRecord]:
+        '''Open auctions whose last tier unlocks at or before a height'''
+        return self._records(
+            'WHERE status = ? AND expiry <= ? ORDER BY expiry',
+            (OPEN, height))
+
+    def unclaimed_fills(self) -> List[AuctionRecord]:
+        '''Filled auctions that we have not yet claimed on Ethereum'''
+        return self._records('WHERE status = ?', (FILLED,))
+
+    def tiers(self, split_tx_id: str, output_index: int) -> List[Tier]:
+        '''The value and lock_time of each tier of an auction'''
+        cur = self.conn.execute(
+            'SELECT value, lock_time FROM tiers '
+            'WHERE split_tx_id = ? AND output_index = ? ORDER BY tier',
+            (split_tx_id, output_index))
+        return [(row[0], row[1]) for row in cur]
@@ -1,32 +1,56 @@
 import sys
 import json
 import asyncio
+import hashlib
 
 # from scripts import interface_wrapper as iw
+import scripts.metrics as metrics
+import scripts.txcache as txcache
+import scripts.ratelimit as ratelimit
 
 from connectrum.svr_info import ServerInfo
 from connectrum.client import StratumClient
 
 from riemann import tx
-from riemann import utils as rutils
 
 # from ether.transactions import UnsignedEthTx
 
-from typing import Any, cast, Tuple, Union
+from typing import Any, cast, Dict, List, NamedTuple, Optional, Tuple, Union
 
-with open('build/ValidateSPV.json', 'r') as jsonfile:
-    j = json.loads(jsonfile.read())
-    ABI = json.loads(j['interface'])
+BUILD_FILE = 'build/ValidateSPV.json'
 
+# NB: loaded on first use, so that importing needs no contract build
+ABI: Optional[List[Dict[str, Any]]] = None
+
+
+def abi() -> List[Dict[str, Any]]:
+    '''The ValidateSPV ABI, loaded from the build on first use'''
+    global ABI
+    if ABI is None:
+        with open(BUILD_FILE, 'r') as jsonfile:
+            j = json.loads(jsonfile.read())
+            ABI = cast(List[Dict[str, Any]], json.loads(j['interface']))
+    return ABI
+
+
+SERVER_HOSTNAME = 'fortress.qtornado.com'
 
 CLIENT: StratumClient
+TX_CACHE: Optional[txcache.TxCache] = None
+
+
+def _get_tx_cache() -> txcache.TxCache:
+    global TX_CACHE
+    if TX_CACHE is None:
+        TX_CACHE = txcache.TxCache()
+    return TX_CACHE
 
 
 async def _get_client() -> StratumClient:
+    global CLIENT
     try:
         return CLIENT
     except NameError:
-        global CLIENT
         CLIENT = await setup_client()
         return CLIENT
 
@@ -39,7 +63,7 @@ async def setup_client() -> StratumClient:
 
     server = ServerInfo({
         "nickname": None,
-        "hostname": "fortress.qtornado.com",
+        "hostname": SERVER_HOSTNAME,
         "ip_addr": None,
         "ports": [
             "s50002",
@@ -69,6 +93,21 @@ async def setup_client() -> StratumClient:
 
     return client
 
+
+async def _rpc(method: str, *params: Any) -> Any:
+    '''
+    makes an electrum RPC, recording its latency per method
+    rate limited per server, and identical in-flight RPCs are sent once
+    '''
+    client = await _get_client()
+    limiter = ratelimit.for_server(SERVER_HOSTNAME)
+
+    async def send(method: str, *params: Any) -> Any:
+        with metrics.span('electrum_rpc', method=method):
+            return await client.RPC(method, *params)
+
+    return await limiter.call(send, method, *params)
+
 # # # # # # # # # # # # # # #
 # Use this script Sparingly #
 # # # # # # # # # # # # # # #
@@ -83,8 +122,7 @@ async def broadcast(t: Union[tx.Tx, str]) -> Any:
     else:
         txhex = cast(tx.Tx, t).hex()
 
-    client = await _get_client()
-    res = await client.RPC('blockchain.transaction.broadcast', txhex)
+    res = await _rpc('blockchain.transaction.broadcast', txhex)
     return res
 
 
@@ -113,60 +151,89 @@ async def get_latest_blockheight() -> int:
     gets the latest blockheight that a server is aware of
     '''
     client = await _get_client()
-    fut, _ = client.subscribe('blockchain.headers.subscribe')
-    block_dict = await fut
+    with metrics.span('electrum_rpc', method='blockchain.headers.subscribe'):
+        fut, _ = client.subscribe('blockchain.headers.subscribe')
+        block_dict = await fut
     print(block_dict)
     return cast(int, block_dict['height'])
 
 
-async def get_block_merkle_root(height: int) -> bytes:
+async def subscribe_headers() -> Tuple[int, 'asyncio.Queue[Any]']:
     '''
-    gets the merkle root of a block
+    subscribes to new block headers
+    returns the current height and a queue that receives each new tip
     '''
     client = await _get_client()
+    with metrics.span('electrum_rpc', method='blockchain.headers.subscribe'):
+        fut, queue = client.subscribe('blockchain.headers.subscribe')
+        block_dict = await fut
+    return cast(int, block_dict['height']), queue
+
 
-    header_dict = await client.RPC('blockchain.block.headers', height, 1)
+async def get_block_merkle_root(height: int) -> bytes:
+    '''
+    gets the merkle root of a block
+    '''
+    header_dict = await _rpc('blockchain.block.headers', height, 1)
     merkle_root = bytes.fromhex(header_dict['hex'])[36:68]
 
     return merkle_root
 
 
-async def get_tx_from_api(tx_id: str) -> Tuple[dict, tx.Tx]:
+async def get_tx_from_api(
+        tx_id: str,
+        use_cache: bool = True) -> Tuple[dict, tx.Tx]:
     '''
     gets a transaction from electrum and returns it as a dict and an object
+    confirmed transactions are cached, and later lookups skip the network.
+    on a cache hit, the dict only holds txid, hex, block_height and
+    confirmations, which is a lower bound: the cache's minimum
     '''
-    client = await _get_client()
-    tx_dict = await client.RPC('blockchain.transaction.get', tx_id, True)
+    if use_cache:
+        hit = _get_tx_cache().get(tx_id)
+        if hit is not None:
+            t, height = hit
+            return {'txid': tx_id, 'hex': t.hex(), 'block_height': height,
+                    'confirmations': txcache.MIN_CONFIRMATIONS}, t
+
+    tx_dict = await _rpc('blockchain.transaction.get', tx_id, True)
     t = tx.Tx.from_hex(tx_dict['hex'])
 
     latest_blockheight = await get_latest_blockheight()
 
     # NB: I'm not sure why this works. I feel like it should be -1
-    tx_dict['block_height'] = latest_blockheight - tx_dict['confirmations'] + 1
+    confirmations = tx_dict.get('confirmations', 0)
+    tx_dict['block_height'] = latest_blockheight - confirmations + 1
+
+    if use_cache and confirmations >= txcache.MIN_CONFIRMATIONS:
+        _get_tx_cache().put(
+            tx_id, bytes.fromhex(tx_dict['hex']), tx_dict['block_height'])
 
     return tx_dict, t
 
 
-async def get_header_chain(start_height: int, count: int) -> str:
+async def get_header_chain_bytes(start_height: int, count: int) -> bytes:
     '''
-    gets headers starting at a specified height
+    gets headers starting at a specified height, as raw bytes
     '''
-    client = await _get_client()
+    res = await _rpc('blockchain.block.headers', start_height, count)
 
-    res = await client.RPC(
-        'blockchain.block.headers', start_height, count)
+    return bytes.fromhex(res['hex'])
 
-    return cast(str, res['hex'])
 
+async def get_header_chain(start_height: int, count: int) -> str:
+    '''
+    gets headers starting at a specified height
+    '''
+    return (await get_header_chain_bytes(start_height, count)).hex()
 
-async def get_merkle_proof_from_api(tx_id: str, hght: int) -> Tuple[str, int]:
+
+async def get_merkle_proof_bytes(tx_id: str, hght: int) -> Tuple[bytes, int]:
     '''
     gets a transaction inclusion proof from electrum
-    puts it into the format we expect
+    puts it into the format we expect, as raw bytes
     '''
-    client = await _get_client()
-
-    res = await client.RPC('blockchain.transaction.get_merkle', tx_id, hght)
+    res = await _rpc('blockchain.transaction.get_merkle', tx_id, hght)
 
     pos = res['pos']
 
@@ -180,44 +247,84 @@ async def get_merkle_proof_from_api(tx_id: str, hght: int) -> Tuple[str, int]:
     proof.extend(block_root)
 
     # NB: add 1 because our proof uses 1-indexed position
-    return proof.hex(), pos + 1
+    return bytes(proof), pos + 1
 
 
-def verify_proof(proof: bytes, index: int) -> bool:
+async def get_merkle_proof_from_api(tx_id: str, hght: int) -> Tuple[str, int]:
+    '''
+    gets a transaction inclusion proof from electrum
+    puts it into the format we expect
+    '''
+    proof, index = await get_merkle_proof_bytes(tx_id, hght)
+    return proof.hex(), index
+
+
+def _hash256_pair(a: Union[bytes, memoryview],
+                  b: Union[bytes, memoryview]) -> bytes:
+    h = hashlib.sha256(a)
+    h.update(b)
+    return hashlib.sha256(h.digest()).digest()
+
+
+def verify_proof(proof: Union[bytes, memoryview], index: int) -> bool:
     '''
     verifies a merkle leaf occurs at a specified index given a merkle proof
+    accepts a memoryview, so a proof inside a larger buffer is not copied
     '''
     index = index  # This is 1 indexed
     # TODO: making creating and verifying indexes the same
+    proof = memoryview(proof)
     root = proof[-32:]
-    current = proof[0:32]
+    current: Union[bytes, memoryview] = proof[0:32]
 
     # For all hashes between first and last
     for i in range(1, len(proof) // 32 - 1):
         # If the current index is even,
         # The next hash goes before the current one
         if index % 2 == 0:
-            current = rutils.hash256(
-                proof[i * 32: (i + 1) * 32]
-                + current
-            )
+            current = _hash256_pair(proof[i * 32: (i + 1) * 32], current)
             # Halve and floor the index
             index = index // 2
         else:
             # The next hash goes after the current one
-            current = rutils.hash256(
-                current
-                + proof[i * 32: (i + 1) * 32]
-            )
+            current = _hash256_pair(current, proof[i * 32: (i + 1) * 32])
             # Halve and ceil the index
             index = index // 2 + 1
-        print(current.hex())
     # At the end we should have made the root
     if current != root:
         return False
     return True
 
 
+class ClaimArgs(NamedTuple):
+    '''
+    The raw arguments of the auction contract's claim method, in order.
+    e.g. interface_wrapper.create_claim_data(*args)
+    '''
+    tx: bytes
+    proof: bytes
+    leaf_index: int  # NB: the claim method's index argument
+    headers: bytes
+
+
+async def get_claim_args(tx_id: str, num_headers: int) -> ClaimArgs:
+    '''
+    gets the tx, proof and header chain for a claim, as raw bytes
+    suitable for interface_wrapper.create_claim_data
+    '''
+    (tx_json, t) = await get_tx_from_api(tx_id)
+
+    proof, index = await get_merkle_proof_bytes(
+        t.tx_id.hex(), tx_json['block_height'])
+
+    # Create a header chain
+    chain = await get_header_chain_bytes(
+        tx_json['block_height'],
+        num_headers + 1)
+
+    return ClaimArgs(t.to_bytes(), proof, index, chain)
+
+
 # async def get_that_tx(
 #         tx_id: str,
 #         num_headers: int,
@@ -245,35 +352,27 @@ async def do_it_all(tx_id: str, num_headers: int) -> None:
     '''
     Gets proof info and prints it
     '''
-    (tx_json, t) = await get_tx_from_api(tx_id)
-
-    proof, index = await get_merkle_proof_from_api(
-        t.tx_id.hex(), tx_json['block_height'])
-
-    # Create a header chain
-    chain = await get_header_chain(
-        tx_json['block_height'],
-        num_headers + 1)
+    args = await get_claim_args(tx_id, num_headers)
 
     # Error if the proof isn't valid
-    assert(verify_proof(bytes.fromhex(proof), index))
+    assert(verify_proof(args.proof, args.leaf_index))
 
     print()
     print()
     print('---- TX ----')
-    print(t.hex())
+    print(args.tx.hex())
     print()
     print()
     print('--- PROOF ---')
-    print(proof)
+    print(args.proof.hex())
     print()
     print()
     print('--- INDEX ---')
-    print(index)
+    print(args.leaf_index)
     print()
     print()
     print('--- CHAIN ---')
-    print(chain)
+    print(args.headers.hex())
 
 
 def main() -> None:
@@ -0,0 +1,237 @@
+'''
+Lightweight timing spans and counters for hot paths.
+
+Disabled by default, and nearly free when disabled. Enable with
+metrics.enable(), or by setting INTEGRAL_METRICS=1 in the environment.
+
+Example:
+    metrics.enable()
+    with metrics.span('electrum_rpc', method='blockchain.transaction.get'):
+        ...
+    metrics.incr('abi_bytes_encoded', 388, method='open')
+    metrics.export('/tmp/integral.prom')
+'''
+import os
+import json
+import time
+import asyncio
+import functools
+import threading
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, cast
+
+PREFIX = 'integral'
+
+Labels = Tuple[Tuple[str, str], ...]
+Key = Tuple[str, Labels]
+F = TypeVar('F', bound=Callable[..., Any])
+
+_enabled = os.environ.get('INTEGRAL_METRICS', '') == '1'
+_lock = threading.Lock()
+_counters: Dict[Key, float] = {}
+_timings: Dict[Key, List[float]] = {}  # count, total seconds, max seconds
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    '''Clears all recorded metrics'''
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+
+
+def _key(name: str, labels: Dict[str, Any]) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def incr(name: str, value: float = 1, **labels: Any) -> None:
+    '''Adds to a counter. Does nothing if metrics are disabled'''
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels: Any) -> None:
+    '''Records one timing. Does nothing if metrics are disabled'''
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        t = _timings.get(key)
+        if t is None:
+            _timings[key] = [1, seconds, seconds]
+        else:
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+
+class _Span:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: Dict[str, Any]) -> None:
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> '_Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        labels = self.labels
+        if args[0] is not None:
+            labels = dict(labels, error=args[0].__name__)
+        observe(self.name, time.perf_counter() - self.start, **labels)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, **labels: Any) -> Any:
+    '''
+    Times a block of code. Failed blocks get an error label with the
+    exception type. Returns a shared no-op context if metrics are disabled.
+    '''
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, labels)
+
+
+def timed(name: str, **labels: Any) -> Callable[[F], F]:
+    '''Decorates a function or coroutine function to time each call'''
+    def decorator(f: F) -> F:
+        if asyncio.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                if not _enabled:
+                    return await f(*args, **kwargs)
+                with _Span(name, labels):
+                    return await f(*args, **kwargs)
+            return cast(F, async_wrapper)
+
+        @functools.wraps(f)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not _enabled:
+                return f(*args, **kwargs)
+            with _Span(name, labels):
+                return f(*args, **kwargs)
+        return cast(F, wrapper)
+    return decorator
+
+
+def snapshot() -> Dict[str, Any]:
+    '''Copies the current metrics into a JSON-serializable dict'''
+    with _lock:
+        counters = [{'name': k[0], 'labels': dict(k[1]), 'value': v}
+                    for k, v in _counters.items()]
+        timings = [{'name': k[0], 'labels': dict(k[1]), 'count': t[0],
+                    'seconds': t[1], 'max_seconds': t[2]}
+                   for k, t in _timings.items()]
+    return {'time': time.time(), 'counters': counters, 'timings': timings}
+
+
+def _prom_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    pairs = ['{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"'))
+             for k, v in sorted(labels.items())]
+    return '{' + ','.join(pairs) + '}'
+
+
+def prometheus_text(snap: Optional[Dict[str, Any]] = None) -> str:
+    '''Renders a snapshot in the Prometheus text exposition format'''
+    if snap is None:
+        snap = snapshot()
+    lines = []
+    typed = set()
+
+    def declare(metric: str, kind: str) -> None:
+        if metric not in typed:
+            typed.add(metric)
+            lines.append('# TYPE {} {}'.format(metric, kind))
+
+    for c in sorted(snap['counters'], key=lambda c: c['name']):
+        metric = '{}_{}_total'.format(PREFIX, c['name'])
+        declare(metric, 'counter')
+        lines.append('{}{} {}'.format(
+            metric, _prom_labels(c['labels']), c['value']))
+
+    for t in sorted(snap['timings'], key=lambda t: t['name']):
+        metric = '{}_{}_seconds'.format(PREFIX, t['name'])
+        labels = _prom_labels(t['labels'])
+        declare(metric, 'summary')
+        lines.append('{}_count{} {}'.format(metric, labels, t['count']))
+        lines.append('{}_sum{} {}'.format(metric, labels, t['seconds']))
+        declare(metric + '_max', 'gauge')
+        lines.append('{}_max{} {}'.format(metric, labels, t['max_seconds']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def export(filename: str, fmt: str = 'prometheus') -> None:
+    '''
+    Writes a snapshot to a file, atomically. Suitable for the node
+    exporter's textfile collector.
+
+    Args:
+        filename (str): the file to write
+        fmt      (str): 'prometheus' or 'json'
+    '''
+    if fmt == 'prometheus':
+        data = prometheus_text()
+    elif fmt == 'json':
+        data = json.dumps(snapshot(), sort_keys=True)
+    else:
+        raise ValueError('Unknown format: {}'.format(fmt))
+
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def start_exporter(
+        filename: str,
+        interval: float = 15,
+        fmt: str = 'prometheus') -> threading.Event:
+    '''
+    Exports a snapshot every interval seconds from a daemon thread. For
+    long-running services. One-shot scripts should call export at exit.
+
+    Returns:
+        (threading.Event): set it to stop the exporter
+    '''
+    stop = threading.Event()
+
+    def run() -> None:
+        while not stop.wait(interval):
+            export(filename, fmt)
+        export(filename, fmt)
+
+    threading.Thread(target=run, name='metrics-exporter', daemon=True).start()
+    return stop
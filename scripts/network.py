@@ -0,0 +1,209 @@
+import hashlib
+
+import riemann
+
+from riemann import tx
+from riemann import utils as rutils
+
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class Network(NamedTuple):
+    '''
+    The address encoding parameters of a Bitcoin network. Passing one of
+    these through the builders avoids riemann's process-global network, so
+    mainnet and testnet work can share a process or a worker pool.
+    '''
+    name: str
+    bech32_hrp: str
+    p2pkh_prefix: int
+    p2sh_prefix: int
+
+
+NETWORKS = {
+    'bitcoin_main': Network('bitcoin_main', 'bc', 0x00, 0x05),
+    'bitcoin_test': Network('bitcoin_test', 'tb', 0x6f, 0xc4),
+    'bitcoin_reg': Network('bitcoin_reg', 'bcrt', 0x6f, 0xc4),
+}
+
+NetworkLike = Optional[str]
+
+
+def get_network(name: NetworkLike = None) -> Network:
+    '''Looks up a network by name
+
+    Args:
+        name (str): e.g. 'bitcoin_main' or 'bitcoin_test'. If None, riemann's
+                    currently selected network
+    Returns:
+        (Network): the network parameters
+    '''
+    if name is None:
+        name = riemann.get_current_network_name()
+    try:
+        return NETWORKS[name]
+    except KeyError:
+        raise ValueError('Unsupported network: {}'.format(name))
+
+
+def for_eth_network(network_id: int) -> Network:
+    '''The Bitcoin network that pairs with an Ethereum network id'''
+    return NETWORKS['bitcoin_main' if network_id == 1 else 'bitcoin_test']
+
+
+# Adapted from the BIP173 and BIP350 reference implementations
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_CONST = 1
+BECH32M_CONST = 0x2bc830a3
+
+
+def _bech32_polymod(values: List[int]) -> int:
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for v in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ v
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _bech32_hrp_expand(hrp: str) -> List[int]:
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+
+def _convertbits(
+        data: List[int],
+        frombits: int,
+        tobits: int,
+        pad: bool) -> Optional[List[int]]:
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        if value < 0 or (value >> frombits):
+            return None
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if pad:
+        if bits:
+            ret.append((acc << (tobits - bits)) & maxv)
+    elif bits >= frombits or ((acc << (tobits - bits)) & maxv):
+        return None
+    return ret
+
+
+def _segwit_decode(hrp: str, address: str) -> Optional[Tuple[int, bytes]]:
+    if address.lower() != address and address.upper() != address:
+        return None
+    address = address.lower()
+    pos = address.rfind('1')
+    if pos < 1 or pos + 7 > len(address) or len(address) > 90:
+        return None
+    if address[:pos] != hrp:
+        return None
+    if any(c not in BECH32_CHARSET for c in address[pos + 1:]):
+        return None
+    data = [BECH32_CHARSET.find(c) for c in address[pos + 1:]]
+    const = _bech32_polymod(_bech32_hrp_expand(hrp) + data)
+    if const not in (BECH32_CONST, BECH32M_CONST):
+        return None
+    version = data[0]
+    program = _convertbits(data[1:-6], 5, 8, False)
+    if program is None or version > 16 or not 2 <= len(program) <= 40:
+        return None
+    if version == 0 and len(program) not in (20, 32):
+        return None
+    # NB: v0 uses bech32, later versions use bech32m
+    if const != (BECH32_CONST if version == 0 else BECH32M_CONST):
+        return None
+    return version, bytes(program)
+
+
+def _segwit_encode(hrp: str, version: int, program: bytes) -> str:
+    data = [version] + (_convertbits(list(program), 8, 5, True) or [])
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    polymod = _bech32_polymod(
+        _bech32_hrp_expand(hrp) + data + [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def _b58check_decode(address: str) -> bytes:
+    n = 0
+    for c in address:
+        n = n * 58 + B58_ALPHABET.index(c)
+    leading_zeros = len(address) - len(address.lstrip('1'))
+    raw = b'\x00' * leading_zeros + n.to_bytes((n.bit_length() + 7) // 8,
+                                               'big')
+    payload, checksum = raw[:-4], raw[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] \
+            != checksum:
+        raise ValueError('Bad base58 checksum')
+    return payload
+
+
+def to_output_script(address: str, network: NetworkLike = None) -> bytes:
+    '''Decodes an address to its output script on a specific network
+
+    Args:
+        address  (str): the address
+        network  (str): the network name. riemann's current network if None
+    Returns:
+        (bytes): the output script
+    '''
+    params = get_network(network)
+    decoded = _segwit_decode(params.bech32_hrp, address)
+    if decoded is not None:
+        version, program = decoded
+        op_version = 0 if version == 0 else 0x50 + version
+        return bytes([op_version, len(program)]) + program
+
+    try:
+        payload = _b58check_decode(address)
+    except ValueError:
+        payload = b''
+    if len(payload) == 21 and payload[0] == params.p2pkh_prefix:
+        return b'\x76\xa9\x14' + payload[1:] + b'\x88\xac'
+    if len(payload) == 21 and payload[0] == params.p2sh_prefix:
+        return b'\xa9\x14' + payload[1:] + b'\x87'
+    raise ValueError('{} is not a valid address on {}'.format(
+        address, params.name))
+
+
+def make_p2wpkh_address(pubkey: bytes, network: NetworkLike = None) -> str:
+    '''Encodes the P2WPKH address of a compressed pubkey
+
+    Args:
+        pubkey  (bytes): the 33-byte compressed pubkey
+        network   (str): the network name. riemann's current network if None
+    Returns:
+        (str): the bech32 address
+    '''
+    params = get_network(network)
+    return _segwit_encode(params.bech32_hrp, 0, rutils.hash160(pubkey))
+
+
+def output(
+        value: int,
+        address: str,
+        network: NetworkLike = None) -> tx.TxOut:
+    '''Like riemann.simple.output, but for an explicit network
+
+    Args:
+        value    (int): the value in satoshi
+        address  (str): the recipient address
+        network  (str): the network name. riemann's current network if None
+    Returns:
+        (riemann.tx.TxOut): the output
+    '''
+    return tx.TxOut(
+        value=rutils.i2le_padded(value, 8),
+        output_script=to_output_script(address, network))
@@ -1,13 +1,17 @@
+import scripts.hd as hd
 import scripts.utils as utils
+import scripts.network as net
 from riemann import simple, tx
 from riemann import utils as rutils
 
+from array import array
+from collections import OrderedDict
 from riemann.tx import Outpoint, Tx
-from typing import cast, List, Tuple
+from typing import cast, Iterable, Iterator, List, Tuple, Union
 
 
 Format = List[Tuple[int, int]]  # sale value, block height
-KeyPair = Tuple[str, str]
+KeyPair = hd.KeyPair
 Prevout = Tuple[str, int, int]  # txid, index, value
 Auction = List[Tx]
 
@@ -15,7 +19,8 @@ Auction = List[Tx]
 def make_partial_tx(outpoint: Outpoint,
                     output_value: int,
                     output_address: str,
-                    lock_time: int = 0) -> Tx:
+                    lock_time: int = 0,
+                    network: net.NetworkLike = None) -> Tx:
     '''Creates an unsigned partial tx
     Args:
         outpoint (riemann.tx.Outpoint): the outpoint to spend
@@ -23,9 +28,11 @@ def make_partial_tx(outpoint: Outpoint,
         output_value             (int): the number of satoshi to receive
         output_address           (str): the seller's address
         lock_time                (int): the tx's lock time
+        network                  (str): the bitcoin network name. riemann's
+                                        current network if None
     '''
     tx_ins = [simple.unsigned_input(outpoint, sequence=0xFFFFFFFD)]
-    tx_outs = [simple.output(output_value, output_address)]
+    tx_outs = [net.output(output_value, output_address, network)]
     return cast(Tx, simple.unsigned_witness_tx(
         tx_ins=tx_ins,
         tx_outs=tx_outs,
@@ -71,7 +78,8 @@ def partial(
         recipient_addr: str,
         output_value: int,
         lock_time: int,
-        keypair: KeyPair) -> Tx:
+        keypair: hd.KeyRef,
+        network: net.NetworkLike = None) -> Tx:
     '''
     Makes a partial_tx from human readable information
 
@@ -82,10 +90,13 @@ def partial(
         recipient_addr       (str): address of the recipient
         output_value         (int): value in satoshi of the output
         lock_time            (int): desired lock_time in bitcoin format
-        keypair  (tuple(str, str)): privkey as hex, pubkey as hex
+        keypair           (KeyRef): privkey and pubkey as hex, or a
+                                   hd.KeyPath to derive them from
+        network              (str): the bitcoin network name
     Returns:
         (riemann.tx.Tx): The signed transaction
     '''
+    keypair = hd.resolve(keypair, index)
     outpoint = simple.outpoint(tx_id, index)
     pub = bytes.fromhex(keypair[1])
     pkh = rutils.hash160(pub)
@@ -95,7 +106,8 @@ def partial(
         outpoint=outpoint,
         output_value=output_value,
         output_address=recipient_addr,
-        lock_time=lock_time)
+        lock_time=lock_time,
+        network=network)
 
     signed = sign_partial_tx(
         partial_tx=unsigned,
@@ -111,7 +123,8 @@ def dutch(
         prevout_value: int,
         recipient_addr: str,
         format_tuples: Format,
-        keypair: KeyPair) -> Auction:
+        keypair: hd.KeyRef,
+        network: net.NetworkLike = None) -> Auction:
     '''
     Makes a dutch auction given a list representing the format
 
@@ -121,14 +134,18 @@ def dutch(
         prevout_value                   (int): value in satoshi of the input
         recipient_addr                  (str): address of the recipient
         format_tuples (list(tuple(int, int))): tuples of value and timelock
-        keypair             (tuple(str, str)): privkey as hex, pubkey as hex
+        keypair                      (KeyRef): privkey and pubkey as hex, or
+                                              an hd.KeyPath to derive them
+        network                         (str): the bitcoin network name
     Returns:
         list(riemann.tx.Tx): The signed transactions
     '''
+    # NB: derive the auction's key once for all tiers
+    keypair = hd.resolve(keypair, index)
     ret = []
     for t in format_tuples:
         txn = partial(tx_id, index, prevout_value, recipient_addr,
-                      t[0], t[1], keypair)
+                      t[0], t[1], keypair, network)
         ret.append(txn)
     return ret
 
@@ -139,7 +156,8 @@ def dutch_as_hex(
         prevout_value: int,
         recipient_addr: str,
         format_tuples: Format,
-        keypair: KeyPair) -> str:
+        keypair: hd.KeyRef,
+        network: net.NetworkLike = None) -> str:
     '''
     Makes a dutch auction given a list representing the format
 
@@ -149,12 +167,14 @@ def dutch_as_hex(
         prevout_value                   (int): value in satoshi of the input
         recipient_addr                  (str): address of the recipient
         format_tuples (list(tuple(int, int))): tuples of value and timelock
-        keypair             (tuple(str, str)): privkey as hex, pubkey as hex
+        keypair                      (KeyRef): privkey and pubkey as hex, or
+                                              an hd.KeyPath to derive them
+        network                         (str): the bitcoin network name
     Returns:
         str: The signed transactions as a hex blob
     '''
     txns = dutch(tx_id, index, prevout_value, recipient_addr,
-                 format_tuples, keypair)
+                 format_tuples, keypair, network)
     b = bytearray()
     for t in txns:
         b.extend(t)
@@ -165,7 +185,8 @@ def multidutch(
         prevouts: List[Prevout],
         recipient_addr: str,
         format_tuples: Format,
-        keypair: KeyPair) -> List[Auction]:
+        keypair: hd.KeyRef,
+        network: net.NetworkLike = None) -> List[Auction]:
     '''
     Makes identical dutch auctions for each outpoint in a list of outpoints
 
@@ -173,14 +194,16 @@ def multidutch(
         prevouts (list(tuple(str, int, int))): tuple of txid, index, value
         recipient_addr                  (str): address of the recipient
         format_tuples (list(tuple(int, int))): tuples of value and timelock
-        keypair             (tuple(str, str)): privkey as hex, pubkey as hex
+        keypair                      (KeyRef): privkey and pubkey as hex, or
+                                              an hd.KeyPath to derive them
+        network                         (str): the bitcoin network name
     Returns:
         list(list(riemann.tx.Tx)): The signed transactions
     '''
     ret = []
     for p in prevouts:
         d = dutch(p[0], p[1], p[2], recipient_addr,
-                  format_tuples, keypair)
+                  format_tuples, keypair, network)
         ret.append(d)
     return ret
 
@@ -189,7 +212,8 @@ def multidutch_as_hex(
         prevouts: List[Prevout],
         recipient_addr: str,
         format_tuples: Format,
-        keypair: KeyPair) -> List[str]:
+        keypair: hd.KeyRef,
+        network: net.NetworkLike = None) -> List[str]:
     '''
     Makes identical dutch auctions for each outpoint in a list of outpoints
 
@@ -197,15 +221,244 @@ def multidutch_as_hex(
         prevouts (list(tuple(str, str, int))): tuple of txid, index, value
         recipient_addr                  (str): address of the recipient
         format_tuples (list(tuple(int, int))): tuples of value and timelock
-        keypair             (tuple(str, str)): privkey as hex, pubkey as hex
+        keypair                      (KeyRef): privkey and pubkey as hex, or
+                                              an hd.KeyPath to derive them
+        network                         (str): the bitcoin network name
     Returns:
         list(str): A list of dutch partial_tx blobs
     '''
-    dutches = multidutch(prevouts, recipient_addr, format_tuples, keypair)
-    ret = []
-    for d in dutches:
-        b = bytearray()
-        for t in d:
-            b.extend(t)
-        ret.append(b.hex())
-    return ret
+    # NB: packs each tier as it is signed, rather than holding every Tx
+    store = multidutch_compact(prevouts, recipient_addr, format_tuples,
+                               keypair, network)
+    return [store.auction_bytes(i).hex() for i in range(len(store))]
+
+
+# Compact representations
+#
+# A riemann Tx holds each field in its own object, so a signed tier costs
+# kilobytes. These hold the same information in raw bytes and flat arrays.
+
+# NB: prevouts of one tx are made together, so recent txids are enough.
+#     bounded, so long-running processes do not keep every txid forever
+TXID_CACHE_SIZE = 4096
+_TXIDS: 'OrderedDict[bytes, bytes]' = OrderedDict()
+
+
+def intern_txid(tx_id: Union[str, bytes]) -> bytes:
+    '''
+    Returns a shared 32-byte object for a txid, so that many prevouts of one
+    tx hold one copy of it. Only the most recently used txids are kept
+
+    Args:
+        tx_id (str or bytes): the txid, as hex or bytes
+    Returns:
+        (bytes): the interned txid
+    '''
+    b = bytes.fromhex(tx_id) if isinstance(tx_id, str) else bytes(tx_id)
+    shared = _TXIDS.get(b)
+    if shared is not None:
+        _TXIDS.move_to_end(b)
+        return shared
+    _TXIDS[b] = b
+    if len(_TXIDS) > TXID_CACHE_SIZE:
+        _TXIDS.popitem(last=False)
+    return b
+
+
+class CompactPrevout:
+    '''A prevout holding an interned 32-byte txid instead of a hex string'''
+    __slots__ = ('tx_id', 'index', 'value')
+
+    def __init__(self, tx_id: Union[str, bytes], index: int, value: int):
+        self.tx_id = intern_txid(tx_id)
+        self.index = index
+        self.value = value
+
+    def to_tuple(self) -> Prevout:
+        return self.tx_id.hex(), self.index, self.value
+
+
+class CompactFormat:
+    '''
+    An auction format stored as two flat arrays of unsigned integers.
+    Iterates as (value, lock_time) tuples, like a Format.
+    '''
+    __slots__ = ('values', 'lock_times')
+
+    def __init__(self, format_tuples: Iterable[Tuple[int, int]]) -> None:
+        self.values = array('Q')
+        self.lock_times = array('L')
+        for value, lock_time in format_tuples:
+            self.values.append(value)
+            self.lock_times.append(lock_time)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return zip(self.values, self.lock_times)
+
+
+def _varint_at(raw: bytes, offset: int) -> Tuple[int, int]:
+    '''Reads a varint. Returns its value and the offset after it'''
+    prefix = raw[offset]
+    if prefix < 0xfd:
+        return prefix, offset + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[prefix]
+    return (int.from_bytes(raw[offset + 1:offset + 1 + size], 'little'),
+            offset + 1 + size)
+
+
+class SignedPartial:
+    '''
+    A signed partial tx as raw bytes, plus the offsets of its first
+    output's value and its lock_time
+
+    Args:
+        raw (bytes): the serialized, signed, witness partial tx
+    '''
+    __slots__ = ('raw', 'value_offset', 'lock_time_offset')
+
+    def __init__(self, raw: bytes) -> None:
+        self.raw = raw
+        # NB: version (4), segwit marker and flag (2)
+        n_ins, offset = _varint_at(raw, 6)
+        for _ in range(n_ins):
+            # NB: outpoint (36), script sig, sequence (4)
+            script_len, offset = _varint_at(raw, offset + 36)
+            offset += script_len + 4
+        _, self.value_offset = _varint_at(raw, offset)
+        self.lock_time_offset = len(raw) - 4
+
+    @classmethod
+    def from_tx(cls, t: Tx) -> 'SignedPartial':
+        return cls(t.to_bytes())
+
+    @property
+    def value(self) -> int:
+        o = self.value_offset
+        return int.from_bytes(self.raw[o:o + 8], 'little')
+
+    @property
+    def lock_time(self) -> int:
+        return int.from_bytes(self.raw[self.lock_time_offset:], 'little')
+
+    def hex(self) -> str:
+        return self.raw.hex()
+
+    def to_tx(self) -> Tx:
+        return cast(Tx, tx.Tx.from_bytes(self.raw))
+
+
+class PartialStore:
+    '''
+    Many signed partial txns packed into one buffer, with per-tier offsets
+    in flat arrays. The per-tier cost is the raw tx plus 20 bytes.
+    Tiers are grouped into auctions by their position.
+    '''
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.starts = array('Q')
+        self.value_offsets = array('H')
+        self.auction_starts = array('Q')  # the first tier of each auction
+
+    def append_auction(self, partials: Iterable[SignedPartial]) -> None:
+        '''Adds the tiers of one auction'''
+        self.auction_starts.append(len(self.starts))
+        for p in partials:
+            self.starts.append(len(self.buffer))
+            self.value_offsets.append(p.value_offset)
+            self.buffer.extend(p.raw)
+
+    def __len__(self) -> int:
+        return len(self.auction_starts)
+
+    @property
+    def num_tiers(self) -> int:
+        return len(self.starts)
+
+    def _end(self, tier: int) -> int:
+        if tier + 1 < len(self.starts):
+            return self.starts[tier + 1]
+        return len(self.buffer)
+
+    def tier(self, tier: int) -> SignedPartial:
+        '''Copies a single tier out of the store'''
+        p = SignedPartial.__new__(SignedPartial)
+        p.raw = bytes(self.buffer[self.starts[tier]:self._end(tier)])
+        p.value_offset = self.value_offsets[tier]
+        p.lock_time_offset = len(p.raw) - 4
+        return p
+
+    def value_and_lock_time(self, tier: int) -> Tuple[int, int]:
+        '''Reads a tier's value and lock_time without copying the tier'''
+        start, end = self.starts[tier], self._end(tier)
+        v = start + self.value_offsets[tier]
+        return (int.from_bytes(self.buffer[v:v + 8], 'little'),
+                int.from_bytes(self.buffer[end - 4:end], 'little'))
+
+    def auction_bytes(self, auction: int) -> bytes:
+        '''The concatenated tiers of an auction, as in dutch_as_hex'''
+        start = self.starts[self.auction_starts[auction]]
+        if auction + 1 < len(self.auction_starts):
+            end = self.starts[self.auction_starts[auction + 1]]
+        else:
+            end = len(self.buffer)
+        return bytes(self.buffer[start:end])
+
+
+def dutch_compact(
+        prevout: Union[Prevout, CompactPrevout],
+        recipient_addr: str,
+        format_tuples: Iterable[Tuple[int, int]],
+        keypair: hd.KeyRef,
+        network: net.NetworkLike = None) -> List[SignedPartial]:
+    '''
+    Like dutch, but returns compact records instead of Tx objects
+
+    Args:
+        prevout    (tuple or CompactPrevout): txid, index, value
+        recipient_addr                 (str): address of the recipient
+        format_tuples (iterable(tuple(int, int))): value and timelock tuples
+        keypair                     (KeyRef): privkey and pubkey as hex, or
+                                             an hd.KeyPath to derive them
+        network                        (str): the bitcoin network name
+    Returns:
+        list(SignedPartial): The signed transactions
+    '''
+    if isinstance(prevout, CompactPrevout):
+        prevout = prevout.to_tuple()
+    tx_id, index, value = prevout
+    keypair = hd.resolve(keypair, index)
+    return [SignedPartial.from_tx(partial(
+        tx_id, index, value, recipient_addr, sale_value, lock_time,
+        keypair, network)) for sale_value, lock_time in format_tuples]
+
+
+def multidutch_compact(
+        prevouts: Iterable[Union[Prevout, CompactPrevout]],
+        recipient_addr: str,
+        format_tuples: Iterable[Tuple[int, int]],
+        keypair: hd.KeyRef,
+        network: net.NetworkLike = None) -> PartialStore:
+    '''
+    Like multidutch, but packs the signed tiers into a PartialStore. No Tx
+    object outlives the signing of its tier.
+
+    Args:
+        prevouts (iterable(tuple or CompactPrevout)): txid, index, value
+        recipient_addr                 (str): address of the recipient
+        format_tuples (iterable(tuple(int, int))): value and timelock tuples
+        keypair                     (KeyRef): privkey and pubkey as hex, or
+                                             an hd.KeyPath to derive them
+        network                        (str): the bitcoin network name
+    Returns:
+        (PartialStore): The signed transactions, one auction per prevout
+    '''
+    format_tuples = CompactFormat(format_tuples)
+    store = PartialStore()
+    for p in prevouts:
+        store.append_auction(dutch_compact(
+            p, recipient_addr, format_tuples, keypair, network))
+    return store
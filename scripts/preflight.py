@@ -0,0 +1,397 @@
+'''
+Runs StatelessSwap's claim checks locally, before spending gas.
+
+Mirrors claim, _makeAllChecks and _extractBidder, including bitcoin-spv's
+parsing and header validation, and reports the revert reason the
+contract would give. The cases in test/preflight_cases.json pin the
+mirror to the contract: test/Preflight.test.js runs them on a dev chain,
+and this module's CLI runs them here.
+
+Usage:
+    python -m scripts.preflight test/preflight_cases.json
+'''
+import sys
+import json
+import hashlib
+
+import scripts.utils as utils
+
+from typing import (Any, Callable, Dict, Iterable, List, NamedTuple,
+                    Optional, Tuple)
+
+ADDR0 = '0x0000000000000000000000000000000000000000'
+DIFF1_TARGET = 0xffff * 256 ** (0x1d - 3)
+HEADER_SIZE = 80
+UINT256 = 2 ** 256
+
+# Listing states, as the contract's ListingStates enum
+NONE = 0
+ACTIVE = 1
+CLOSED = 2
+
+# The contract's revert reasons
+VIN_MALFORMED = 'vin is malformed'
+VOUT_MALFORMED = 'vout is malformed'
+BAD_LENGTH = 'Header bytes not multiple of 80.'
+INVALID_CHAIN = 'Header bytes not a valid chain.'
+LOW_WORK = 'Header does not meet its own difficulty target.'
+BAD_PROOF = 'Bad inclusion proof'
+LOW_DIFF = 'Not enough difficulty in header chain.'
+NOT_ACTIVE = 'Listing has closed or does not exist.'
+OUT_OF_BOUNDS = 'Slice out of bounds'
+
+
+class Revert(Exception):
+    '''A check failed. The message is the contract's revert reason'''
+
+    @property
+    def reason(self) -> str:
+        return str(self.args[0])
+
+
+class Claim(NamedTuple):
+    '''The arguments of StatelessSwap.claim, in order'''
+    proof: bytes
+    leaf_index: int  # NB: the claim method's _index argument
+    version: bytes
+    vin: bytes
+    vout: bytes
+    locktime: bytes
+    headers: bytes
+
+
+class ListingState(NamedTuple):
+    state: int
+    req_diff: int
+    seller: Optional[str]
+
+
+class Verdict(NamedTuple):
+    '''
+    Whether a claim would succeed. On failure, reason is the revert reason.
+    bidder is None when the contract falls back to the seller
+    '''
+    ok: bool
+    reason: Optional[str]
+    diff: int
+    listing_id: Optional[bytes]
+    bidder: Optional[str]
+
+
+Lookup = Callable[[bytes], ListingState]
+
+
+def _hash256(data: bytes) -> bytes:
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def _slice(data: bytes, start: int, length: int) -> bytes:
+    if len(data) < start + length:
+        raise Revert(OUT_OF_BOUNDS)
+    return data[start:start + length]
+
+
+def _parse_varint(buf: bytes) -> Optional[Tuple[int, int]]:
+    '''The varint's data length and value. None if buf is too short'''
+    if not buf:
+        return None
+    data_len = {0xfd: 2, 0xfe: 4, 0xff: 8}.get(buf[0], 0)
+    if data_len == 0:
+        return 0, buf[0]
+    if len(buf) < 1 + data_len:
+        return None
+    return data_len, int.from_bytes(buf[1:1 + data_len], 'little')
+
+
+def _input_length(tx_in: bytes) -> Optional[int]:
+    if len(tx_in) < 37:
+        return None
+    varint = _parse_varint(tx_in[36:])
+    if varint is None:
+        return None
+    return 36 + 1 + varint[0] + varint[1] + 4
+
+
+def _output_length(tx_out: bytes) -> Optional[int]:
+    if len(tx_out) < 9:
+        return None
+    varint = _parse_varint(tx_out[8:])
+    if varint is None:
+        return None
+    return 8 + 1 + varint[0] + varint[1]
+
+
+def _validate_vector(
+        vector: bytes,
+        length_at: Callable[[bytes], Optional[int]]) -> bool:
+    varint = _parse_varint(vector)
+    if varint is None or varint[1] == 0:
+        return False
+    offset = 1 + varint[0]
+    for _ in range(varint[1]):
+        if offset >= len(vector):
+            return False
+        length = length_at(vector[offset:])
+        if length is None:
+            return False
+        offset += length
+    return offset == len(vector)
+
+
+def validate_vin(vin: bytes) -> bool:
+    return _validate_vector(vin, _input_length)
+
+
+def validate_vout(vout: bytes) -> bool:
+    return _validate_vector(vout, _output_length)
+
+
+def check_tx(
+        version: bytes,
+        vin: bytes,
+        vout: bytes,
+        locktime: bytes) -> bytes:
+    '''Validates the tx's vectors. Returns its txid, little-endian'''
+    if not validate_vin(vin):
+        raise Revert(VIN_MALFORMED)
+    if not validate_vout(vout):
+        raise Revert(VOUT_MALFORMED)
+    return _hash256(version + vin + vout + locktime)
+
+
+def extract_target(header: bytes) -> int:
+    '''The header's target, with the contract's uint8 and uint256 wrapping'''
+    exponent = (header[75] - 3) % 256
+    mantissa = int.from_bytes(header[72:75], 'little')
+    return mantissa * pow(256, exponent, UINT256) % UINT256
+
+
+def header_difficulty(header: bytes) -> int:
+    '''A header's difficulty, as ValidateSPV calculates it'''
+    target = extract_target(header)
+    if target == 0:
+        raise Revert('SafeMath: division by zero')
+    return DIFF1_TARGET // target
+
+
+def check_headers(headers: bytes) -> Tuple[int, bytes]:
+    '''
+    Validates a header chain. Returns its total difficulty and the first
+    header's merkle root, little-endian
+    '''
+    if len(headers) % HEADER_SIZE != 0:
+        raise Revert(BAD_LENGTH)
+    diff = 0
+    digest = b''
+    for start in range(0, len(headers), HEADER_SIZE):
+        header = headers[start:start + HEADER_SIZE]
+        if start != 0 and header[4:36] != digest:
+            raise Revert(INVALID_CHAIN)
+        digest = _hash256(header)
+        if int.from_bytes(digest, 'little') > extract_target(header):
+            raise Revert(LOW_WORK)
+        diff += header_difficulty(header)
+    return diff, _slice(headers, 36, 32)
+
+
+def verify_merkle(proof: bytes, index: int) -> bool:
+    '''
+    Verifies a proof of txid, intermediate nodes and root, as
+    bitcoin-spv's verifyHash256Merkle. The index is 0-indexed
+    '''
+    if len(proof) % 32 != 0:
+        return False
+    if len(proof) == 32:
+        return True
+    if len(proof) == 64:
+        return False
+    current = proof[:32]
+    for i in range(1, len(proof) // 32 - 1):
+        node = proof[i * 32:(i + 1) * 32]
+        if index % 2 == 1:
+            current = _hash256(node + current)
+        else:
+            current = _hash256(current + node)
+        index >>= 1
+    return current == proof[-32:]
+
+
+def check_proof(
+        tx_id: bytes,
+        merkle_root: bytes,
+        proof: bytes,
+        index: int) -> None:
+    if tx_id == merkle_root and index == 0 and not proof:
+        return
+    if not verify_merkle(tx_id + proof + merkle_root, index):
+        raise Revert(BAD_PROOF)
+
+
+def make_all_checks(claim: Claim) -> int:
+    '''Runs the contract's makeAllChecks. Returns the chain's difficulty'''
+    tx_id = check_tx(claim.version, claim.vin, claim.vout, claim.locktime)
+    diff, merkle_root = check_headers(claim.headers)
+    check_proof(tx_id, merkle_root, claim.proof, claim.leaf_index)
+    return diff
+
+
+def _output_at(vout: bytes, index: int) -> bytes:
+    varint = _parse_varint(vout)
+    assert varint is not None
+    offset = 1 + varint[0]
+    for _ in range(index):
+        length = _output_length(vout[offset:])
+        assert length is not None
+        offset += length
+    length = _output_length(vout[offset:])
+    assert length is not None
+    return _slice(vout, offset, length)
+
+
+def extract_bidder(vout: bytes) -> str:
+    '''
+    The bidder address from the second output's OP_RETURN. ADDR0 if there
+    is none. vout must already be valid
+    '''
+    if vout[0] <= 1:
+        return ADDR0
+    output = _output_at(vout, 1)
+    if _slice(output, 9, 1) != b'\x6a':
+        return ADDR0
+    data = _slice(output, 11, _slice(output, 10, 1)[0])
+    return '0x' + data[:20].hex() if len(data) >= 20 else ADDR0
+
+
+def listing_id(vin: bytes) -> bytes:
+    '''The listing a tx claims, from its first outpoint'''
+    return utils.keccak256(_slice(vin, 1, 36))
+
+
+def check_claim(claim: Claim, lookup: Lookup) -> Verdict:
+    '''
+    Runs the contract's claim checks against a listing
+
+    Args:
+        claim      (Claim): the claim's arguments
+        lookup  (function): gets a listing's state by its id
+    Returns:
+        (Verdict): whether the claim would succeed, and why not
+    '''
+    try:
+        diff = make_all_checks(claim)
+    except Revert as e:
+        return Verdict(False, e.reason, 0, None, None)
+    lid = listing_id(claim.vin)
+    listing = lookup(lid)
+    try:
+        if diff < listing.req_diff:
+            raise Revert(LOW_DIFF)
+        if listing.state != ACTIVE:
+            raise Revert(NOT_ACTIVE)
+        bidder = extract_bidder(claim.vout)
+    except Revert as e:
+        return Verdict(False, e.reason, diff, lid, None)
+    return Verdict(True, None, diff, lid, None if bidder == ADDR0 else bidder)
+
+
+def preflight(claims: Iterable[Claim], lookup: Lookup) -> List[Verdict]:
+    '''Checks a batch of claims. One verdict per claim, in order'''
+    return [check_claim(c, lookup) for c in claims]
+
+
+def indexer_lookup(ix: Any, contract: str) -> Lookup:
+    '''Looks listings up in an indexer.Indexer's local table'''
+
+    def lookup(lid: bytes) -> ListingState:
+        listing = ix.get(contract, '0x' + lid.hex())
+        if listing is None:
+            return ListingState(NONE, 0, None)
+        state = ACTIVE if listing.status == 'active' else CLOSED
+        return ListingState(state, listing.req_diff or 0, listing.seller)
+
+    return lookup
+
+
+def _varint_end(raw: bytes, offset: int) -> Tuple[int, int]:
+    varint = _parse_varint(raw[offset:])
+    if varint is None:
+        raise ValueError('Truncated varint')
+    return offset + 1 + varint[0], varint[1]
+
+
+def split_tx(raw: bytes) -> Tuple[bytes, bytes, bytes, bytes]:
+    '''
+    Splits a serialized tx into the version, vin, vout and locktime that
+    claim takes. Witnesses are dropped
+    '''
+    offset = 6 if raw[4:6] == b'\x00\x01' else 4
+    vin_start = offset
+    offset, num_ins = _varint_end(raw, offset)
+    for _ in range(num_ins):
+        offset, script_len = _varint_end(raw, offset + 36)
+        offset += script_len + 4
+    vout_start = offset
+    offset, num_outs = _varint_end(raw, offset)
+    for _ in range(num_outs):
+        offset, script_len = _varint_end(raw, offset + 8)
+        offset += script_len
+    return raw[:4], raw[vin_start:vout_start], raw[vout_start:offset], \
+        raw[-4:]
+
+
+def from_claim_args(args: Any) -> Claim:
+    '''
+    Converts a merkle.ClaimArgs, whose proof includes the txid and root
+    and whose index is 1-indexed
+    '''
+    version, vin, vout, locktime = split_tx(args.tx)
+    return Claim(args.proof[32:-32], args.leaf_index - 1,
+                 version, vin, vout, locktime, args.headers)
+
+
+def _claim_from_case(case: Dict[str, Any]) -> Claim:
+    return Claim(
+        bytes.fromhex(case['proof'][2:]),
+        case['index'],
+        bytes.fromhex(case['version'][2:]),
+        bytes.fromhex(case['vin'][2:]),
+        bytes.fromhex(case['vout'][2:]),
+        bytes.fromhex(case['locktime'][2:]),
+        bytes.fromhex(case['headers'][2:]))
+
+
+def run_case(case: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Runs a parity case. Cases without a listing only run makeAllChecks.
+    Returns the outcome in the form of the case's expected field
+    '''
+    claim = _claim_from_case(case)
+    if case.get('listing') is None:
+        try:
+            return {'reason': None, 'diff': str(make_all_checks(claim))}
+        except Revert as e:
+            return {'reason': e.reason}
+    listing = ListingState(ACTIVE, int(case['listing']['req_diff']), None)
+    verdict = check_claim(claim, lambda _: listing)
+    if not verdict.ok:
+        return {'reason': verdict.reason}
+    return {'reason': None, 'bidder': verdict.bidder}
+
+
+def main() -> None:
+    with open(sys.argv[1], 'r') as f:
+        cases = json.load(f)
+    mismatches = 0
+    for case in cases:
+        outcome = run_case(case)
+        if outcome != case['expected']:
+            mismatches += 1
+            print('MISMATCH {}: got {}, expected {}'.format(
+                case['name'], outcome, case['expected']))
+    print('{} cases, {} mismatches'.format(len(cases), mismatches))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
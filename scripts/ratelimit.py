@@ -0,0 +1,199 @@
+'''
+Client-side rate limiting for Electrum servers.
+
+Public servers throttle or disconnect clients that send bursts of RPCs.
+Each server gets a token bucket whose rate adapts to what we observe.
+Errors and slow responses halve the rate. Fast, successful calls raise
+it a little at a time. Identical in-flight requests are coalesced into
+one call, and every waiter gets its result.
+'''
+import asyncio
+
+import scripts.metrics as metrics
+
+from typing import (Any, Awaitable, Callable, Dict, Hashable, Optional,
+                    Tuple)
+
+DEFAULT_RATE = 5.0          # requests per second
+DEFAULT_BURST = 10
+MIN_RATE = 0.5
+MAX_RATE = 50.0
+INCREASE_STEP = 0.5         # requests per second, after each fast success
+DECREASE_FACTOR = 0.5       # after each error or slow response
+TARGET_LATENCY = 1.0        # seconds
+
+# Errors that suggest the server is pushing back on us. NB: OSError
+# covers ConnectionError
+THROTTLE_ERRORS = (asyncio.TimeoutError, OSError)
+THROTTLE_MESSAGES = ('rate', 'busy', 'too many', 'excessive')
+
+
+class TokenBucket:
+    '''
+    Allows bursts of up to burst requests, refilled at rate per second
+
+    Args:
+        rate                (float): tokens added per second
+        burst                 (int): the most tokens the bucket holds
+        clock            (function): returns the time in seconds. the
+                                     event loop's time if None
+        sleep (coroutine function): waits some seconds, asyncio.sleep
+    '''
+
+    def __init__(
+            self,
+            rate: float,
+            burst: int,
+            clock: Optional[Callable[[], float]] = None,
+            sleep: Callable[[float], Awaitable[Any]] = asyncio.sleep) \
+            -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._updated: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def time(self) -> float:
+        if self._clock is None:
+            return asyncio.get_event_loop().time()
+        return self._clock()
+
+    def _refill(self, now: float) -> None:
+        if self._updated is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        '''Waits for a token, then takes it. Waiters are served in order'''
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill(self.time())
+            while self.tokens < 1:
+                await self._sleep((1 - self.tokens) / self.rate)
+                self._refill(self.time())
+            self.tokens -= 1
+
+
+def _is_throttle(e: BaseException) -> bool:
+    if isinstance(e, THROTTLE_ERRORS):
+        return True
+    msg = str(e).lower()
+    return any(m in msg for m in THROTTLE_MESSAGES)
+
+
+def _coalesce_key(method: str, params: Tuple[Any, ...]) -> Hashable:
+    try:
+        hash(params)
+        return method, params
+    except TypeError:
+        return method, repr(params)
+
+
+class ServerLimiter:
+    '''
+    Rate limits and coalesces RPCs to one server. Adjusts its rate
+    additively up and multiplicatively down, like TCP congestion control.
+
+    Args:
+        name             (str): the server, for metrics labels
+        rate           (float): the starting rate, in requests per second
+        burst            (int): the most requests to send at once
+        min_rate       (float): the floor for the adapted rate
+        max_rate       (float): the ceiling for the adapted rate
+        target_latency (float): responses slower than this reduce the rate
+        bucket   (TokenBucket): the bucket to use, e.g. with its own clock
+    '''
+
+    def __init__(
+            self,
+            name: str,
+            rate: float = DEFAULT_RATE,
+            burst: int = DEFAULT_BURST,
+            min_rate: float = MIN_RATE,
+            max_rate: float = MAX_RATE,
+            target_latency: float = TARGET_LATENCY,
+            bucket: Optional[TokenBucket] = None) -> None:
+        self.name = name
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self._in_flight: Dict[Hashable, 'asyncio.Future[Any]'] = {}
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def _set_rate(self, rate: float) -> None:
+        self.bucket.rate = max(self.min_rate, min(self.max_rate, rate))
+
+    def record(
+            self,
+            latency: Optional[float],
+            error: Optional[BaseException]) -> None:
+        '''Adapts the rate to the outcome of one call'''
+        if error is not None and _is_throttle(error):
+            metrics.incr('rpc_throttled', server=self.name)
+            self._set_rate(self.rate * DECREASE_FACTOR)
+        elif latency is not None and latency > self.target_latency:
+            self._set_rate(self.rate * DECREASE_FACTOR)
+        elif error is None:
+            self._set_rate(self.rate + INCREASE_STEP)
+
+    async def _call(
+            self,
+            send: Callable[..., Awaitable[Any]],
+            method: str,
+            params: Tuple[Any, ...]) -> Any:
+        await self.bucket.acquire()
+        start = self.bucket.time()
+        try:
+            result = await send(method, *params)
+        except Exception as e:
+            self.record(None, e)
+            raise
+        self.record(self.bucket.time() - start, None)
+        return result
+
+    async def call(
+            self,
+            send: Callable[..., Awaitable[Any]],
+            method: str,
+            *params: Any) -> Any:
+        '''
+        Makes an RPC once the rate allows. If an identical RPC is already
+        in flight, waits for its result instead of sending another
+
+        Args:
+            send (coroutine function): makes the RPC, e.g. client.RPC
+            method              (str): the RPC method
+            params                   : the RPC params
+        Returns:
+            the RPC result
+        '''
+        key = _coalesce_key(method, params)
+        fut = self._in_flight.get(key)
+        if fut is not None:
+            metrics.incr('rpc_coalesced', server=self.name, method=method)
+        else:
+            fut = asyncio.ensure_future(self._call(send, method, params))
+            self._in_flight[key] = fut
+            fut.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # NB: one waiter being cancelled must not cancel the shared call
+        return await asyncio.shield(fut)
+
+
+LIMITERS: Dict[str, ServerLimiter] = {}
+
+
+def for_server(name: str, **kwargs: Any) -> ServerLimiter:
+    '''Gets the limiter for a server, making it on first use'''
+    limiter = LIMITERS.get(name)
+    if limiter is None:
+        limiter = ServerLimiter(name, **kwargs)
+        LIMITERS[name] = limiter
+    return limiter
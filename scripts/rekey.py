@@ -0,0 +1,384 @@
+'''
+Re-encrypts our encrypted files under a new passphrase.
+
+Every encrypted file under the data directory is rekeyed, plus any
+files named on the command line. Only files ending in .enc are searched,
+so the ledger, caches and indexer databases are never opened. v2
+envelopes are found by their magic bytes. v1 files carry no marker, so
+a file is taken as v1 if it opens under the current passphrase and holds
+JSON, as every v1 file we write does. All files are rewritten as v2
+envelopes.
+
+The new passphrase is stretched once and shared by every file. Each
+file still gets its own key, derived from its random file nonce. v2
+files written separately each have their own salt, so the current
+passphrase is stretched once per distinct salt, across the workers,
+before any file is rekeyed. Files are rewritten atomically.
+
+A journal records finished files and the new key's salt. If the run is
+interrupted, rerunning with the same passphrases picks up where it left
+off. A file that already opens under the new key is not touched again.
+
+Usage:
+    python -m scripts.rekey [--workers N] [extra files...]
+'''
+import os
+import sys
+import json
+import getpass
+import argparse
+
+import scripts.utils as utils
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple, cast
+
+JOURNAL_NAME = '.rekey-journal'
+ENCRYPTED_SUFFIXES = ('.enc',)
+OLD_PASSPHRASE_ENV = 'INTEGRAL_PASSPHRASE'
+NEW_PASSPHRASE_ENV = 'INTEGRAL_NEW_PASSPHRASE'
+
+# Per-file outcomes
+REKEYED = 'rekeyed'
+ALREADY_DONE = 'already done'
+FAILED = 'failed'
+
+KeyCache = Dict[Tuple[bytes, int], utils.StretchedKey]  # by salt, iterations
+
+_OLD_PHRASE = ''
+_NEW_PHRASE = ''
+_NEW_KEY: Optional[utils.StretchedKey] = None
+_OLD_KEYS: KeyCache = {}
+_NEW_KEYS: KeyCache = {}
+_OLD_V1_SECRET: Optional[bytes] = None
+
+
+def _init_worker(
+        old_phrase: str,
+        new_phrase: str,
+        new_key: utils.StretchedKey,
+        old_v1_secret: Optional[bytes],
+        old_keys: KeyCache) -> None:
+    global _OLD_PHRASE, _NEW_PHRASE, _NEW_KEY, _OLD_V1_SECRET
+    _OLD_PHRASE = old_phrase
+    _NEW_PHRASE = new_phrase
+    _NEW_KEY = new_key
+    _OLD_V1_SECRET = old_v1_secret
+    _OLD_KEYS.clear()
+    _OLD_KEYS.update(old_keys)
+    _NEW_KEYS.clear()
+    _NEW_KEYS[(new_key.salt, new_key.iterations)] = new_key
+
+
+def _stretched(
+        phrase: str,
+        envelope: bytes,
+        cache: KeyCache) -> utils.StretchedKey:
+    '''A phrase stretched with an envelope's salt, cached per salt'''
+    (_, _, _, iterations, salt, _, _) = utils.ENVELOPE_HEADER.unpack(
+        envelope[:utils.ENVELOPE_HEADER.size])
+    key = cache.get((salt, iterations))
+    if key is None:
+        key = utils.stretch_phrase(phrase, salt, iterations)
+        cache[(salt, iterations)] = key
+    return key
+
+
+def _envelope_params(filename: str) -> Optional[Tuple[bytes, int]]:
+    '''A v2 file's salt and iterations. None for other files'''
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(utils.ENVELOPE_HEADER.size)
+    except OSError:
+        return None
+    if len(header) < utils.ENVELOPE_HEADER.size \
+            or not utils.is_envelope_v2(header):
+        return None
+    (_, _, _, iterations, salt, _, _) = utils.ENVELOPE_HEADER.unpack(header)
+    return salt, iterations
+
+
+def _stretch(args: Tuple[str, bytes, int]) -> utils.StretchedKey:
+    phrase, salt, iterations = args
+    return utils.stretch_phrase(phrase, salt, iterations)
+
+
+def stretch_old_keys(
+        old_phrase: str,
+        files: Iterable[str],
+        workers: Optional[int] = None) -> KeyCache:
+    '''
+    Stretches the current passphrase once for each distinct salt among
+    the v2 files, spread over worker processes
+
+    Args:
+        old_phrase     (str): the current passphrase
+        files    (list(str)): the files to rekey
+        workers        (int): worker processes. 0 to run in this process
+    Returns:
+        (dict): the stretched keys, by salt and iterations
+    '''
+    params = sorted({p for p in map(_envelope_params, files)
+                     if p is not None})
+    args = [(old_phrase, salt, iterations) for salt, iterations in params]
+    if workers == 0 or len(args) < 2:
+        keys = list(map(_stretch, args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            keys = list(executor.map(_stretch, args))
+    return dict(zip(params, keys))
+
+
+def _decrypt_old(data: bytes) -> bytes:
+    if utils.is_envelope_v2(data):
+        key = _stretched(_OLD_PHRASE, data, _OLD_KEYS)
+        return utils.decode_envelope(data, _OLD_PHRASE, key=key)
+    secret = _OLD_V1_SECRET or utils.v1_secret(_OLD_PHRASE)
+    return cast(bytes, utils.decode_aes(data, _OLD_PHRASE, secret=secret))
+
+
+def _is_new(data: bytes) -> bool:
+    '''
+    Checks whether a file already opens under the new passphrase. Files
+    from an earlier, finished run have a different salt, so this stretches
+    the new passphrase again for them
+    '''
+    if not utils.is_envelope_v2(data):
+        return False
+    try:
+        utils.decode_envelope(
+            data, _NEW_PHRASE, key=_stretched(_NEW_PHRASE, data, _NEW_KEYS))
+        return True
+    except ValueError:
+        return False
+
+
+def _has_new_salt(data: bytes) -> bool:
+    assert _NEW_KEY is not None
+    header = data[:utils.ENVELOPE_HEADER.size]
+    return utils.is_envelope_v2(data) \
+        and utils.ENVELOPE_HEADER.unpack(header)[3:5] \
+        == (_NEW_KEY.iterations, _NEW_KEY.salt)
+
+
+def rekey_file(filename: str) -> Tuple[str, str, str]:
+    '''
+    Rekeys one file in a worker
+
+    Returns:
+        (str, str, str): the filename, the outcome, and an error message
+    '''
+    assert _NEW_KEY is not None
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        # NB: a file this run wrote before being interrupted
+        if _has_new_salt(data) and _is_new(data):
+            return filename, ALREADY_DONE, ''
+        try:
+            plaintext = _decrypt_old(data)
+        except ValueError:
+            if _is_new(data):
+                return filename, ALREADY_DONE, ''
+            raise
+        utils.write_to_file(
+            utils.encode_envelope(plaintext, '', key=_NEW_KEY), filename)
+        return filename, REKEYED, ''
+    except Exception as e:
+        return filename, FAILED, repr(e)
+
+
+def is_v1_file(data: bytes, old_v1_secret: bytes) -> bool:
+    '''
+    Checks whether data is a v1 file under the current passphrase. v1
+    has no marker, so it must decrypt, and the plaintext must be JSON
+    '''
+    # NB: iv (16), encrypted key (48), then whole AES blocks
+    if len(data) < 80 or (len(data) - 64) % 16 != 0:
+        return False
+    try:
+        plaintext = utils.decode_aes(data, '', secret=old_v1_secret)
+        json.loads(plaintext.decode('utf-8'))
+    except ValueError:
+        return False
+    return True
+
+
+def find_encrypted(
+        root: str,
+        old_v1_secret: Optional[bytes] = None) -> List[str]:
+    '''
+    Finds the v2 envelopes under a directory, and the v1 files if given
+    the current passphrase's v1 secret. Only files with one of
+    ENCRYPTED_SUFFIXES are opened
+    '''
+    found = []
+    prefix_size = len(utils.ENVELOPE_MAGIC) + 1
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(ENCRYPTED_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                with open(path, 'rb') as f:
+                    if utils.is_envelope_v2(f.read(prefix_size)):
+                        found.append(path)
+                    elif old_v1_secret is not None:
+                        f.seek(0)
+                        if is_v1_file(f.read(), old_v1_secret):
+                            found.append(path)
+            except OSError:
+                continue
+    return sorted(found)
+
+
+class Journal:
+    '''
+    Records the new key's parameters and each finished file, so that an
+    interrupted rekey can resume with the same new key
+
+    Args:
+        path (str): the journal file
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.salt: Optional[bytes] = None
+        self.iterations: Optional[int] = None
+        self.done: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # NB: a line cut short by a crash
+                    if 'salt' in entry:
+                        self.salt = bytes.fromhex(entry['salt'])
+                        self.iterations = entry['iterations']
+                    else:
+                        self.done.add(entry['done'])
+        self._file = open(path, 'a')
+
+    def start(self, key: utils.StretchedKey) -> None:
+        self._append({'salt': key.salt.hex(), 'iterations': key.iterations})
+
+    def finish(self, filename: str) -> None:
+        self._append({'done': filename})
+
+    def _append(self, entry: dict) -> None:
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self, remove: bool = False) -> None:
+        self._file.close()
+        if remove:
+            os.remove(self.path)
+
+
+def rekey(
+        old_phrase: str,
+        new_phrase: str,
+        files: Iterable[str],
+        journal_path: str,
+        workers: Optional[int] = None,
+        old_v1_secret: Optional[bytes] = None) -> Dict[str, List[str]]:
+    '''
+    Rekeys files concurrently, resuming from a journal if one exists
+
+    Args:
+        old_phrase     (str): the current passphrase
+        new_phrase     (str): the new passphrase
+        files    (list(str)): the files to rekey
+        journal_path   (str): where to record progress
+        workers        (int): worker processes. 0 to run in this process
+        old_v1_secret (bytes): the current passphrase stretched by
+                               utils.v1_secret. stretched here if needed
+    Returns:
+        (dict): the filenames with each outcome. FAILED maps to messages
+    '''
+    journal = Journal(journal_path)
+    if journal.salt is not None and journal.iterations is not None:
+        new_key = utils.stretch_phrase(
+            new_phrase, journal.salt, journal.iterations)
+    else:
+        new_key = utils.stretch_phrase(new_phrase)
+        journal.start(new_key)
+
+    todo = [f for f in files if f not in journal.done]
+    # NB: only stretch the v1 secret if some file needs it
+    for filename in todo:
+        if old_v1_secret is not None:
+            break
+        with open(filename, 'rb') as f:
+            if not utils.is_envelope_v2(f.read(len(utils.ENVELOPE_MAGIC) + 1)):
+                old_v1_secret = utils.v1_secret(old_phrase)
+                break
+
+    old_keys = stretch_old_keys(old_phrase, todo, workers)
+
+    results: Dict[str, List[str]] = {REKEYED: [], ALREADY_DONE: [], FAILED: []}
+    init_args = (old_phrase, new_phrase, new_key, old_v1_secret, old_keys)
+    if workers == 0:
+        _init_worker(*init_args)
+        outcomes: Iterable[Tuple[str, str, str]] = map(rekey_file, todo)
+        executor: Optional[Executor] = None
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=init_args)
+        outcomes = executor.map(rekey_file, todo, chunksize=16)
+    try:
+        for filename, outcome, error in outcomes:
+            if outcome == FAILED:
+                results[FAILED].append('{}: {}'.format(filename, error))
+            else:
+                results[outcome].append(filename)
+                journal.finish(filename)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        journal.close(remove=not results[FAILED])
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Re-encrypts our files under a new passphrase')
+    parser.add_argument('files', nargs='*',
+                        help='extra files to rekey')
+    parser.add_argument('--root', default=utils.PATH,
+                        help='directory to search for encrypted files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes. 0 to run in-process')
+    args = parser.parse_args()
+
+    old_phrase = os.environ.get(OLD_PASSPHRASE_ENV) \
+        or getpass.getpass('Current passphrase: ')
+    new_phrase = os.environ.get(NEW_PASSPHRASE_ENV) \
+        or getpass.getpass('New passphrase: ')
+
+    old_v1_secret = utils.v1_secret(old_phrase)
+    files = sorted(set(find_encrypted(args.root, old_v1_secret))
+                   | {os.path.abspath(f) for f in args.files})
+    results = rekey(
+        old_phrase=old_phrase,
+        new_phrase=new_phrase,
+        files=files,
+        journal_path=os.path.join(args.root, JOURNAL_NAME),
+        workers=args.workers,
+        old_v1_secret=old_v1_secret)
+
+    print('{} rekeyed, {} already done, {} failed'.format(
+        len(results[REKEYED]), len(results[ALREADY_DONE]),
+        len(results[FAILED])))
+    for failure in results[FAILED]:
+        print('FAILED {}'.format(failure), file=sys.stderr)
+    if results[FAILED]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,4 +10,5 @@ mypy \
     --strict-equality \
     --show-error-codes \
     --warn-return-any \
-    --ignore-missing-imports
+    --ignore-missing-imports && \
+python -m unittest discover -s scripts/tests -t .
@@ -0,0 +1,202 @@
+'''
+Finds fills of our auctions in raw blocks and mempool txns.
+
+Walks serialized bytes through a memoryview, without parsing txns into
+objects. Each input's outpoint is looked up in a set of our auctioned
+outpoints. Only a matching tx is copied, to compute its txid and read
+the bidder's OP_RETURN, exactly as the contract's _extractBidder does.
+Partial txns are signed SIGHASH_SINGLE, so the value paid for a fill is
+the output at the same index as its input.
+
+Malformed or truncated bytes raise ValueError.
+
+Example:
+    scanner = Scanner.from_ledger(ledger)
+    for fill in scanner.scan_block(raw_block):
+        ledger.mark_filled(fill.split_tx_id, fill.output_index, fill.tx_id)
+'''
+import hashlib
+
+import scripts.preflight as preflight
+import scripts.ledger as ledger_db
+
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+HEADER_SIZE = 80
+OUTPOINT_SIZE = 36
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class FillMatch(NamedTuple):
+    '''
+    A tx spending one of our auctioned outpoints. value is that of the
+    output at input_index, or None if there is none. bidder is None when
+    the contract would fall back to the seller
+    '''
+    tx_id: str
+    split_tx_id: str
+    output_index: int
+    input_index: int
+    value: Optional[int]
+    bidder: Optional[str]
+
+
+def outpoint_key(tx_id: str, index: int) -> bytes:
+    '''An outpoint as serialized in an input: LE txid, then LE index'''
+    return bytes.fromhex(tx_id)[::-1] + index.to_bytes(4, 'little')
+
+
+def _varint(view: memoryview, offset: int) -> Tuple[int, int]:
+    '''Reads a varint. Returns its value and the offset after it'''
+    first = view[offset]
+    if first < 0xfd:
+        return first, offset + 1
+    size = 2 if first == 0xfd else 4 if first == 0xfe else 8
+    end = offset + 1 + size
+    return int.from_bytes(view[offset + 1:end], 'little'), end
+
+
+class Scanner:
+    '''
+    Matches txns against a set of outpoints
+
+    Args:
+        outpoints (list(tuple)): the (txid, index) outpoints to watch
+    '''
+
+    def __init__(self, outpoints: Iterable[Tuple[str, int]] = ()) -> None:
+        self.outpoints: Set[bytes] = set()
+        for tx_id, index in outpoints:
+            self.add(tx_id, index)
+
+    @classmethod
+    def from_ledger(cls, ledger: ledger_db.AuctionLedger) -> 'Scanner':
+        '''Watches every open auction in a ledger'''
+        return cls(ledger.open_outpoints())
+
+    def add(self, tx_id: str, index: int) -> None:
+        self.outpoints.add(outpoint_key(tx_id, index))
+
+    def discard(self, tx_id: str, index: int) -> None:
+        self.outpoints.discard(outpoint_key(tx_id, index))
+
+    def scan_block(self, block: Buffer) -> List[FillMatch]:
+        '''Finds the fills in a serialized block'''
+        view = memoryview(block)
+        matches: List[FillMatch] = []
+        try:
+            count, offset = _varint(view, HEADER_SIZE)
+            for _ in range(count):
+                offset = self._scan_tx(view, offset, matches)
+        except IndexError:
+            raise ValueError('Truncated block')
+        if offset != len(view):
+            raise ValueError('Malformed block')
+        return matches
+
+    def scan_tx(self, raw: Buffer) -> List[FillMatch]:
+        '''Finds the fills in a serialized tx, e.g. from the mempool'''
+        view = memoryview(raw)
+        matches: List[FillMatch] = []
+        try:
+            end = self._scan_tx(view, 0, matches)
+        except IndexError:
+            raise ValueError('Truncated tx')
+        if end != len(view):
+            raise ValueError('Malformed tx')
+        return matches
+
+    def _scan_tx(
+            self,
+            view: memoryview,
+            start: int,
+            matches: List[FillMatch]) -> int:
+        '''Scans the tx at start. Returns the offset after it'''
+        outpoints = self.outpoints
+        segwit = view[start + 4] == 0 and view[start + 5] == 1
+        vin_start = start + 6 if segwit else start + 4
+
+        num_ins, offset = _varint(view, vin_start)
+        hits: Optional[List[Tuple[int, bytes]]] = None
+        for i in range(num_ins):
+            if outpoints:
+                outpoint = view[offset:offset + OUTPOINT_SIZE].tobytes()
+                if outpoint in outpoints:
+                    if hits is None:
+                        hits = []
+                    hits.append((i, outpoint))
+            script_len, offset = _varint(view, offset + OUTPOINT_SIZE)
+            offset += script_len + 4
+
+        vout_start = offset
+        num_outs, offset = _varint(view, offset)
+        for _ in range(num_outs):
+            script_len, offset = _varint(view, offset + 8)
+            offset += script_len
+        vout_end = offset
+
+        if segwit:
+            for _ in range(num_ins):
+                items, offset = _varint(view, offset)
+                for _ in range(items):
+                    item_len, offset = _varint(view, offset)
+                    offset += item_len
+        end = offset + 4
+        if end > len(view):
+            raise IndexError('tx runs past the end of the buffer')
+
+        if hits is not None:
+            self._record(view, start, vin_start, vout_start, vout_end, end,
+                         hits, matches)
+        return end
+
+    @staticmethod
+    def _record(
+            view: memoryview,
+            start: int,
+            vin_start: int,
+            vout_start: int,
+            vout_end: int,
+            end: int,
+            hits: List[Tuple[int, bytes]],
+            matches: List[FillMatch]) -> None:
+        '''Reads the txid, value and bidder of a matching tx'''
+        h = hashlib.sha256(view[start:start + 4])
+        h.update(view[vin_start:vout_end])
+        h.update(view[end - 4:end])
+        tx_id = hashlib.sha256(h.digest()).digest()[::-1].hex()
+
+        vout = view[vout_start:vout_end].tobytes()
+        value_offsets = []
+        num_outs, offset = _varint(view, vout_start)
+        for _ in range(num_outs):
+            value_offsets.append(offset)
+            script_len, offset = _varint(view, offset + 8)
+            offset += script_len
+        try:
+            bidder = preflight.extract_bidder(vout)
+        except preflight.Revert:
+            bidder = preflight.ADDR0  # NB: the claim would revert anyway
+        for input_index, outpoint in hits:
+            value = None
+            if input_index < num_outs:
+                o = value_offsets[input_index]
+                value = int.from_bytes(view[o:o + 8], 'little')
+            matches.append(FillMatch(
+                tx_id=tx_id,
+                split_tx_id=outpoint[31::-1].hex(),
+                output_index=int.from_bytes(outpoint[32:], 'little'),
+                input_index=input_index,
+                value=value,
+                bidder=None if bidder == preflight.ADDR0 else bidder))
+
+
+def record_fills(
+        ledger: ledger_db.AuctionLedger,
+        scanner: Scanner,
+        matches: Iterable[FillMatch]) -> None:
+    '''Marks matched auctions filled, and stops watching their outpoints'''
+    for m in matches:
+        ledger.mark_filled(m.split_tx_id, m.output_index, m.tx_id)
+        scanner.discard(m.split_tx_id, m.output_index)
@@ -0,0 +1,596 @@
+'''
+Claims filled auctions on Ethereum, as a long-running service.
+
+Each fill moves through a pipeline of concurrent stages:
+    1. locate: wait for the fill tx to confirm, then fetch it and its proof
+    2. wait: on each new tip, extend a shared header cache, and release
+       fills whose header chain has enough difficulty for the listing
+    3. claim: build the claim calldata, take a nonce and sign
+    4. submit: send the signed tx to Ethereum
+
+Proofs are fetched as soon as the tx confirms. Headers are fetched once
+per tip and shared by every fill. So when a fill reaches its required
+difficulty, only encoding, signing and sending remain.
+
+Run against the ledger, claiming every unclaimed fill. Each fill's
+contract and reqDiff come from its listing, as indexed from the
+contracts' logs:
+    INTEGRAL_ETH_PRIVKEY=... python -m scripts.settlement \\
+        --eth-rpc http://localhost:8545 --contract 0x... --start-nonce 12
+'''
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import functools
+import argparse
+
+import scripts.aio as aio
+import scripts.utils as utils
+import scripts.merkle as merkle
+import scripts.metrics as metrics
+import scripts.indexer as indexer
+import scripts.preflight as preflight
+import scripts.interface_wrapper as iw
+import scripts.ledger as ledger_db
+
+from ether import crypto
+from typing import (cast, Any, Awaitable, Callable, Dict, List,
+                    NamedTuple, Optional, Set, Tuple)
+
+GWEI = 1000000000
+ETH_PRIVKEY_ENV = 'INTEGRAL_ETH_PRIVKEY'
+
+HEADER_SIZE = 80
+MAX_HEADERS_PER_RPC = 2016
+
+MAX_ATTEMPTS = 5
+NO_OP_GAS = 21000       # a plain transfer, sent to fill a nonce gap
+RETRY_DELAY = 2.0       # seconds, doubled after each failed attempt
+POLL_INTERVAL = 30.0    # seconds between tip checks without notifications
+
+# Rejections that mean the node already has the tx
+ALREADY_KNOWN = ('already known', 'known transaction', 'already imported')
+
+# Sends a signed tx hex and returns its hash. Raises indexer.RPCError when
+# the node rejects the tx, and anything else when the outcome is unknown
+EthSender = Callable[[str], Awaitable[str]]
+
+
+def _hash256(data: bytes) -> bytes:
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+class Fill(NamedTuple):
+    '''
+    A bitcoin tx that fills an auction, and the listing it claims. The
+    ledger outpoint is optional, and marked claimed once submitted
+    '''
+    tx_id: str
+    contract_address: str
+    req_diff: int
+    split_tx_id: Optional[str] = None
+    output_index: Optional[int] = None
+
+
+class NonceManager:
+    '''
+    Hands out Ethereum nonces to concurrent claims. A nonce whose tx was
+    never accepted is released, and reused before any new nonce, so that
+    later txns are not stuck behind a gap. Released nonces at the top are
+    simply handed out again, as nothing waits behind them
+
+    Args:
+        next_nonce (int): the account's next unused nonce
+    '''
+
+    def __init__(self, next_nonce: int) -> None:
+        self.next_nonce = next_nonce
+        self._released: Set[int] = set()
+
+    def reserve(self) -> int:
+        if self._released:
+            nonce = min(self._released)
+            self._released.remove(nonce)
+            return nonce
+        nonce = self.next_nonce
+        self.next_nonce += 1
+        return nonce
+
+    def release(self, nonce: int) -> None:
+        self._released.add(nonce)
+        while self.next_nonce - 1 in self._released:
+            self.next_nonce -= 1
+            self._released.remove(self.next_nonce)
+
+    def take_gaps(self) -> List[int]:
+        '''Reserves every released nonce that later nonces are behind'''
+        gaps = sorted(self._released)
+        self._released.clear()
+        return gaps
+
+
+class HeaderCache:
+    '''Raw headers by height, shared by every waiting fill'''
+
+    def __init__(self) -> None:
+        self.headers: Dict[int, bytes] = {}
+
+    async def _fetch_missing(self, start: int, end: int) -> None:
+        height = start
+        while height <= end:
+            if height in self.headers:
+                height += 1
+                continue
+            count = min(end - height + 1, MAX_HEADERS_PER_RPC)
+            chain = await merkle.get_header_chain_bytes(height, count)
+            for i in range(len(chain) // HEADER_SIZE):
+                self.headers[height + i] = \
+                    chain[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]
+            height += max(1, len(chain) // HEADER_SIZE)
+
+    def _broken_link(self, start: int, end: int) -> Optional[int]:
+        '''The lowest height whose header does not link to the one below'''
+        for height in range(start + 1, end + 1):
+            header = self.headers.get(height)
+            prev = self.headers.get(height - 1)
+            if header is not None and prev is not None \
+                    and header[4:36] != _hash256(prev):
+                return height
+        return None
+
+    async def fetch(self, start: int, end: int) -> None:
+        '''
+        Fetches any missing headers from start to end, inclusive. After a
+        reorg, old headers are refetched back to the fork point
+        '''
+        await self._fetch_missing(start, end)
+        # NB: each pass moves the break down by at least one header
+        for _ in range(end - start):
+            broken = self._broken_link(start, end)
+            if broken is None:
+                return
+            self.drop_from(broken - 1)
+            await self._fetch_missing(start, end)
+
+    def chain(self, start: int, end: int) -> Optional[bytes]:
+        '''
+        The headers from start to end, if all are cached and link up.
+        On a broken link, the header below it may be stale too, so both
+        are dropped, to be fetched again
+        '''
+        headers: List[bytes] = []
+        for height in range(start, end + 1):
+            header = self.headers.get(height)
+            if header is None:
+                return None
+            if headers and header[4:36] != _hash256(headers[-1]):
+                self.drop_from(height - 1)
+                return None
+            headers.append(header)
+        return b''.join(headers)
+
+    def drop_from(self, height: int) -> None:
+        for h in [h for h in self.headers if h >= height]:
+            del self.headers[h]
+
+    def prune(self, below: int) -> None:
+        for h in [h for h in self.headers if h < below]:
+            del self.headers[h]
+
+
+class _Pending:
+    '''A fill's progress through the pipeline'''
+
+    def __init__(self, fill: Fill, future: 'asyncio.Future[str]') -> None:
+        self.fill = fill
+        self.future = future
+        self.args: Optional[merkle.ClaimArgs] = None
+        self.height = 0
+        self.attempts = 0
+        self.ready_at = 0.0
+
+
+def _is_confirmed(tx_json: dict) -> bool:
+    # NB: mempool txns carry no confirmations
+    return cast(int, tx_json.get('confirmations', 0)) > 0
+
+
+def _claim_headers(headers: bytes, req_diff: int) -> Optional[bytes]:
+    '''The shortest prefix of a header chain with enough difficulty'''
+    total = 0
+    for i in range(len(headers) // HEADER_SIZE):
+        total += preflight.header_difficulty(headers[i * HEADER_SIZE:])
+        if total >= req_diff:
+            return headers[:(i + 1) * HEADER_SIZE]
+    return None
+
+
+def json_rpc_sender(url: str) -> EthSender:
+    '''Makes an EthSender that calls eth_sendRawTransaction on a node'''
+    rpc = indexer.JsonRpc(url)
+
+    async def send(signed_hex: str) -> str:
+        loop = asyncio.get_event_loop()
+        return str(await loop.run_in_executor(
+            None, rpc.call, 'eth_sendRawTransaction', ['0x' + signed_hex]))
+
+    return send
+
+
+class Settler:
+    '''
+    Claims fills on Ethereum as soon as their header chains allow
+
+    Args:
+        eth_privkey              (str): the claiming account's privkey as hex
+        start_nonce              (int): the account's next unused nonce
+        eth_send   (coroutine function): sends a signed tx hex, returns its
+                                         hash. see EthSender
+        network_id               (int): ethereum network id
+        gas_price                (int): gas price in wei
+        signer            (aio.Signer): signs off the event loop
+        ledger         (AuctionLedger): marks fills claimed once submitted
+        locate_workers           (int): fills located at once
+        claim_workers            (int): claims built and signed at once
+    '''
+
+    def __init__(
+            self,
+            eth_privkey: str,
+            start_nonce: int,
+            eth_send: EthSender,
+            network_id: int = 1,
+            gas_price: int = 15 * GWEI,
+            signer: Optional[aio.Signer] = None,
+            ledger: Optional[ledger_db.AuctionLedger] = None,
+            locate_workers: int = 8,
+            claim_workers: int = 4) -> None:
+        self.eth_privkey = eth_privkey
+        self.eth_send = eth_send
+        self.network_id = network_id
+        self.gas_price = gas_price
+        self.signer = signer or aio.Signer()
+        self.ledger = ledger
+        self.locate_workers = locate_workers
+        self.claim_workers = claim_workers
+        self.nonces = NonceManager(start_nonce)
+        self.headers = HeaderCache()
+        self.tip = 0
+        self.waiting: Dict[str, _Pending] = {}
+        self._intake: Optional['asyncio.Queue[_Pending]'] = None
+        self._claims: 'asyncio.Queue[_Pending]'
+        self._signed: 'asyncio.Queue[Tuple[_Pending, int, str]]'
+        self._tip_changed: Optional[asyncio.Event] = None
+        self._check_lock: Optional[asyncio.Lock] = None
+
+    def _make_queues(self) -> 'asyncio.Queue[_Pending]':
+        # NB: made lazily, so that they bind to the running loop
+        if self._intake is None:
+            self._intake = asyncio.Queue()
+            self._claims = asyncio.Queue()
+            self._signed = asyncio.Queue()
+        return self._intake
+
+    def submit(self, fill: Fill) -> 'asyncio.Future[str]':
+        '''
+        Queues a fill to be claimed
+
+        Returns:
+            (asyncio.Future): resolves to the claim tx hash once submitted
+        '''
+        future = asyncio.get_event_loop().create_future()
+        self._make_queues().put_nowait(_Pending(fill, future))
+        metrics.incr('settlement_fills')
+        return future
+
+    async def run(self) -> None:
+        '''Runs every stage until cancelled'''
+        self._tip_changed = asyncio.Event()
+        self._check_lock = asyncio.Lock()
+        self._make_queues()
+        self.tip, tips = await merkle.subscribe_headers()
+        workers = [self._watch_tips(tips)]
+        workers += [self._locate() for _ in range(self.locate_workers)]
+        workers += [self._claim() for _ in range(self.claim_workers)]
+        workers.append(self._submit())
+        tasks = [asyncio.ensure_future(w) for w in workers]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def _next_tip(self) -> None:
+        assert self._tip_changed is not None
+        await self._tip_changed.wait()
+
+    async def _watch_tips(self, tips: 'asyncio.Queue[Any]') -> None:
+        assert self._tip_changed is not None
+        while True:
+            try:
+                notification = await asyncio.wait_for(
+                    tips.get(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            header = notification[0] \
+                if isinstance(notification, list) else notification
+            if header['height'] <= self.tip:
+                # NB: a reorg at the same height. refetch the new headers
+                self.headers.drop_from(header['height'])
+            self.tip = header['height']
+            # NB: wake everything waiting on this tip, then arm the next
+            self._tip_changed.set()
+            self._tip_changed = asyncio.Event()
+            await self._check_waiting()
+
+    async def _locate(self) -> None:
+        intake = self._make_queues()
+        while True:
+            pending = await intake.get()
+            try:
+                await self._locate_one(pending)
+            except Exception as e:
+                self._fail(pending, e)
+
+    async def _locate_one(self, pending: _Pending) -> None:
+        tx_id = pending.fill.tx_id
+        while True:
+            tx_json, t = await merkle.get_tx_from_api(tx_id)
+            if _is_confirmed(tx_json):
+                break
+            await self._next_tip()
+        pending.height = tx_json['block_height']
+        proof, index = await merkle.get_merkle_proof_bytes(
+            t.tx_id.hex(), pending.height)
+        pending.args = merkle.ClaimArgs(t.to_bytes(), proof, index, b'')
+        self.waiting[tx_id] = pending
+        await self._check_waiting()
+
+    async def _check_waiting(self) -> None:
+        '''Releases the waiting fills whose header chains are now enough'''
+        assert self._check_lock is not None
+        async with self._check_lock:
+            if not self.waiting:
+                return
+            lowest = min(p.height for p in self.waiting.values())
+            self.headers.prune(lowest)
+            await self.headers.fetch(lowest, self.tip)
+            for tx_id, pending in list(self.waiting.items()):
+                assert pending.args is not None
+                chain = self.headers.chain(pending.height, self.tip)
+                if chain is None:
+                    continue
+                if chain[36:68] != pending.args.proof[-32:]:
+                    # NB: the tx's block was reorged out. locate it again
+                    del self.waiting[tx_id]
+                    self._make_queues().put_nowait(pending)
+                    continue
+                headers = _claim_headers(chain, pending.fill.req_diff)
+                if headers is None:
+                    continue
+                del self.waiting[tx_id]
+                pending.args = pending.args._replace(headers=headers)
+                pending.ready_at = time.monotonic()
+                self._claims.put_nowait(pending)
+
+    async def _claim(self) -> None:
+        while True:
+            pending = await self._claims.get()
+            assert pending.args is not None
+            nonce = self.nonces.reserve()
+            try:
+                unsigned = iw.create_claim_tx(
+                    *pending.args,
+                    contract_address=pending.fill.contract_address,
+                    value=0,
+                    nonce=nonce,
+                    gas_price=self.gas_price,
+                    network_id=self.network_id)
+                (signed_hex,) = await self.signer.sign_eth_txns(
+                    [unsigned], self.eth_privkey)
+            except Exception as e:
+                self.nonces.release(nonce)
+                self._fail(pending, e)
+                continue
+            self._signed.put_nowait((pending, nonce, signed_hex))
+
+    async def _submit(self) -> None:
+        while True:
+            pending, nonce, signed_hex = await self._signed.get()
+            try:
+                tx_hash = await self.eth_send(signed_hex)
+            except indexer.RPCError as e:
+                if any(m in str(e).lower() for m in ALREADY_KNOWN):
+                    tx_hash = '0x' + utils.keccak256(
+                        bytes.fromhex(signed_hex)).hex()
+                else:
+                    # NB: a definite rejection, so the nonce is unused
+                    self.nonces.release(nonce)
+                    asyncio.ensure_future(self._retry(pending, e))
+                    continue
+            except Exception as e:
+                # NB: e.g. a timeout. the node may have the tx, so keep its
+                #     nonce and send the same tx again
+                asyncio.ensure_future(
+                    self._resend(pending, nonce, signed_hex, e))
+                continue
+            metrics.observe('settlement_latency',
+                            time.monotonic() - pending.ready_at)
+            fill = pending.fill
+            if self.ledger is not None and fill.split_tx_id is not None \
+                    and fill.output_index is not None:
+                self.ledger.mark_claimed(
+                    fill.split_tx_id, fill.output_index, tx_hash)
+            if not pending.future.done():
+                pending.future.set_result(tx_hash)
+
+    async def _retry(self, pending: _Pending, e: Exception) -> None:
+        pending.attempts += 1
+        if pending.attempts >= MAX_ATTEMPTS:
+            self._fail(pending, e)
+            if self._claims.empty():
+                # NB: no claim will take the released nonce soon, and later
+                #     nonces may already be sent. fill the gap with a no-op
+                await self._fill_gaps()
+            return
+        metrics.incr('settlement_retries')
+        await asyncio.sleep(RETRY_DELAY * 2 ** (pending.attempts - 1))
+        self._claims.put_nowait(pending)
+
+    async def _fill_gaps(self) -> None:
+        '''Sends a 0-value tx to ourselves at each gap in the nonces'''
+        address = crypto.priv_to_addr(bytes.fromhex(self.eth_privkey))
+        for nonce in self.nonces.take_gaps():
+            try:
+                unsigned = iw.create_unsigned_tx(
+                    contract_address=address,
+                    start_gas=NO_OP_GAS,
+                    gas_price=self.gas_price,
+                    nonce=nonce,
+                    network_id=self.network_id)
+                (signed_hex,) = await self.signer.sign_eth_txns(
+                    [unsigned], self.eth_privkey)
+                await self.eth_send(signed_hex)
+            except indexer.RPCError as e:
+                if not any(m in str(e).lower() for m in ALREADY_KNOWN):
+                    # NB: left for the next claim to take
+                    self.nonces.release(nonce)
+                continue
+            except Exception:
+                # NB: the node may have the tx, so its nonce stays reserved
+                continue
+            metrics.incr('settlement_gap_fills')
+
+    async def _resend(
+            self,
+            pending: _Pending,
+            nonce: int,
+            signed_hex: str,
+            e: Exception) -> None:
+        pending.attempts += 1
+        if pending.attempts >= MAX_ATTEMPTS:
+            # NB: never released, as the tx may yet be mined
+            self._fail(pending, e)
+            return
+        metrics.incr('settlement_retries')
+        await asyncio.sleep(RETRY_DELAY * 2 ** (pending.attempts - 1))
+        self._signed.put_nowait((pending, nonce, signed_hex))
+
+    def _fail(self, pending: _Pending, e: Exception) -> None:
+        metrics.incr('settlement_failures')
+        if not pending.future.done():
+            pending.future.set_exception(e)
+
+
+def ledger_fill(
+        ix: indexer.Indexer,
+        record: ledger_db.AuctionRecord,
+        default_req_diff: Optional[int] = None) -> Optional[Fill]:
+    '''
+    Makes a fill from a ledger record, finding its listing's contract and
+    reqDiff in the indexer. None if no active listing is indexed for it
+
+    Args:
+        ix             (Indexer): a synced index of the swap contracts
+        record   (AuctionRecord): a filled auction
+        default_req_diff   (int): for listings whose events carry none
+    '''
+    outpoint = bytes.fromhex(record.split_tx_id)[::-1] \
+        + record.output_index.to_bytes(4, 'little')
+    lid = '0x' + utils.keccak256(outpoint).hex()
+    for listing in ix.find(lid):
+        if listing.status != indexer.ACTIVE:
+            continue
+        req_diff = listing.req_diff
+        if req_diff is None:
+            req_diff = default_req_diff
+        if req_diff is None or record.fill_tx_id is None:
+            return None
+        return Fill(record.fill_tx_id, listing.contract, req_diff,
+                    record.split_tx_id, record.output_index)
+    return None
+
+
+async def settle_ledger(
+        settler: Settler,
+        ledger: ledger_db.AuctionLedger,
+        ix: indexer.Indexer,
+        contracts: List[str],
+        default_req_diff: Optional[int] = None,
+        poll_interval: float = POLL_INTERVAL) -> None:
+    '''
+    Submits the ledger's unclaimed fills to a settler, as they appear.
+    Each is claimed on the contract that lists it, with that listing's
+    reqDiff, as indexed from the contracts' logs
+    '''
+    seen: Set[str] = set()
+
+    def report(fill: Fill, future: 'asyncio.Future[str]') -> None:
+        if future.exception() is not None:
+            seen.discard(fill.tx_id)  # NB: try again on the next poll
+            print('FAILED {}: {!r}'.format(fill.tx_id, future.exception()),
+                  file=sys.stderr)
+        else:
+            print('claimed {} in {}'.format(fill.tx_id, future.result()))
+
+    while True:
+        # NB: blocks the loop briefly. the index's connection is not
+        #     shared across threads
+        ix.sync(contracts)
+        for record in ledger.unclaimed_fills():
+            if record.fill_tx_id is None or record.fill_tx_id in seen:
+                continue
+            fill = ledger_fill(ix, record, default_req_diff)
+            if fill is None:
+                continue  # NB: not indexed yet. look again next poll
+            seen.add(record.fill_tx_id)
+            settler.submit(fill).add_done_callback(
+                functools.partial(report, fill))
+        await asyncio.sleep(poll_interval)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Claims the ledger\'s filled auctions on Ethereum')
+    parser.add_argument('--eth-rpc', required=True)
+    parser.add_argument('--contract', action='append', required=True,
+                        help='a swap contract to index listings of. '
+                             'may repeat')
+    parser.add_argument('--from-block', type=int, default=0,
+                        help='where to start indexing new contracts')
+    parser.add_argument('--index-db', default=indexer.INDEX_PATH)
+    parser.add_argument('--req-diff', type=int,
+                        help='for listings whose events carry no reqDiff')
+    parser.add_argument('--start-nonce', type=int, required=True)
+    parser.add_argument('--network-id', type=int, default=1)
+    parser.add_argument('--gas-price', type=int, default=15 * GWEI)
+    args = parser.parse_args()
+
+    eth_privkey = os.environ.get(ETH_PRIVKEY_ENV)
+    if not eth_privkey:
+        sys.exit('Set {} to the claiming account\'s privkey'.format(
+            ETH_PRIVKEY_ENV))
+    ledger = ledger_db.AuctionLedger()
+    ix = indexer.Indexer(indexer.JsonRpc(args.eth_rpc), args.index_db)
+    ix.sync(args.contract, from_block=args.from_block)
+    settler = Settler(
+        eth_privkey=eth_privkey,
+        start_nonce=args.start_nonce,
+        eth_send=json_rpc_sender(args.eth_rpc),
+        network_id=args.network_id,
+        gas_price=args.gas_price,
+        ledger=ledger)
+
+    async def serve() -> List[Any]:
+        return list(await asyncio.gather(
+            settler.run(),
+            settle_ledger(settler, ledger, ix, args.contract,
+                          args.req_diff)))
+
+    asyncio.get_event_loop().run_until_complete(serve())
+
+
+if __name__ == '__main__':
+    main()
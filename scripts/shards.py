@@ -0,0 +1,540 @@
+'''
+Splits a large auction job across hosts, and merges the results.
+
+A job lists root prevouts. Each root is split into auctions by
+make_several_auctions, and each auction gets one Ethereum open tx. plan
+assigns every root a fixed Ethereum nonce range, and gives each shard a
+contiguous run of roots. So shards share no outpoints and no nonces, and
+each host needs only its shard's roots, its keys and a local artifact
+cache. Rerunning a shard re-signs only what is missing from its cache.
+
+A root may instead be a split tree leaf, marked "leaf": true. Leaves
+are auctioned as they are, one auction each. To spread one large
+funding prevout over many hosts, make its tree once with
+utxo_setup.make_and_sign_split_tree, list the leaves as roots, and
+broadcast the tree before the opens.
+
+merge checks the shard outputs against the manifest before combining
+them. Every root must appear exactly once. Each split tx must spend its
+root, and each auction its own split output, or its leaf. Each signed
+open must carry its auction's calldata, and exactly the planned nonce,
+so there are no gaps and no overlaps. Every open must be signed by the
+same account, as nonces are per account.
+
+Job file:
+    {
+        "job_id": "<name>",
+        "contract_address": "0x...",
+        "recipient": "<bitcoin address>",
+        "format": [[<value>, <lock_time>], ...],
+        "req_diff": <int>,
+        "eth_value": <int>,
+        "start_nonce": <int>,
+        "network_id": 1,                                    (optional)
+        "feerate": <sat/vbyte>,                             (optional)
+        "roots": [{"tx_id": "<txid>", "index": <int>, "value": <int>,
+                   "control_addr": "<address>", "key": "<keyring name>",
+                   "num_auctions": <int>}, ...]
+    }
+
+A leaf root:
+    {"tx_id": "<txid>", "index": <int>, "value": <int>,
+     "key": "<keyring name>", "leaf": true}
+
+Usage:
+    python -m scripts.shards plan job.json --shards 4 -o manifest.json
+    python -m scripts.shards run manifest.json --shard 0 \\
+        --keyring keys.enc -o shard-0.json
+    python -m scripts.shards merge manifest.json shard-*.json -o merged.json
+
+Or try it on one box, with a process standing in for each host:
+    python -m scripts.shards simulate manifest.json --keyring keys.enc \\
+        --out-dir shards/
+'''
+import os
+import sys
+import json
+import getpass
+import hashlib
+import argparse
+
+import scripts.gas as gas
+import scripts.bulk as bulk
+import scripts.fees as fees
+import scripts.utils as utils
+import scripts.preflight as preflight
+import scripts.artifact_cache as ac
+
+from ether import transactions
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+MANIFEST_VERSION = 1
+ETH_PRIVKEY_ENV = 'INTEGRAL_ETH_PRIVKEY'
+
+Manifest = Dict[str, Any]
+ShardOutput = Dict[str, Any]
+
+
+class ShardError(Exception):
+    '''Shard outputs that do not merge into one consistent result'''
+
+    @property
+    def problems(self) -> List[str]:
+        return list(self.args[0])
+
+
+def manifest_hash(manifest: Manifest) -> str:
+    return hashlib.sha256(json.dumps(
+        manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def plan(job: Dict[str, Any], num_shards: int) -> Manifest:
+    '''
+    Assigns nonce ranges to roots, and contiguous runs of roots to shards,
+    balancing the number of auctions in each shard
+
+    Args:
+        job          (dict): the job, as described above
+        num_shards    (int): how many shards to make. fewer if there are
+                             fewer roots
+    Returns:
+        (dict): the manifest, i.e. the job plus its nonces and shards
+    '''
+    roots = [dict(r, num_auctions=1) if r.get('leaf') else r
+             for r in job['roots']]
+    if not roots:
+        raise ValueError('Job has no roots')
+    outpoints = [(r['tx_id'], r['index']) for r in roots]
+    if len(set(outpoints)) != len(outpoints):
+        raise ValueError('Job spends a root outpoint twice')
+    for i, r in enumerate(roots):
+        if r['num_auctions'] < 1:
+            raise ValueError('Root {} has no auctions'.format(i))
+
+    manifest = dict(job)
+    manifest['version'] = MANIFEST_VERSION
+    nonce = job['start_nonce']
+    manifest['roots'] = []
+    for r in roots:
+        manifest['roots'].append(dict(r, nonces=[nonce,
+                                                 nonce + r['num_auctions']]))
+        nonce += r['num_auctions']
+
+    total = nonce - job['start_nonce']
+    num_shards = max(1, min(num_shards, len(roots)))
+    cuts = [0]
+    done = 0
+    for i, r in enumerate(roots):
+        if len(cuts) == num_shards:
+            break
+        done += r['num_auctions']
+        left = len(roots) - i - 1
+        # NB: cut once this shard has its share, leaving a root per shard
+        if (done >= total * len(cuts) / num_shards
+                and left >= num_shards - len(cuts)) \
+                or left == num_shards - len(cuts):
+            cuts.append(i + 1)
+    # NB: the last shard always runs to the end
+    cuts.append(len(roots))
+    manifest['shards'] = [_shard(manifest, k, cuts[k], cuts[k + 1])
+                          for k in range(num_shards)]
+    return manifest
+
+
+def _shard(manifest: Manifest, shard_id: int, start: int, end: int
+           ) -> Dict[str, Any]:
+    return {
+        'shard': shard_id,
+        'roots': [start, end],
+        'nonces': [manifest['roots'][start]['nonces'][0],
+                   manifest['roots'][end - 1]['nonces'][1]]}
+
+
+def run_shard(
+        manifest: Manifest,
+        shard_id: int,
+        keyring: bulk.Keyring,
+        eth_privkey: str,
+        cache_dir: Optional[str] = None) -> ShardOutput:
+    '''
+    Builds and signs one shard's auctions, using only local state
+
+    Args:
+        manifest     (dict): the manifest from plan
+        shard_id      (int): the shard to run
+        keyring      (dict): key names mapped to keypairs
+        eth_privkey   (str): the Ethereum account that opens the auctions
+        cache_dir     (str): the artifact cache. ac.CACHE_PATH if None
+    Returns:
+        (dict): the shard output, for merge
+    '''
+    # NB: imported here, as it needs the contract build
+    import scripts.eth_auction_setup as eas
+
+    shard = manifest['shards'][shard_id]
+    cache = ac.ArtifactCache(cache_dir or ac.CACHE_PATH)
+    form = [(f[0], f[1]) for f in manifest['format']]
+    results = []
+    start, end = shard['roots']
+    for i in range(start, end):
+        root = manifest['roots'][i]
+        if root.get('leaf'):
+            _, open_data, eth_txns = eas.make_auctions(
+                prevouts=[(root['tx_id'], root['index'], root['value'])],
+                auction_keys=keyring[root['key']],
+                start_nonce=root['nonces'][0],
+                contract_address=manifest['contract_address'],
+                reqDiff=manifest['req_diff'],
+                eth_value=manifest['eth_value'],
+                eth_privkey=eth_privkey,
+                recipient=manifest['recipient'],
+                form=form,
+                network_id=manifest.get('network_id', 1),
+                cache=cache)
+            results.append({
+                'root': i,
+                'split_tx': None,
+                'open_data': open_data,
+                'eth_txns': eth_txns,
+                'nonces': root['nonces']})
+            continue
+        split_tx, open_data, eth_txns = eas.make_several_auctions(
+            tx_id=root['tx_id'],
+            index=root['index'],
+            control_addr=root['control_addr'],
+            control_addr_keypair=keyring[root['key']],
+            prevout_value=root['value'],
+            start_nonce=root['nonces'][0],
+            contract_address=manifest['contract_address'],
+            reqDiff=manifest['req_diff'],
+            eth_value=manifest['eth_value'],
+            eth_privkey=eth_privkey,
+            num_auctions=root['num_auctions'],
+            recipient=manifest['recipient'],
+            form=form,
+            network_id=manifest.get('network_id', 1),
+            feerate=manifest.get('feerate', fees.DEFAULT_FEERATE),
+            cache=cache)
+        results.append({
+            'root': i,
+            'split_tx': split_tx.hex(),
+            'open_data': open_data,
+            'eth_txns': eth_txns,
+            'nonces': root['nonces']})
+    return {
+        'job_id': manifest['job_id'],
+        'manifest_hash': manifest_hash(manifest),
+        'shard': shard_id,
+        'results': results}
+
+
+def _rlp_item(raw: bytes, offset: int) -> Tuple[bytes, int]:
+    '''Reads an RLP string. Returns it and the offset after it'''
+    prefix = raw[offset]
+    if prefix < 0x80:
+        return raw[offset:offset + 1], offset + 1
+    if prefix < 0xb8:
+        start, length = offset + 1, prefix - 0x80
+    elif prefix < 0xc0:
+        start = offset + 1 + prefix - 0xb7
+        length = int.from_bytes(raw[offset + 1:start], 'big')
+    else:
+        raise ValueError('Unexpected nested RLP list')
+    if start + length > len(raw):
+        raise ValueError('Truncated RLP string')
+    return raw[start:start + length], start + length
+
+
+def _eth_fields(raw: bytes) -> List[bytes]:
+    '''
+    The fields of a signed legacy tx: nonce, gas price, gas limit, to,
+    value, data, v, r and s
+    '''
+    if raw[0] < 0xc0:
+        raise ValueError('Not an RLP list')
+    offset = 1 if raw[0] <= 0xf7 else 1 + raw[0] - 0xf7
+    fields = []
+    while offset < len(raw):
+        field, offset = _rlp_item(raw, offset)
+        fields.append(field)
+    if len(fields) != 9:
+        raise ValueError('Expected 9 fields, got {}'.format(len(fields)))
+    return fields
+
+
+def _tx_id(raw: bytes) -> bytes:
+    '''A tx's txid, little-endian, from its witness-stripped parts'''
+    version, vin, vout, locktime = preflight.split_tx(raw)
+    h = hashlib.sha256(version + vin + vout + locktime).digest()
+    return hashlib.sha256(h).digest()
+
+
+def _spends(raw: bytes) -> Optional[bytes]:
+    '''The outpoint a tx's first input spends. None if it does not parse'''
+    try:
+        (_, vin, _, _) = preflight.split_tx(raw)
+    except (ValueError, IndexError):
+        return None
+    return vin[1:37]
+
+
+def verify(manifest: Manifest, outputs: Sequence[ShardOutput]) -> List[str]:
+    '''
+    Checks shard outputs against a manifest
+
+    Returns:
+        (list(str)): the problems found. empty if the outputs merge
+    '''
+    problems = []
+    num_roots = len(manifest['roots'])
+    covered = 0
+    for shard_id, shard in enumerate(manifest['shards']):
+        if shard['roots'][0] != covered:
+            problems.append('shard {} starts at root {}, not {}'.format(
+                shard_id, shard['roots'][0], covered))
+        covered = shard['roots'][1]
+    if covered != num_roots:
+        problems.append('shards end at root {} of {}'.format(
+            covered, num_roots))
+
+    expected_hash = manifest_hash(manifest)
+    seen_shards: Set[int] = set()
+    seen_roots: Dict[int, Dict[str, Any]] = {}
+    for out in outputs:
+        shard_id = out['shard']
+        if out['manifest_hash'] != expected_hash:
+            problems.append('shard {} is from another manifest'.format(
+                shard_id))
+            continue
+        if shard_id in seen_shards:
+            problems.append('shard {} appears twice'.format(shard_id))
+            continue
+        if not 0 <= shard_id < len(manifest['shards']):
+            problems.append('shard {} is not in the manifest'.format(
+                shard_id))
+            continue
+        seen_shards.add(shard_id)
+        start, end = manifest['shards'][shard_id]['roots']
+        got = sorted(r['root'] for r in out['results'])
+        if got != list(range(start, end)):
+            problems.append('shard {} has roots {}, expected {}-{}'.format(
+                shard_id, got, start, end - 1))
+        for r in out['results']:
+            seen_roots.setdefault(r['root'], r)
+    for shard_id in range(len(manifest['shards'])):
+        if shard_id not in seen_shards:
+            problems.append('shard {} is missing'.format(shard_id))
+    unseen = sorted(set(range(num_roots)) - set(seen_roots))
+    if unseen and len(seen_shards) == len(manifest['shards']):
+        problems.append('roots {} are in no shard output'.format(unseen))
+
+    contract = bytes.fromhex(manifest['contract_address'][2:])
+
+    spent: Set[bytes] = set()
+    nonces: Set[int] = set()
+    sender: Optional[str] = None
+    for i, r in sorted(seen_roots.items()):
+        root = manifest['roots'][i]
+        n = root['num_auctions']
+        if len(r['open_data']) != n or len(r['eth_txns']) != n:
+            problems.append('root {} has the wrong number of auctions'.format(
+                i))
+            continue
+
+        root_outpoint = bytes.fromhex(root['tx_id'])[::-1] \
+            + root['index'].to_bytes(4, 'little')
+        if root.get('leaf'):
+            # NB: the leaf is the auction outpoint, checked below
+            auction_outpoints = [root_outpoint]
+        else:
+            if root_outpoint in spent:
+                problems.append('root {} outpoint is spent twice'.format(i))
+            spent.add(root_outpoint)
+            split_tx = bytes.fromhex(r['split_tx'])
+            if _spends(split_tx) != root_outpoint:
+                problems.append('root {} split tx does not spend it'.format(
+                    i))
+            split_tx_id = _tx_id(split_tx)
+            auction_outpoints = [split_tx_id + j.to_bytes(4, 'little')
+                                 for j in range(n)]
+
+        for j, (data, outpoint) in enumerate(
+                zip(r['open_data'], auction_outpoints)):
+            if _spends(gas.bytes_arg(bytes.fromhex(data), 0)) != outpoint:
+                problems.append('root {} auction {} spends the wrong '
+                                'outpoint'.format(i, j))
+            if outpoint in spent:
+                problems.append('root {} auction {} outpoint is spent '
+                                'twice'.format(i, j))
+            spent.add(outpoint)
+
+        for j, (signed, data) in enumerate(
+                zip(r['eth_txns'], r['open_data'])):
+            try:
+                fields = _eth_fields(bytes.fromhex(signed))
+            except (ValueError, IndexError) as e:
+                problems.append('root {} eth tx {} does not parse: {}'.format(
+                    i, j, e))
+                continue
+            value = int.from_bytes(fields[4], 'big')
+            if fields[3] != contract or value != manifest['eth_value']:
+                problems.append('root {} eth tx {} pays the wrong contract '
+                                'or value'.format(i, j))
+            if fields[5] != bytes.fromhex(data):
+                problems.append('root {} eth tx {} calldata is not its open '
+                                'data'.format(i, j))
+            nonce = int.from_bytes(fields[0], 'big')
+            if nonce != root['nonces'][0] + j:
+                problems.append('root {} eth tx {} has nonce {}, '
+                                'expected {}'.format(
+                                    i, j, nonce, root['nonces'][0] + j))
+            if nonce in nonces:
+                problems.append('nonce {} is used twice'.format(nonce))
+            nonces.add(nonce)
+            try:
+                signer = transactions.SignedEthTx.deserialize(
+                    bytes.fromhex(signed)).recover_sender()
+            except Exception as e:
+                problems.append('root {} eth tx {} has a bad signature: '
+                                '{}'.format(i, j, e))
+                continue
+            if sender is None:
+                sender = signer
+            elif signer != sender:
+                problems.append('root {} eth tx {} is signed by {}, not '
+                                '{}'.format(i, j, signer, sender))
+    return problems
+
+
+def merge(manifest: Manifest, outputs: Sequence[ShardOutput]) -> Dict:
+    '''
+    Verifies shard outputs and combines them, in root order
+
+    Returns:
+        (dict): the roots' results, and every eth tx in nonce order
+    Raises:
+        ShardError: listing the problems, if the outputs do not merge
+    '''
+    problems = verify(manifest, outputs)
+    if problems:
+        raise ShardError(problems)
+    results = sorted((r for out in outputs for r in out['results']),
+                     key=lambda r: r['root'])
+    return {
+        'job_id': manifest['job_id'],
+        'manifest_hash': manifest_hash(manifest),
+        'results': results,
+        'eth_txns': [t for r in results for t in r['eth_txns']]}
+
+
+def _read_json(filename: str) -> Any:
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def _write_json(obj: Any, filename: str) -> None:
+    utils.write_to_file(json.dumps(obj, indent=2).encode('utf-8'), filename)
+
+
+def _run_shard_to_file(
+        manifest: Manifest,
+        shard_id: int,
+        keyring: bulk.Keyring,
+        eth_privkey: str,
+        out_dir: str) -> str:
+    # NB: module level, so it pickles for process pools
+    filename = os.path.join(out_dir, 'shard-{}.json'.format(shard_id))
+    _write_json(run_shard(
+        manifest, shard_id, keyring, eth_privkey,
+        cache_dir=os.path.join(out_dir, 'cache-{}'.format(shard_id))),
+        filename)
+    return filename
+
+
+def simulate(
+        manifest: Manifest,
+        keyring: bulk.Keyring,
+        eth_privkey: str,
+        out_dir: str) -> Dict:
+    '''
+    Runs every shard in its own process, each with its own cache
+    directory as its only state, then merges the outputs
+
+    Returns:
+        (dict): the merged result
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    num_shards = len(manifest['shards'])
+    with ProcessPoolExecutor(max_workers=num_shards) as executor:
+        futures = [executor.submit(_run_shard_to_file, manifest, i, keyring,
+                                   eth_privkey, out_dir)
+                   for i in range(num_shards)]
+        filenames = [f.result() for f in futures]
+    return merge(manifest, [_read_json(f) for f in filenames])
+
+
+def _secrets(keyring_file: str) -> Tuple[bulk.Keyring, str]:
+    secret_phrase = os.environ.get(bulk.KEYRING_PASSPHRASE_ENV) \
+        or getpass.getpass('Keyring passphrase: ')
+    eth_privkey = os.environ.get(ETH_PRIVKEY_ENV) \
+        or getpass.getpass('Ethereum privkey: ')
+    return bulk.load_keyring(keyring_file, secret_phrase), eth_privkey
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Splits auction jobs across hosts, and merges results')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('plan', help='make a manifest from a job')
+    p.add_argument('job')
+    p.add_argument('--shards', type=int, required=True)
+    p.add_argument('-o', '--output', required=True)
+
+    p = commands.add_parser('run', help='run one shard on this host')
+    p.add_argument('manifest')
+    p.add_argument('--shard', type=int, required=True)
+    p.add_argument('--keyring', required=True)
+    p.add_argument('--cache', help='artifact cache directory')
+    p.add_argument('-o', '--output', required=True)
+
+    p = commands.add_parser('merge', help='verify and merge shard outputs')
+    p.add_argument('manifest')
+    p.add_argument('outputs', nargs='+')
+    p.add_argument('-o', '--output', required=True)
+
+    p = commands.add_parser('simulate',
+                            help='run every shard in local processes')
+    p.add_argument('manifest')
+    p.add_argument('--keyring', required=True)
+    p.add_argument('--out-dir', required=True)
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'plan':
+            _write_json(plan(_read_json(args.job), args.shards), args.output)
+        elif args.command == 'run':
+            keyring, eth_privkey = _secrets(args.keyring)
+            _write_json(run_shard(
+                _read_json(args.manifest), args.shard, keyring, eth_privkey,
+                cache_dir=args.cache), args.output)
+        elif args.command == 'merge':
+            _write_json(merge(
+                _read_json(args.manifest),
+                [_read_json(f) for f in args.outputs]), args.output)
+        else:
+            keyring, eth_privkey = _secrets(args.keyring)
+            merged = simulate(
+                _read_json(args.manifest), keyring, eth_privkey,
+                args.out_dir)
+            _write_json(merged, os.path.join(args.out_dir, 'merged.json'))
+    except ShardError as e:
+        for problem in e.problems:
+            print('PROBLEM {}'.format(problem), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import scripts.utils as utils
+
+from riemann import utils as rutils
+
+from riemann.tx import Tx
+from typing import List, cast
+
+
+class SighashContext:
+    '''
+    Precomputes the BIP143 hashPrevouts, hashSequence and hashOutputs of a
+    witness transaction, so that each per-input digest costs a single
+    constant-size hash instead of rehashing every input and output.
+
+    The tx must not change after the context is made. Witnesses may be
+    added, as they are not committed to by the sighash.
+
+    Args:
+        t (riemann.tx.Tx): the (usually unsigned) witness transaction
+    '''
+
+    def __init__(self, t: Tx) -> None:
+        self.version: bytes = t.version
+        self.lock_time: bytes = t.lock_time
+        self.outpoints: List[bytes] = [
+            tx_in.outpoint.to_bytes() for tx_in in t.tx_ins]
+        self.sequences: List[bytes] = [tx_in.sequence for tx_in in t.tx_ins]
+        self.outputs: List[bytes] = [o.to_bytes() for o in t.tx_outs]
+
+        self.hash_prevouts = rutils.hash256(b''.join(self.outpoints))
+        self.hash_sequence = rutils.hash256(b''.join(self.sequences))
+        self.hash_outputs = rutils.hash256(b''.join(self.outputs))
+
+    def _digest(
+            self,
+            index: int,
+            script: bytes,
+            prevout_value: bytes,
+            sighash_type: int,
+            anyone_can_pay: bool) -> bytes:
+        null = b'\x00' * 32
+        hash_prevouts = null if anyone_can_pay else self.hash_prevouts
+        if anyone_can_pay or sighash_type == utils.SIGHASH_SINGLE:
+            hash_sequence = null
+        else:
+            hash_sequence = self.hash_sequence
+
+        if sighash_type == utils.SIGHASH_ALL:
+            hash_outputs = self.hash_outputs
+        elif index < len(self.outputs):
+            hash_outputs = rutils.hash256(self.outputs[index])
+        else:
+            raise NotImplementedError(
+                'SIGHASH_SINGLE bug is not supported. '
+                'Input index {} has no matching output.'.format(index))
+
+        if anyone_can_pay:
+            sighash_type |= utils.SIGHASH_ANYONECANPAY
+
+        preimage = b''.join([
+            self.version,
+            hash_prevouts,
+            hash_sequence,
+            self.outpoints[index],
+            script,
+            prevout_value,
+            self.sequences[index],
+            hash_outputs,
+            self.lock_time,
+            rutils.i2le_padded(sighash_type, 4)])
+        return cast(bytes, rutils.hash256(preimage))
+
+    def sighash_all(
+            self,
+            index: int,
+            script: bytes,
+            prevout_value: bytes,
+            anyone_can_pay: bool = False) -> bytes:
+        '''Computes the BIP143 SIGHASH_ALL digest for an input
+
+        Args:
+            index            (int): the index of the input being signed
+            script         (bytes): the prevout's script code, with its
+                                     length prefix, as riemann takes it
+            prevout_value  (bytes): the value of the prevout in LE uint64
+            anyone_can_pay  (bool): whether to set ANYONECANPAY
+        Returns:
+            (bytes): the 32-byte digest to sign
+        '''
+        return self._digest(index, script, prevout_value,
+                            utils.SIGHASH_ALL, anyone_can_pay)
+
+    def sighash_single(
+            self,
+            index: int,
+            script: bytes,
+            prevout_value: bytes,
+            anyone_can_pay: bool = False) -> bytes:
+        '''Computes the BIP143 SIGHASH_SINGLE digest for an input
+
+        Args:
+            index            (int): the index of the input being signed
+            script         (bytes): the prevout's script code, with its
+                                     length prefix, as riemann takes it
+            prevout_value  (bytes): the value of the prevout in LE uint64
+            anyone_can_pay  (bool): whether to set ANYONECANPAY
+        Returns:
+            (bytes): the 32-byte digest to sign
+        '''
+        return self._digest(index, script, prevout_value,
+                            utils.SIGHASH_SINGLE, anyone_can_pay)
@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+import unittest
+
+import scripts.aio as aio
+import scripts.utils as utils
+import scripts.partial_tx as pt
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from riemann import tx
+
+from typing import List
+
+RECIPIENT = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+FORMAT = [(100000, 600000), (90000, 600006)]
+PRIVKEY = hashlib.sha256(b'aio-test-key').digest()
+KEYPAIR = (PRIVKEY.hex(),
+           utils.to_pubkey(utils.coerce_key(PRIVKEY)).hex())
+PREVOUTS = [(hashlib.sha256(b'aio-test-split').hexdigest(), i, 550)
+            for i in range(3)]
+
+
+def _summary(auction: List[tx.Tx]) -> List[tuple]:
+    '''What a partial tx commits to, as signatures are not deterministic'''
+    return [(t.tx_ins[0].outpoint.to_bytes(), t.tx_outs[0].to_bytes(),
+             t.lock_time) for t in auction]
+
+
+class TestSigner(unittest.TestCase):
+
+    def _check(self, signer: aio.Signer) -> None:
+        async def build() -> tuple:
+            return (await signer.multidutch(
+                        PREVOUTS, RECIPIENT, FORMAT, KEYPAIR),
+                    await signer.multidutch_as_hex(
+                        PREVOUTS, RECIPIENT, FORMAT, KEYPAIR))
+        loop = asyncio.new_event_loop()
+        try:
+            auctions, blobs = loop.run_until_complete(build())
+        finally:
+            loop.close()
+        expected = [_summary(a) for a in pt.multidutch(
+            PREVOUTS, RECIPIENT, FORMAT, KEYPAIR)]
+        self.assertEqual([_summary(a) for a in auctions], expected)
+        self.assertEqual(len(blobs), len(PREVOUTS))
+        for summary, blob in zip(expected, blobs):
+            for outpoint, output, lock_time in summary:
+                self.assertIn(outpoint + b'\x00', bytes.fromhex(blob))
+                self.assertIn(output, bytes.fromhex(blob))
+
+    def test_default_is_a_process_pool(self) -> None:
+        signer = aio.Signer(max_concurrency=2)
+        self.addCleanup(signer.close)
+        self.assertIsInstance(signer.executor, ProcessPoolExecutor)
+        self._check(signer)
+
+    def test_thread_pool(self) -> None:
+        with ThreadPoolExecutor(2) as executor:
+            signer = aio.Signer(executor=executor)
+            self._check(signer)
+            signer.close()
+            self.assertIs(signer.executor, executor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import io
+import os
+import json
+import tempfile
+import unittest
+
+import scripts.utils as utils
+
+from typing import Any, BinaryIO
+
+PHRASE = 'envelope-test-phrase'
+CHUNK_SIZE = 64
+BLOCK_SIZE = CHUNK_SIZE + utils.ENVELOPE_TAG_SIZE
+HEADER_SIZE = utils.ENVELOPE_HEADER.size
+
+
+class TestEnvelope(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # NB: few iterations keep the tests fast
+        self.key = utils.stretch_phrase(PHRASE, iterations=1000)
+        self.data = {str(i): {'partial': 'ab' * (i + 1), 'tiers': [i, 1.5]}
+                     for i in range(20)}
+        self.envelope = self._encrypt(self.data)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, 'state.json')
+
+    def _encrypt(self, data: Any) -> bytes:
+        out = io.BytesIO()
+        utils.encrypt_stream(
+            io.BytesIO(json.dumps(data).encode('utf-8')), out, PHRASE,
+            key=self.key, chunk_size=CHUNK_SIZE)
+        return out.getvalue()
+
+    def _read(self, envelope: bytes) -> Any:
+        with open(self.filename, 'wb') as f:
+            f.write(envelope)
+        return utils.read_encrypted_json_file(
+            self.filename, PHRASE, key=self.key)
+
+    def test_round_trip(self) -> None:
+        self.assertGreater(len(self.envelope), 10 * BLOCK_SIZE)
+        self.assertEqual(self._read(self.envelope), self.data)
+        for data in [[], {}, 'é' * 100, 12345, [1.25, None, True]]:
+            self.assertEqual(self._read(self._encrypt(data)), data)
+
+    def test_write_then_read(self) -> None:
+        utils.write_encrypted_json_file(
+            self.data, self.filename, PHRASE, key=self.key)
+        self.assertEqual(
+            utils.read_encrypted_json_file(self.filename, PHRASE),
+            self.data)
+
+    def test_wrong_phrase(self) -> None:
+        with open(self.filename, 'wb') as f:
+            f.write(self.envelope)
+        with self.assertRaises(ValueError):
+            utils.read_encrypted_json_file(self.filename, 'wrong')
+
+    def test_flipped_byte(self) -> None:
+        for offset in [HEADER_SIZE + 5, HEADER_SIZE + BLOCK_SIZE * 3 + 70,
+                       len(self.envelope) - 1, 30]:
+            tampered = bytearray(self.envelope)
+            tampered[offset] ^= 1
+            with self.assertRaises(ValueError):
+                self._read(bytes(tampered))
+            with self.assertRaises(ValueError):
+                utils.decode_envelope(bytes(tampered), PHRASE, key=self.key)
+
+    def test_truncated_final_chunk(self) -> None:
+        final = HEADER_SIZE + BLOCK_SIZE * (
+            (len(self.envelope) - HEADER_SIZE) // BLOCK_SIZE)
+        for end in [len(self.envelope) - 1, final]:
+            with self.assertRaises(ValueError):
+                self._read(self.envelope[:end])
+
+    def test_reordered_chunks(self) -> None:
+        first = HEADER_SIZE
+        second = HEADER_SIZE + BLOCK_SIZE
+        third = HEADER_SIZE + 2 * BLOCK_SIZE
+        swapped = self.envelope[:first] \
+            + self.envelope[second:third] + self.envelope[first:second] \
+            + self.envelope[third:]
+        with self.assertRaises(ValueError):
+            self._read(swapped)
+
+    def test_data_after_final_chunk(self) -> None:
+        with self.assertRaises(ValueError):
+            self._read(self.envelope + b'\x00')
+
+
+class TestLoadJsonStream(unittest.TestCase):
+
+    def test_matches_json_loads(self) -> None:
+        docs = [
+            '{"a": [1, 2.5e-3, "x\\"y"], "b": {"c": null}, "d": -12}',
+            '[ {"é": true}, false, 123456789012345678901234567890 ]',
+            ' "just a string" ', '1.5E+10', '{}', '[]']
+        for doc in docs:
+            for chunk_size in [1, 2, 5, 1000]:
+                self.assertEqual(
+                    utils.load_json_stream(io.StringIO(doc), chunk_size),
+                    json.loads(doc))
+
+    def test_rejects_malformed(self) -> None:
+        for doc in ['{"a": 1,}', '[1, 2', '{"a" 1}', '{1: 2}', '[1] x',
+                    '', '12 13']:
+            for chunk_size in [1, 3, 1000]:
+                with self.assertRaises(json.JSONDecodeError):
+                    utils.load_json_stream(io.StringIO(doc), chunk_size)
+
+
+class TestWriteFile(unittest.TestCase):
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.filename = os.path.join(tmp.name, 'state.json')
+
+    def test_failed_write_leaves_no_tmp(self) -> None:
+        utils.write_to_file(b'old', self.filename)
+
+        def write(outfile: BinaryIO) -> None:
+            outfile.write(b'partial')
+            raise ValueError('writer failed')
+
+        with self.assertRaises(ValueError):
+            utils.write_file_with(write, self.filename)
+        self.assertEqual(os.listdir(self.dir), ['state.json'])
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+
+import scripts.hd as hd
+import scripts.network as net
+
+from typing import List, Tuple
+
+# NB: BIP32 test vectors 1 and 2, as (path, xprv)
+VECTOR_1_SEED = bytes.fromhex('000102030405060708090a0b0c0d0e0f')
+VECTOR_1: List[Tuple[str, str]] = [
+    ('m', 'xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvv'
+          'NKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi'),
+    ("m/0'", 'xprv9uHRZZhk6KAJC1avXpDAp4MDc3sQKNxDiPvvkX8Br5ngLNv1TxvUxt4cV1'
+             'rGL5hj6KCesnDYUhd7oWgT11eZG7XnxHrnYeSvkzY7d2bhkJ7'),
+    ("m/0'/1", 'xprv9wTYmMFdV23N2TdNG573QoEsfRrWKQgWeibmLntzniatZvR9BmLnvSxqu'
+               '53Kw1UmYPxLgboyZQaXwTCg8MSY3H2EU4pWcQDnRnrVA1xe8fs'),
+    ("m/0'/1/2'", 'xprv9z4pot5VBttmtdRTWfWQmoH1taj2axGVzFqSb8C9xaxKymcFzXBDptW'
+                  'mT7FwuEzG3ryjH4ktypQSAewRiNMjANTtpgP4mLTj34bhnZX7UiM'),
+    ("m/0'/1/2'/2", 'xprvA2JDeKCSNNZky6uBCviVfJSKyQ1mDYahRjijr5idH2WwLsEd4Hsb2T'
+                    'yh8RfQMuPh7f7RtyzTtdrbdqqsunu5Mm3wDvUAKRHSC34sJ7in334'),
+    ("m/0'/1/2'/2/1000000000",
+     'xprvA41z7zogVVwxVSgdKUHDy1SKmdb533PjDz7J6N6mV6uS3ze1ai8FHa8kmHScGpWmj4'
+     'WggLyQjgPie1rFSruoUihUZREPSL39UNdE3BBDu76')]
+
+VECTOR_2_SEED = bytes.fromhex(
+    'fffcf9f6f3f0edeae7e4e1dedbd8d5d2cfccc9c6c3c0bdbab7b4b1aeaba8a5a29f9c99'
+    '9693908d8a8784817e7b7875726f6c696663605d5a5754514e4b484542')
+VECTOR_2: List[Tuple[str, str]] = [
+    ('m', 'xprv9s21ZrQH143K31xYSDQpPDxsXRTUcvj2iNHm5NUtrGiGG5e2DtALGdso3pGz6'
+          'ssrdK4PFmM8NSpSBHNqPqm55Qn3LqFtT2emdEXVYsCzC2U'),
+    ('m/0', 'xprv9vHkqa6EV4sPZHYqZznhT2NPtPCjKuDKGY38FBWLvgaDx45zo9WQRUT3dKY'
+            'njwih2yJD9mkrocEZXo1ex8G81dwSM1fwqWpWkeS3v86pgKt'),
+    ("m/0/2147483647'",
+     'xprv9wSp6B7kry3Vj9m1zSnLvN3xH8RdsPP1Mh7fAaR7aRLcQMKTR2vidYEeEg2mUCTAwC'
+     'd6vnxVrcjfy2kRgVsFawNzmjuHc2YmYRmagcEPdU9'),
+    ("m/0/2147483647'/1",
+     'xprv9zFnWC6h2cLgpmSA46vutJzBcfJ8yaJGg8cX1e5StJh45BBciYTRXSd25UEPVuesF9'
+     'yog62tGAQtHjXajPPdbRCHuWS6T8XA2ECKADdw4Ef'),
+    ("m/0/2147483647'/1/2147483646'",
+     'xprvA1RpRA33e1JQ7ifknakTFpgNXPmW2YvmhqLQYMmrj4xJXXWYpDPS3xz7iAxn8L39nj'
+     'GVyuoseXzU6rcxFLJ8HFsTjSyQbLYnMpCqE2VbFWc'),
+    ("m/0/2147483647'/1/2147483646'/2",
+     'xprvA2nrNbFZABcdryreWet9Ea4LvTJcGsqrMzxHx98MMrotbir7yrKCEXw7nadnHM8Dq3'
+     '8EGfSh6dqA9QWTyefMLEcBYJUuekgW4BYPJcr9E7j')]
+
+TEMPLATE = "m/84'/0'/0'/0/{}"
+TX_ID = 'ab' * 32
+
+
+def _xprv_parts(xprv: str) -> Tuple[bytes, bytes]:
+    '''The chain code and private key of an xprv'''
+    payload = net._b58check_decode(xprv)
+    assert len(payload) == 78 and payload[45] == 0
+    return payload[13:45], payload[46:]
+
+
+class TestVectors(unittest.TestCase):
+
+    def assertMatchesVector(
+            self,
+            seed: bytes,
+            vector: List[Tuple[str, str]]) -> None:
+        keychain = hd.Keychain.from_seed(seed)
+        for path, xprv in vector:
+            with self.subTest(path=path):
+                chain_code, privkey = _xprv_parts(xprv)
+                node = keychain.derive(path.replace("'", 'h'))
+                self.assertEqual(node.chain_code, chain_code)
+                self.assertEqual(node.privkey, privkey)
+                self.assertEqual(keychain.keypair(path)[0], privkey.hex())
+
+    def test_vector_1(self) -> None:
+        self.assertMatchesVector(VECTOR_1_SEED, VECTOR_1)
+
+    def test_vector_2(self) -> None:
+        self.assertMatchesVector(VECTOR_2_SEED, VECTOR_2)
+
+    def test_cache_does_not_change_keys(self) -> None:
+        # NB: deepest first, so every parent comes from the cache after
+        cold = hd.Keychain.from_seed(VECTOR_1_SEED)
+        warm = hd.Keychain.from_seed(VECTOR_1_SEED)
+        for path, _ in reversed(VECTOR_1):
+            warm.derive(path)
+        for path, _ in VECTOR_1:
+            self.assertEqual(warm.derive(path), cold.derive(path))
+
+    def test_parse_path(self) -> None:
+        self.assertEqual(hd.parse_path("m/0'/1/2h"),
+                         (hd.HARDENED, 1, hd.HARDENED + 2))
+        for path in ['0/1', 'm/-1', 'm/{}'.format(hd.HARDENED), 'm/x']:
+            with self.assertRaises(ValueError):
+                hd.parse_path(path)
+
+
+class TestKeyPath(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.keychain = hd.Keychain.from_seed(VECTOR_2_SEED)
+
+    def test_for_batch_scopes_templates(self) -> None:
+        key = hd.KeyPath(self.keychain, TEMPLATE)
+        with self.assertRaises(ValueError):
+            hd.resolve(key)
+
+        a, b = hd.batch_steps(TX_ID, 0)
+        scoped = hd.for_batch(key, TX_ID, 0)
+        assert isinstance(scoped, hd.KeyPath)
+        self.assertEqual(scoped.scoped_path,
+                         "m/84'/0'/0'/0/{}/{}/{{}}".format(a, b))
+        self.assertEqual(
+            hd.resolve(scoped, 3),
+            self.keychain.keypair("m/84'/0'/0'/0/{}/{}/3".format(a, b)))
+
+        # NB: scoping again keeps the first batch
+        self.assertIs(scoped.for_batch(TX_ID, 1), scoped)
+
+    def test_batches_get_distinct_keys(self) -> None:
+        key = hd.KeyPath(self.keychain, TEMPLATE)
+        batches = [hd.for_batch(key, TX_ID, 0), hd.for_batch(key, TX_ID, 1),
+                   hd.for_batch(key, 'cd' * 32, 0)]
+        pubkeys = {hd.resolve(k, i)[1] for k in batches for i in range(3)}
+        self.assertEqual(len(pubkeys), 9)
+        self.assertEqual(len({hd.key_id(k) for k in batches}), 3)
+
+    def test_plain_keys_are_unchanged(self) -> None:
+        path = hd.KeyPath(self.keychain, "m/0/1")
+        self.assertIs(path.for_batch(TX_ID, 0), path)
+        self.assertEqual(hd.resolve(path), self.keychain.keypair('m/0/1'))
+        keypair = self.keychain.keypair('m/0')
+        self.assertIs(hd.for_batch(keypair, TX_ID, 0), keypair)
+        self.assertEqual(hd.key_id(keypair), keypair[1])
+        self.assertEqual(hd.address(keypair),
+                         self.keychain.address('m/0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import os
+import json
+import tempfile
+import unittest
+
+import scripts.utils as utils
+import scripts.indexer as indexer
+import scripts.interface_wrapper as iw
+
+from unittest import mock
+from typing import Any, Dict, List
+
+CONTRACT = '0x' + '11' * 20
+SELLER = '0x' + '22' * 20
+OTHER_SELLER = '0x' + '33' * 20
+ASSET = '0x' + '44' * 20
+BIDDER = '0x' + '55' * 20
+
+ACTIVE_TOPIC = '0x' + utils.keccak256(
+    b'ListingActive(bytes32,address,address,uint256,bytes,uint256)').hex()
+CLOSED_TOPIC = '0x' + utils.keccak256(
+    b'ListingClosed(bytes32,address,address,address,uint256)').hex()
+
+
+def _word(value: Any) -> bytes:
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:]).rjust(32, b'\x00')
+    return int(value).to_bytes(32, 'big')
+
+
+def _listing_id(n: int) -> str:
+    return '0x' + bytes([n]).rjust(32, b'\x00').hex()
+
+
+def _block_hash(number: int, fork: str) -> str:
+    return '0x' + utils.keccak256(
+        '{}-{}'.format(fork, number).encode('utf-8')).hex()
+
+
+def _log(
+        number: int,
+        fork: str,
+        topics: List[str],
+        data: bytes) -> Dict[str, Any]:
+    return {
+        'address': CONTRACT,
+        'blockNumber': hex(number),
+        'blockHash': _block_hash(number, fork),
+        'transactionHash': '0x' + utils.keccak256(
+            '{}-{}-tx'.format(fork, number).encode('utf-8')).hex(),
+        'logIndex': '0x0',
+        'topics': topics,
+        'data': '0x' + data.hex()}
+
+
+def active_log(
+        number: int,
+        fork: str,
+        n: int,
+        seller: str,
+        value: int,
+        partial_tx: bytes,
+        req_diff: int) -> Dict[str, Any]:
+    padded = partial_tx + b'\x00' * (-len(partial_tx) % 32)
+    data = _word(value) + _word(96) + _word(req_diff) \
+        + _word(len(partial_tx)) + padded
+    return _log(number, fork,
+                [ACTIVE_TOPIC, _listing_id(n), '0x' + _word(seller).hex(),
+                 '0x' + _word(ASSET).hex()],
+                data)
+
+
+def closed_log(
+        number: int,
+        fork: str,
+        n: int,
+        seller: str,
+        value: int) -> Dict[str, Any]:
+    return _log(number, fork,
+                [CLOSED_TOPIC, _listing_id(n), '0x' + _word(BIDDER).hex(),
+                 '0x' + _word(ASSET).hex()],
+                _word(seller) + _word(value))
+
+
+def chain(
+        tip: int,
+        logs: List[Dict[str, Any]],
+        forks: Dict[int, str]) -> indexer.RecordedChain:
+    '''Blocks up to tip, each from the last fork starting at or below it'''
+    def fork_of(number: int) -> str:
+        return forks[max(n for n in forks if n <= number)]
+    return indexer.RecordedChain(
+        {n: _block_hash(n, fork_of(n)) for n in range(tip + 1)}, logs)
+
+
+class TestIndexer(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.logs = [
+            active_log(3, 'a', 1, SELLER, 1000, b'\x01' * 70, 7),
+            active_log(5, 'a', 2, OTHER_SELLER, 2000, b'\x02' * 64, 9),
+            active_log(6, 'a', 3, SELLER, 3000, b'\x03', 11)]
+        self.main = chain(
+            10, self.logs + [closed_log(8, 'a', 1, SELLER, 1000)], {0: 'a'})
+        self.indexer = indexer.Indexer(self.main, ':memory:', batch_size=4)
+
+    def tearDown(self) -> None:
+        self.indexer.close()
+
+    def test_decodes_listings(self) -> None:
+        self.assertEqual(self.indexer.sync([CONTRACT]), 4)
+        listing = self.indexer.get(CONTRACT, _listing_id(2))
+        assert listing is not None
+        self.assertEqual(listing.seller, OTHER_SELLER)
+        self.assertEqual(listing.asset, ASSET)
+        self.assertEqual(listing.value, 2000)
+        self.assertEqual(listing.partial_tx, b'\x02' * 64)
+        self.assertEqual(listing.req_diff, 9)
+        self.assertEqual(listing.status, indexer.ACTIVE)
+        self.assertEqual(listing.opened_block, 5)
+
+        closed = self.indexer.get(CONTRACT, _listing_id(1))
+        assert closed is not None
+        self.assertEqual(closed.status, indexer.CLOSED)
+        self.assertEqual(closed.bidder, BIDDER)
+        self.assertEqual(closed.closed_block, 8)
+        self.assertEqual(self.indexer.last_block(CONTRACT), 10)
+
+    def test_open_listings(self) -> None:
+        self.indexer.sync([CONTRACT])
+        mine = self.indexer.open_listings(seller=SELLER)
+        self.assertEqual([x.listing_id for x in mine], [_listing_id(3)])
+        everyone = self.indexer.open_listings(asset=ASSET, contract=CONTRACT)
+        self.assertEqual([x.listing_id for x in everyone],
+                         [_listing_id(2), _listing_id(3)])
+
+    def test_sync_is_incremental(self) -> None:
+        self.indexer.sync([CONTRACT], to_block=6)
+        self.assertEqual(len(self.indexer.open_listings()), 3)
+        self.assertEqual(self.indexer.sync([CONTRACT]), 1)
+        self.assertEqual(len(self.indexer.open_listings()), 2)
+        self.assertEqual(self.indexer.sync([CONTRACT]), 0)
+
+    def test_reorg_rolls_back_to_fork(self) -> None:
+        self.indexer.sync([CONTRACT])
+
+        # NB: from block 7 on, the close is gone and listing 4 opens
+        self.indexer.rpc = chain(
+            12,
+            self.logs + [active_log(9, 'b', 4, SELLER, 4000, b'\x04', 13)],
+            {0: 'a', 7: 'b'})
+        self.assertEqual(self.indexer.check_reorg(), 6)
+        self.assertEqual(self.indexer.last_block(CONTRACT), 6)
+        reopened = self.indexer.get(CONTRACT, _listing_id(1))
+        assert reopened is not None
+        self.assertEqual(reopened.status, indexer.ACTIVE)
+        self.assertIsNone(reopened.bidder)
+
+        self.assertEqual(self.indexer.sync([CONTRACT]), 1)
+        self.assertEqual(
+            [x.listing_id for x in self.indexer.open_listings(seller=SELLER)],
+            [_listing_id(1), _listing_id(3), _listing_id(4)])
+        self.assertIsNone(self.indexer.check_reorg())
+
+    def test_replays_recorded_file(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'chain.json')
+            with open(filename, 'w') as f:
+                json.dump({'blocks': {str(n): h
+                                      for n, h in self.main.blocks.items()},
+                           'logs': self.main.logs}, f)
+            self.indexer.rpc = indexer.RecordedChain.from_file(filename)
+            self.assertEqual(self.indexer.sync([CONTRACT]), 4)
+        self.assertEqual(len(self.indexer.open_listings()), 2)
+
+
+class TestDefaultAbi(unittest.TestCase):
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.build_file = os.path.join(tmp.name, 'IntegralAuction.json')
+        for name, value in [('BUILD_FILE', self.build_file), ('ABI', None)]:
+            patcher = mock.patch.object(iw, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_without_build(self) -> None:
+        self.assertIs(indexer.default_abi(), indexer.SWAP_EVENTS_ABI)
+
+    def test_events_come_from_build(self) -> None:
+        # NB: a build with only the StatelessSwap events, and a function
+        stateless = [indexer.SWAP_EVENTS_ABI[0], indexer.SWAP_EVENTS_ABI[2]]
+        function = {'type': 'function', 'name': 'claim', 'inputs': []}
+        with open(self.build_file, 'w') as f:
+            json.dump({'interface': json.dumps(stateless + [function])}, f)
+        self.assertEqual(indexer.default_abi(), stateless)
+        ix = indexer.Indexer(chain(1, [], {0: 'a'}), ':memory:')
+        self.addCleanup(ix.close)
+        self.assertEqual(set(ix.events), {ACTIVE_TOPIC, CLOSED_TOPIC})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import scripts.ledger as ledger_db
+
+SPLIT = 'ab' * 32
+TIERS = [(1000, 600000), (900, 600006)]
+
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.ledger = ledger_db.AuctionLedger(':memory:')
+        self.addCleanup(self.ledger.close)
+        self.ledger.record_auctions(
+            SPLIT, ((i, 550, bytes([i]) * 10) for i in range(4)), TIERS)
+
+    def status(self, index: int) -> str:
+        record = self.ledger.get(SPLIT, index)
+        assert record is not None
+        return record.status
+
+    def test_fill_then_claim(self) -> None:
+        self.assertTrue(self.ledger.mark_filled(SPLIT, 0, 'f0'))
+        self.assertEqual(self.status(0), ledger_db.FILLED)
+        self.assertEqual([r.output_index
+                          for r in self.ledger.unclaimed_fills()], [0])
+        self.assertTrue(self.ledger.mark_claimed(SPLIT, 0, '0xc0'))
+        record = self.ledger.get(SPLIT, 0)
+        assert record is not None
+        self.assertEqual((record.status, record.fill_tx_id,
+                          record.claim_tx_hash),
+                         (ledger_db.CLAIMED, 'f0', '0xc0'))
+        self.assertEqual(self.ledger.unclaimed_fills(), [])
+
+    def test_claimed_is_not_filled_again(self) -> None:
+        self.ledger.mark_filled(SPLIT, 0, 'f0')
+        self.ledger.mark_claimed(SPLIT, 0, '0xc0')
+        self.assertFalse(self.ledger.mark_filled(SPLIT, 0, 'f1'))
+        record = self.ledger.get(SPLIT, 0)
+        assert record is not None
+        self.assertEqual((record.status, record.fill_tx_id),
+                         (ledger_db.CLAIMED, 'f0'))
+
+    def test_closed_is_not_filled(self) -> None:
+        self.ledger.mark_closed(SPLIT, [1, 2])
+        self.assertFalse(self.ledger.mark_filled(SPLIT, 1, 'f1'))
+        self.assertEqual(self.status(1), ledger_db.CLOSED)
+        self.assertEqual(self.ledger.open_indexes(SPLIT), [0, 3])
+
+    def test_only_fills_are_claimed(self) -> None:
+        self.assertFalse(self.ledger.mark_claimed(SPLIT, 0, '0xc0'))
+        self.assertEqual(self.status(0), ledger_db.OPEN)
+        self.ledger.mark_closed(SPLIT, [1])
+        self.assertFalse(self.ledger.mark_claimed(SPLIT, 1, '0xc1'))
+        self.assertEqual(self.status(1), ledger_db.CLOSED)
+
+    def test_filled_is_not_closed(self) -> None:
+        self.ledger.mark_filled(SPLIT, 2, 'f2')
+        self.ledger.mark_closed(SPLIT, [2, 3])
+        self.assertEqual(self.status(2), ledger_db.FILLED)
+        self.assertEqual(self.status(3), ledger_db.CLOSED)
+
+    def test_rerecording_keeps_status(self) -> None:
+        self.ledger.mark_filled(SPLIT, 0, 'f0')
+        self.ledger.record_auctions(
+            SPLIT, ((i, 550, bytes([i]) * 10) for i in range(4)), TIERS)
+        self.assertEqual(self.status(0), ledger_db.FILLED)
+        self.assertEqual(self.ledger.tiers(SPLIT, 0), TIERS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import hashlib
+import unittest
+
+import riemann
+import scripts.network as net
+
+from riemann.encoding import addresses
+from typing import List
+
+NETWORKS = ['bitcoin_main', 'bitcoin_test']
+
+# NB: valid addresses and their output scripts, from BIP173 and BIP350
+SEGWIT_VECTORS = [
+    ('bitcoin_main', 'BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4',
+     '0014751e76e8199196d454941c45d1b3a323f1433bd6'),
+    ('bitcoin_test',
+     'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7',
+     '00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262'),
+    ('bitcoin_test',
+     'tb1qqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesrxh6hy',
+     '0020000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433'),
+    ('bitcoin_main',
+     'bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7kt'
+     '5nd6y',
+     '5128751e76e8199196d454941c45d1b3a323f1433bd6751e76e8199196d454941c45d1'
+     'b3a323f1433bd6'),
+    ('bitcoin_main', 'BC1SW50QGDZ25J', '6002751e'),
+    ('bitcoin_main', 'bc1zw508d6qejxtdg4y5r3zarvaryvaxxpcs',
+     '5210751e76e8199196d454941c45d1b3a323'),
+    ('bitcoin_test',
+     'tb1pqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesf3hn0c',
+     '5120000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433'),
+    ('bitcoin_main',
+     'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0',
+     '512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')]
+
+# NB: invalid addresses, mostly from BIP350
+INVALID_SEGWIT = [
+    # invalid human-readable part
+    'tc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq5zuyut',
+    # v1 with a bech32 checksum
+    'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqh2y7hd',
+    # v0 with a bech32m checksum
+    'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kemeawh',
+    # mixed case
+    'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8F3t4',
+    # empty data section
+    'bc1gmk9yu']
+
+BASE58_VECTORS = [
+    ('1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2',
+     '76a91477bff20c60e522dfaa3350c39b030a5d004e839a88ac'),
+    ('3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy',
+     'a914b472a266d0bd89c13706a4132ccfb16f7c3b9fcb87')]
+
+
+def _pubkeys() -> List[bytes]:
+    return [bytes([2 + i % 2]) + hashlib.sha256(bytes([i])).digest()
+            for i in range(4)]
+
+
+class TestNetwork(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.addCleanup(riemann.select_network,
+                        riemann.get_current_network_name())
+
+    def test_segwit_vectors(self) -> None:
+        for network, address, script in SEGWIT_VECTORS:
+            with self.subTest(address=address):
+                self.assertEqual(net.to_output_script(address, network).hex(),
+                                 script)
+
+    def test_invalid_segwit(self) -> None:
+        for address in INVALID_SEGWIT:
+            with self.subTest(address=address):
+                with self.assertRaises(ValueError):
+                    net.to_output_script(address, 'bitcoin_main')
+
+    def test_base58_vectors(self) -> None:
+        for address, script in BASE58_VECTORS:
+            self.assertEqual(
+                net.to_output_script(address, 'bitcoin_main').hex(), script)
+            with self.assertRaises(ValueError):
+                net.to_output_script(address, 'bitcoin_test')
+        with self.assertRaises(ValueError):
+            net.to_output_script('1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN3',
+                                 'bitcoin_main')
+
+    def test_matches_riemann(self) -> None:
+        scripts = ['OP_1', 'OP_2 {} OP_1 OP_CHECKMULTISIG'.format('02' * 33)]
+        for network in NETWORKS:
+            riemann.select_network(network)
+            made = [addresses.make_p2pkh_address(p) for p in _pubkeys()] \
+                + [addresses.make_p2wpkh_address(p) for p in _pubkeys()] \
+                + [addresses.make_p2sh_address(s) for s in scripts] \
+                + [addresses.make_p2wsh_address(s) for s in scripts]
+            for address in made:
+                with self.subTest(network=network, address=address):
+                    self.assertEqual(
+                        net.to_output_script(address, network),
+                        addresses.to_output_script(address))
+            for pubkey in _pubkeys():
+                self.assertEqual(net.make_p2wpkh_address(pubkey, network),
+                                 addresses.make_p2wpkh_address(pubkey))
+
+    def test_explicit_network_ignores_riemann(self) -> None:
+        pubkey = _pubkeys()[0]
+        riemann.select_network('bitcoin_test')
+        self.assertTrue(
+            net.make_p2wpkh_address(pubkey, 'bitcoin_main').startswith('bc1'))
+        self.assertTrue(net.make_p2wpkh_address(pubkey).startswith('tb1'))
+        with self.assertRaises(ValueError):
+            net.get_network('bitcoin_nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import hashlib
+import unittest
+from unittest import mock
+
+import scripts.utils as utils
+import scripts.partial_tx as pt
+import scripts.benchmarks as benchmarks
+import scripts.interface_wrapper as iw
+import scripts.eth_auction_setup as eas
+
+from typing import List, Union
+
+RECIPIENT = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+FORMAT = [(100000 - 5000 * i, 600000 + 6 * i) for i in range(4)]
+PRIVKEY = hashlib.sha256(b'partial-tx-test-key').digest()
+KEYPAIR = (PRIVKEY.hex(),
+           utils.to_pubkey(utils.coerce_key(PRIVKEY)).hex())
+TX_ID = hashlib.sha256(b'partial-tx-test-split').hexdigest()
+
+
+def _sign_hash(hash_bytes: bytes, privkeydata: str) -> str:
+    '''Like utils.sign_hash, but RFC6979, so that signed bytes compare'''
+    sig = utils.coerce_key(privkeydata).sign_digest_deterministic(
+        hash_bytes,
+        hashfunc=hashlib.sha256,
+        sigencode=utils.sigencode_der_canonize)
+    return bytes(sig).hex()
+
+
+class DeterministicTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        patcher = mock.patch.object(utils, 'sign_hash', _sign_hash)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+def _prevouts(n: int) -> List[pt.Prevout]:
+    return [(TX_ID, i, 550) for i in range(n)]
+
+
+def _auction_bytes(auction: pt.Auction) -> bytes:
+    return b''.join(t.to_bytes() for t in auction)
+
+
+class TestCompact(DeterministicTestCase):
+
+    def test_compact_prevouts_share_a_txid(self) -> None:
+        a = pt.CompactPrevout(TX_ID, 0, 550)
+        b = pt.CompactPrevout(bytes.fromhex(TX_ID), 1, 550)
+        self.assertIs(a.tx_id, b.tx_id)
+        self.assertEqual(b.to_tuple(), (TX_ID, 1, 550))
+
+    def test_dutch_compact_matches_dutch(self) -> None:
+        expected = pt.dutch(TX_ID, 3, 550, RECIPIENT, FORMAT, KEYPAIR)
+        prevouts: List[Union[pt.Prevout, pt.CompactPrevout]] = [
+            (TX_ID, 3, 550), pt.CompactPrevout(TX_ID, 3, 550)]
+        for prevout in prevouts:
+            partials = pt.dutch_compact(
+                prevout, RECIPIENT, pt.CompactFormat(FORMAT), KEYPAIR)
+            self.assertEqual([p.raw for p in partials],
+                             [t.to_bytes() for t in expected])
+            self.assertEqual([(p.value, p.lock_time) for p in partials],
+                             FORMAT)
+
+    def test_store_matches_multidutch(self) -> None:
+        prevouts = _prevouts(3)
+        expected = pt.multidutch(prevouts, RECIPIENT, FORMAT, KEYPAIR)
+        store = pt.multidutch_compact(prevouts, RECIPIENT, FORMAT, KEYPAIR)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.num_tiers, 3 * len(FORMAT))
+        for i, auction in enumerate(expected):
+            self.assertEqual(store.auction_bytes(i), _auction_bytes(auction))
+        self.assertEqual(store.tier(5).raw, expected[1][1].to_bytes())
+        self.assertEqual(store.value_and_lock_time(5), FORMAT[1])
+
+    def test_multidutch_as_hex_is_unchanged(self) -> None:
+        prevouts = _prevouts(2)
+        self.assertEqual(
+            pt.multidutch_as_hex(prevouts, RECIPIENT, FORMAT, KEYPAIR),
+            [_auction_bytes(a).hex() for a in pt.multidutch(
+                prevouts, RECIPIENT, FORMAT, KEYPAIR)])
+
+
+class TestMakeAuctions(DeterministicTestCase):
+
+    def test_partials_match_dutch_as_hex(self) -> None:
+        if not os.path.exists(iw.BUILD_FILE):
+            patcher = mock.patch.object(iw, 'ABI', benchmarks.OPEN_ABI)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        prevouts = _prevouts(2)
+        partials, _, _ = eas.make_auctions(
+            prevouts=[pt.CompactPrevout(*p) for p in prevouts],
+            auction_keys=KEYPAIR,
+            start_nonce=0,
+            contract_address='0x' + '11' * 20,
+            reqDiff=1000,
+            eth_value=10 ** 18,
+            eth_privkey=hashlib.sha256(b'eth').hexdigest(),
+            recipient=RECIPIENT,
+            form=FORMAT)
+        self.assertEqual(
+            partials,
+            [pt.dutch_as_hex(p[0], p[1], p[2], RECIPIENT, FORMAT, KEYPAIR)
+             for p in prevouts])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import json
+import unittest
+
+import scripts.preflight as preflight
+
+CASES_FILE = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'test', 'preflight_cases.json')
+
+
+class TestPreflightCases(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with open(CASES_FILE, 'r') as f:
+            self.cases = json.load(f)
+
+    def test_cases(self) -> None:
+        self.assertEqual(len({c['name'] for c in self.cases}),
+                         len(self.cases))
+        for case in self.cases:
+            with self.subTest(case['name']):
+                self.assertEqual(preflight.run_case(case), case['expected'])
+
+    def test_only_proof_cases_fail_the_proof(self) -> None:
+        # NB: every other case must get past the proof to what it tests
+        proof_cases = {'bad proof index', 'proof not a multiple of 32'}
+        for case in self.cases:
+            if case['name'] not in proof_cases:
+                self.assertNotEqual(case['expected']['reason'],
+                                    preflight.BAD_PROOF, case['name'])
+
+
+if __name__ == '__main__':
+    unittest.main()
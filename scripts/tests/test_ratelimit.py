@@ -0,0 +1,129 @@
+import asyncio
+import unittest
+
+import scripts.ratelimit as ratelimit
+
+from typing import Any, List
+
+
+class FakeClock:
+    '''Time that only moves when slept through'''
+
+    def __init__(self) -> None:
+        self.now = 100.0
+        self.sleeps: List[float] = []
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class LoopTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.clock = FakeClock()
+
+    def run_until_complete(self, coro: Any) -> Any:
+        return self.loop.run_until_complete(coro)
+
+
+class TestTokenBucket(LoopTestCase):
+
+    def _bucket(self, rate: float, burst: int) -> ratelimit.TokenBucket:
+        return ratelimit.TokenBucket(
+            rate, burst, clock=self.clock.time, sleep=self.clock.sleep)
+
+    def test_burst_then_rate(self) -> None:
+        bucket = self._bucket(2.0, 3)
+        for _ in range(3):
+            self.run_until_complete(bucket.acquire())
+        self.assertEqual(self.clock.sleeps, [])
+        self.run_until_complete(bucket.acquire())
+        self.assertEqual(self.clock.sleeps, [0.5])
+        self.run_until_complete(bucket.acquire())
+        self.assertEqual(self.clock.sleeps, [0.5, 0.5])
+
+    def test_refill_is_capped_at_burst(self) -> None:
+        bucket = self._bucket(2.0, 3)
+        for _ in range(3):
+            self.run_until_complete(bucket.acquire())
+        self.clock.now += 60
+        for _ in range(3):
+            self.run_until_complete(bucket.acquire())
+        self.assertEqual(self.clock.sleeps, [])
+        self.run_until_complete(bucket.acquire())
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+    def test_partial_refill(self) -> None:
+        bucket = self._bucket(4.0, 1)
+        self.run_until_complete(bucket.acquire())
+        self.clock.now += 0.125
+        self.run_until_complete(bucket.acquire())
+        self.assertEqual(self.clock.sleeps, [0.125])
+
+
+class TestAIMD(LoopTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        bucket = ratelimit.TokenBucket(
+            4.0, 100, clock=self.clock.time, sleep=self.clock.sleep)
+        self.limiter = ratelimit.ServerLimiter(
+            'test', min_rate=1.0, max_rate=5.0, target_latency=1.0,
+            bucket=bucket)
+        self.latency = 0.1
+        self.sent: List[str] = []
+
+    async def _send(self, method: str, *params: Any) -> str:
+        self.sent.append(method)
+        await asyncio.sleep(0)
+        self.clock.now += self.latency
+        return method
+
+    async def _fail(self, method: str, *params: Any) -> str:
+        raise ValueError('too many requests')
+
+    def test_additive_increase(self) -> None:
+        self.run_until_complete(self.limiter.call(self._send, 'a'))
+        self.assertEqual(self.limiter.rate, 4.0 + ratelimit.INCREASE_STEP)
+        for _ in range(5):
+            self.run_until_complete(self.limiter.call(self._send, 'a'))
+        self.assertEqual(self.limiter.rate, 5.0)
+
+    def test_slow_response_halves(self) -> None:
+        self.latency = 2.0
+        self.run_until_complete(self.limiter.call(self._send, 'a'))
+        self.assertEqual(self.limiter.rate, 2.0)
+        self.run_until_complete(self.limiter.call(self._send, 'a'))
+        self.assertEqual(self.limiter.rate, 1.0)
+
+    def test_throttle_errors_halve(self) -> None:
+        with self.assertRaises(ValueError):
+            self.run_until_complete(self.limiter.call(self._fail, 'a'))
+        self.assertEqual(self.limiter.rate, 2.0)
+        self.limiter.record(None, ConnectionResetError())
+        self.assertEqual(self.limiter.rate, 1.0)
+        self.limiter.record(None, asyncio.TimeoutError())
+        self.assertEqual(self.limiter.rate, 1.0)
+
+    def test_other_errors_keep_rate(self) -> None:
+        self.limiter.record(None, ValueError('bad params'))
+        self.assertEqual(self.limiter.rate, 4.0)
+
+    def test_identical_calls_are_coalesced(self) -> None:
+        async def both() -> List[Any]:
+            return list(await asyncio.gather(
+                self.limiter.call(self._send, 'a', 1),
+                self.limiter.call(self._send, 'a', 1),
+                self.limiter.call(self._send, 'b', 1)))
+        self.assertEqual(self.run_until_complete(both()), ['a', 'a', 'b'])
+        self.assertEqual(self.sent, ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
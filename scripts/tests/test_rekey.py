@@ -0,0 +1,64 @@
+import os
+import json
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import scripts.utils as utils
+import scripts.rekey as rekey
+
+OLD = 'old-phrase'
+NEW = 'new-phrase'
+
+
+class TestRekey(unittest.TestCase):
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        self.v1_secret = utils.v1_secret(OLD)
+        self.v2_files = []
+        for i in range(3):
+            # NB: written separately, so each has its own salt
+            path = os.path.join(self.root, 'state-{}.enc'.format(i))
+            utils.write_encrypted_json_file(
+                {'n': i}, path, OLD,
+                key=utils.stretch_phrase(OLD, iterations=1000))
+            self.v2_files.append(path)
+        self.v1_file = os.path.join(self.root, 'keys.enc')
+        with open(self.v1_file, 'wb') as f:
+            f.write(utils.encode_aes(json.dumps({'v': 1}).encode(), OLD))
+        sqlite3.connect(os.path.join(self.root, 'ledger.sqlite')).close()
+        with open(os.path.join(self.root, 'gas_model.json'), 'w') as f:
+            json.dump({'open': [1, 2]}, f)
+
+    def test_finds_only_encrypted_files(self) -> None:
+        with mock.patch.object(rekey, 'is_v1_file',
+                               wraps=rekey.is_v1_file) as is_v1:
+            found = rekey.find_encrypted(self.root, self.v1_secret)
+        self.assertEqual(found, sorted(self.v2_files + [self.v1_file]))
+        self.assertEqual(is_v1.call_count, 1)
+
+    def test_stretches_once_per_salt(self) -> None:
+        files = rekey.find_encrypted(self.root, self.v1_secret)
+        with mock.patch.object(utils, 'stretch_phrase',
+                               wraps=utils.stretch_phrase) as stretch:
+            results = rekey.rekey(
+                OLD, NEW, files, os.path.join(self.root, rekey.JOURNAL_NAME),
+                workers=0, old_v1_secret=self.v1_secret)
+        self.assertEqual(sorted(results[rekey.REKEYED]), files)
+        self.assertEqual(results[rekey.FAILED], [])
+        # NB: one per old salt, and one for the new key
+        self.assertEqual(stretch.call_count, len(self.v2_files) + 1)
+
+        for i, path in enumerate(self.v2_files):
+            self.assertEqual(
+                utils.read_encrypted_json_file(path, NEW), {'n': i})
+        self.assertEqual(
+            utils.read_encrypted_json_file(self.v1_file, NEW), {'v': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+import scripts.scanner as scanner
+
+from riemann import simple, tx
+
+from typing import List
+
+# NB: OP_RETURN_TX from test/constants.js
+OP_RETURN_TX = bytes.fromhex(
+    '010000000001011746bd867400f3494b8f44c24b83e1aa58c4f0ff25b4a61cffeffd4b'
+    'c0f9ba300000000000ffffffff024897070000000000220020a4333e5612ab1a1043b2'
+    '5755c89b16d55184a42f81799e623e6bc39db8539c180000000000000000166a14edb1'
+    'b5c2f39af0fec151732585b1049b07895211024730440220276e0ec78028582054d866'
+    '14c65bc4bf85ff5710b9d3a248ca28dd311eb2fa6802202ec950dd2a8c9435ff2d400c'
+    'c45d7a4854ae085f49e05cc3f503834546d410de012103732783eef3af7e04d3af4444'
+    '30a629b16a9261e4025f52bf4d6d026299c37c7400000000')
+TX_ID = 'd60033c5cf5c199208a9c656a29967810c4e428c22efb492fdd816e6a0a1e548'
+BIDDER = '0xedb1b5c2f39af0fec151732585b1049b07895211'
+
+
+def _outpoints(raw: bytes) -> List[tuple]:
+    t = tx.Tx.from_bytes(raw)
+    return [(i.outpoint.tx_id[::-1].hex(),
+             int.from_bytes(i.outpoint.index, 'little')) for i in t.tx_ins]
+
+
+def _many_inputs() -> bytes:
+    '''A legacy tx with three inputs and two outputs'''
+    ins = [simple.unsigned_input(simple.outpoint('ab' * 32, i))
+           for i in range(3)]
+    outs = [simple.output(1000 + i, 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4')
+            for i in range(2)]
+    return bytes(simple.unsigned_legacy_tx(ins, outs).to_bytes())
+
+
+class TestScanner(unittest.TestCase):
+
+    def test_matches_riemann(self) -> None:
+        t = tx.Tx.from_bytes(OP_RETURN_TX)
+        self.assertEqual(t.tx_id.hex(), TX_ID)
+        ((split_tx_id, index),) = _outpoints(OP_RETURN_TX)
+
+        s = scanner.Scanner([(split_tx_id, index)])
+        (match,) = s.scan_tx(OP_RETURN_TX)
+        self.assertEqual(match.tx_id, TX_ID)
+        self.assertEqual((match.split_tx_id, match.output_index),
+                         (split_tx_id, index))
+        self.assertEqual(match.input_index, 0)
+        self.assertEqual(match.value,
+                         int.from_bytes(t.tx_outs[0].value, 'little'))
+        self.assertEqual(match.bidder, BIDDER)
+
+    def test_value_is_from_the_inputs_output(self) -> None:
+        raw = _many_inputs()
+        outpoints = _outpoints(raw)
+        s = scanner.Scanner(outpoints)
+        matches = s.scan_tx(raw)
+        self.assertEqual([(m.input_index, m.value) for m in matches],
+                         [(0, 1000), (1, 1001), (2, None)])
+        self.assertEqual({m.tx_id for m in matches},
+                         {tx.Tx.from_bytes(raw).tx_id.hex()})
+
+    def test_scan_block(self) -> None:
+        other = _many_inputs()
+        block = b'\x00' * 80 + b'\x02' + other + OP_RETURN_TX
+        s = scanner.Scanner(_outpoints(OP_RETURN_TX) + _outpoints(other)[1:2])
+        self.assertEqual(
+            [(m.tx_id, m.input_index) for m in s.scan_block(block)],
+            [(tx.Tx.from_bytes(other).tx_id.hex(), 1), (TX_ID, 0)])
+        with self.assertRaises(ValueError):
+            s.scan_block(block[:-10])
+
+    def test_malformed(self) -> None:
+        s = scanner.Scanner(_outpoints(OP_RETURN_TX))
+        for raw in [OP_RETURN_TX[:n] for n in [3, 5, 40, 60, 120, 200, 230]] \
+                + [OP_RETURN_TX[:-1], OP_RETURN_TX + b'\x00', b'']:
+            with self.assertRaises(ValueError):
+                s.scan_tx(raw)
+
+
+if __name__ == '__main__':
+    unittest.main()
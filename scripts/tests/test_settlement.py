@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import unittest
+
+import scripts.aio as aio
+import scripts.utils as utils
+import scripts.merkle as merkle
+import scripts.ledger as ledger_db
+import scripts.indexer as indexer
+import scripts.settlement as settlement
+
+from ether import crypto, transactions
+from unittest import mock
+from typing import Any, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts.tests.test_indexer import CONTRACT, SELLER, active_log, chain
+
+
+def _hash256(data: bytes) -> bytes:
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def header_chain(
+        start: int,
+        end: int,
+        fork: str,
+        below: Dict[int, bytes]) -> Dict[int, bytes]:
+    '''Linked headers from start to end, on top of those below'''
+    headers = dict(below)
+    for height in range(start, end + 1):
+        prev = headers.get(height - 1)
+        prev_hash = b'\x00' * 32 if prev is None else _hash256(prev)
+        root = hashlib.sha256('{}-{}'.format(fork, height).encode()).digest()
+        headers[height] = b'\x01\x00\x00\x00' + prev_hash + root \
+            + b'\x00' * 4 + b'\xff\xff\x00\x1d' + b'\x00' * 4
+    return headers
+
+
+class FakeHeaders:
+    '''Serves blockchain.block.headers from one chain, which can change'''
+
+    def __init__(self, headers: Dict[int, bytes]) -> None:
+        self.headers = headers
+        self.calls: List[Tuple[int, int]] = []
+
+    async def get(self, start: int, count: int) -> bytes:
+        self.calls.append((start, count))
+        return b''.join(self.headers[h] for h in range(start, start + count)
+                        if h in self.headers)
+
+
+def run(coro: Any) -> Any:
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class TestHeaderCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.main = header_chain(100, 110, 'a', {})
+        self.node = FakeHeaders(self.main)
+        patcher = mock.patch.object(
+            merkle, 'get_header_chain_bytes', self.node.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = settlement.HeaderCache()
+
+    def _expected(self, headers: Dict[int, bytes], start: int,
+                  end: int) -> bytes:
+        return b''.join(headers[h] for h in range(start, end + 1))
+
+    def test_fetches_and_links(self) -> None:
+        run(self.cache.fetch(100, 110))
+        self.assertEqual(self.cache.chain(100, 110),
+                         self._expected(self.main, 100, 110))
+        run(self.cache.fetch(100, 110))
+        self.assertEqual(len(self.node.calls), 1)
+
+    def test_reorg_with_taller_tip(self) -> None:
+        run(self.cache.fetch(100, 110))
+
+        # NB: blocks from 105 are replaced, and the new tip is 112
+        below = {h: v for h, v in self.main.items() if h < 105}
+        self.node.headers = header_chain(105, 112, 'b', below)
+        run(self.cache.fetch(100, 112))
+        self.assertEqual(self.cache.chain(100, 112),
+                         self._expected(self.node.headers, 100, 112))
+
+    def test_chain_drops_stale_predecessor(self) -> None:
+        run(self.cache.fetch(100, 110))
+        below = {h: v for h, v in self.main.items() if h < 108}
+        reorged = header_chain(108, 110, 'b', below)
+        self.cache.headers[109] = reorged[109]
+
+        # NB: 108 is stale, so both it and 109 go, and are fetched again
+        self.assertIsNone(self.cache.chain(100, 110))
+        self.assertNotIn(108, self.cache.headers)
+        self.node.headers = reorged
+        run(self.cache.fetch(100, 110))
+        self.assertEqual(self.cache.chain(100, 110),
+                         self._expected(reorged, 100, 110))
+
+
+class TestConfirmations(unittest.TestCase):
+
+    def test_mempool_tx_is_unconfirmed(self) -> None:
+        self.assertFalse(settlement._is_confirmed({'hex': '00'}))
+        self.assertFalse(settlement._is_confirmed({'confirmations': 0}))
+        self.assertTrue(settlement._is_confirmed({'confirmations': 1}))
+
+
+class TestNonceManager(unittest.TestCase):
+
+    def test_released_nonces_are_reused_first(self) -> None:
+        nonces = settlement.NonceManager(5)
+        self.assertEqual([nonces.reserve() for _ in range(3)], [5, 6, 7])
+        nonces.release(6)
+        self.assertEqual(nonces.reserve(), 6)
+        self.assertEqual(nonces.reserve(), 8)
+
+    def test_release_at_the_top_rolls_back(self) -> None:
+        nonces = settlement.NonceManager(5)
+        for _ in range(3):
+            nonces.reserve()
+        nonces.release(6)
+        nonces.release(7)
+        self.assertEqual(nonces.next_nonce, 6)
+        self.assertEqual(nonces.take_gaps(), [])
+        nonces.release(5)
+        self.assertEqual(nonces.reserve(), 5)
+
+    def test_take_gaps(self) -> None:
+        nonces = settlement.NonceManager(5)
+        for _ in range(4):
+            nonces.reserve()
+        nonces.release(5)
+        nonces.release(7)
+        self.assertEqual(nonces.take_gaps(), [5, 7])
+        self.assertEqual(nonces.reserve(), 9)
+
+
+class TestSubmit(unittest.TestCase):
+
+    def setUp(self) -> None:
+        patcher = mock.patch.object(settlement, 'RETRY_DELAY', 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.errors: List[Exception] = []
+        self.sent: List[str] = []
+
+    async def _send(self, signed_hex: str) -> str:
+        self.sent.append(signed_hex)
+        if self.errors:
+            raise self.errors.pop(0)
+        return '0xhash'
+
+    def _submit(self, nonce: int) -> Tuple[settlement.Settler,
+                                           'asyncio.Future[str]']:
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        settler = settlement.Settler(
+            '11' * 32, 5, self._send, signer=aio.Signer(executor=executor))
+        settler._make_queues()
+        future = asyncio.get_event_loop().create_future()
+        pending = settlement._Pending(
+            settlement.Fill('aa' * 32, CONTRACT, 1), future)
+        settler._signed.put_nowait((pending, nonce, 'f86b05'))
+        return settler, future
+
+    def _run_until(self, settler: settlement.Settler,
+                   future: 'asyncio.Future[Any]') -> None:
+        task = asyncio.ensure_future(settler._submit())
+        try:
+            run(asyncio.wait_for(asyncio.shield(future), 1))
+        finally:
+            task.cancel()
+
+    def test_timeout_resends_with_same_nonce(self) -> None:
+        settler, future = self._submit(5)
+        settler.nonces.reserve()
+        self.errors = [asyncio.TimeoutError()]
+        self._run_until(settler, future)
+        self.assertEqual(future.result(), '0xhash')
+        self.assertEqual(self.sent, ['f86b05', 'f86b05'])
+        self.assertEqual(settler.nonces.reserve(), 6)
+
+    def test_already_known_counts_as_sent(self) -> None:
+        settler, future = self._submit(5)
+        self.errors = [indexer.RPCError('already known')]
+        self._run_until(settler, future)
+        self.assertEqual(
+            future.result(),
+            '0x' + utils.keccak256(bytes.fromhex('f86b05')).hex())
+
+    def test_rejection_releases_nonce(self) -> None:
+        settler, future = self._submit(5)
+        settler.nonces.reserve()
+        self.errors = [indexer.RPCError('insufficient funds')]
+        task = asyncio.ensure_future(settler._submit())
+        try:
+            pending = run(asyncio.wait_for(settler._claims.get(), 1))
+        finally:
+            task.cancel()
+        self.assertIs(pending.future, future)
+        self.assertEqual(settler.nonces.reserve(), 5)
+
+    def test_gap_is_filled_after_last_attempt(self) -> None:
+        settler, future = self._submit(5)
+        for _ in range(2):
+            settler.nonces.reserve()
+        self.errors = [indexer.RPCError('insufficient funds')]
+        settlement.MAX_ATTEMPTS, attempts = 1, settlement.MAX_ATTEMPTS
+        self.addCleanup(setattr, settlement, 'MAX_ATTEMPTS', attempts)
+        with self.assertRaises(indexer.RPCError):
+            self._run_until(settler, future)
+
+        # NB: nonce 6 is already out, so 5 is sent as a no-op to ourselves
+        run(asyncio.sleep(0.1))
+        self.assertEqual(len(self.sent), 2)
+        no_op = transactions.SignedEthTx.deserialize(
+            bytes.fromhex(self.sent[1]))
+        self.assertEqual(no_op.nonce, 5)
+        self.assertEqual(no_op.value, 0)
+        self.assertEqual(no_op.data, b'')
+        self.assertEqual(
+            no_op.to, crypto.priv_to_addr(bytes.fromhex('11' * 32)))
+        self.assertEqual(settler.nonces.reserve(), 7)
+
+
+class TestLedgerFill(unittest.TestCase):
+
+    def test_uses_listing_req_diff(self) -> None:
+        split_tx_id = 'ab' * 32
+        ledger = ledger_db.AuctionLedger(':memory:')
+        ledger.record_auctions(split_tx_id, [(3, 550, b'\x00')], [(1, 2)])
+        ledger.mark_filled(split_tx_id, 3, 'cd' * 32)
+        (record,) = ledger.unclaimed_fills()
+
+        ix = indexer.Indexer(chain(4, [], {0: 'a'}), ':memory:')
+        self.assertIsNone(settlement.ledger_fill(ix, record))
+
+        lid = utils.keccak256(
+            bytes.fromhex(split_tx_id)[::-1] + (3).to_bytes(4, 'little'))
+        log = active_log(2, 'a', 0, SELLER, 1000, b'\x01', 77)
+        log['topics'][1] = '0x' + lid.hex()
+        ix.rpc = chain(4, [log], {0: 'a'})
+        ix.sync([CONTRACT])
+        fill = settlement.ledger_fill(ix, record)
+        assert fill is not None
+        self.assertEqual(fill.req_diff, 77)
+        self.assertEqual(fill.contract_address, CONTRACT)
+        self.assertEqual((fill.split_tx_id, fill.output_index),
+                         (split_tx_id, 3))
+        ix.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+import os
+import copy
+import hashlib
+import tempfile
+import unittest
+import multiprocessing
+from unittest import mock
+
+import scripts.utils as utils
+import scripts.shards as shards
+import scripts.benchmarks as benchmarks
+import scripts.interface_wrapper as iw
+
+from ether import transactions
+from typing import Any, Dict, List, Optional, Tuple
+
+CONTRACT = '0x' + 'ab' * 20
+ETH_KEY = b'\x11' * 32
+OTHER_ETH_KEY = b'\x22' * 32
+RECIPIENT = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+PRIVKEY = hashlib.sha256(b'shards-test-key').digest()
+KEYPAIR = (PRIVKEY.hex(), utils.to_pubkey(utils.coerce_key(PRIVKEY)).hex())
+
+
+def _root(i: int, num_auctions: int) -> Dict[str, Any]:
+    return {'tx_id': hashlib.sha256(bytes([i])).hexdigest(), 'index': i % 3,
+            'value': 10 ** 6, 'control_addr': RECIPIENT, 'key': 'k',
+            'num_auctions': num_auctions}
+
+
+def _leaf(i: int) -> Dict[str, Any]:
+    return {'tx_id': hashlib.sha256(b'tree').hexdigest(), 'index': i,
+            'value': 550, 'key': 'k', 'leaf': True}
+
+
+def _job(roots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {'job_id': 'j', 'contract_address': CONTRACT,
+            'recipient': RECIPIENT, 'format': [[1000, 600000]],
+            'req_diff': 1, 'eth_value': 1, 'start_nonce': 120,
+            'roots': roots}
+
+
+def _split_tx(tx_id: str, index: int, n: int) -> bytes:
+    vin = b'\x01' + bytes.fromhex(tx_id)[::-1] + index.to_bytes(4, 'little') \
+        + b'\x00' + b'\xff' * 4
+    vout = bytes([n]) + b''.join(
+        (550).to_bytes(8, 'little') + b'\x01\x51' for _ in range(n))
+    return b'\x01\x00\x00\x00' + vin + vout + b'\x00' * 4
+
+
+def _open_data(outpoint: bytes) -> str:
+    '''ABI calldata whose first bytes arg is a partial tx spending outpoint'''
+    partial = b'\x01\x00\x00\x00\x01' + outpoint + b'\x00' + b'\xff' * 4 \
+        + b'\x00' + b'\x00' * 4
+    padded = partial + b'\x00' * (-len(partial) % 32)
+    return (b'\xde\xad\xbe\xef' + (32 * 5).to_bytes(32, 'big') + b'\x00' * 128
+            + len(partial).to_bytes(32, 'big') + padded).hex()
+
+
+def _eth_tx(nonce: int, data: str, value: int = 1,
+            key: bytes = ETH_KEY) -> str:
+    unsigned = transactions.UnsignedEthTx(
+        nonce, 10 ** 9, 300000, CONTRACT, value, bytes.fromhex(data), 1)
+    return unsigned.sign(key).serialize().hex()
+
+
+def _outputs(manifest: shards.Manifest) -> List[shards.ShardOutput]:
+    '''Shard outputs as run_shard would make them'''
+    outputs = []
+    for shard in manifest['shards']:
+        results = []
+        for i in range(*shard['roots']):
+            root = manifest['roots'][i]
+            outpoint = bytes.fromhex(root['tx_id'])[::-1] \
+                + root['index'].to_bytes(4, 'little')
+            split_tx: Optional[str] = None
+            if root.get('leaf'):
+                outpoints = [outpoint]
+            else:
+                raw = _split_tx(root['tx_id'], root['index'],
+                                root['num_auctions'])
+                split_tx = raw.hex()
+                outpoints = [shards._tx_id(raw) + j.to_bytes(4, 'little')
+                             for j in range(root['num_auctions'])]
+            open_data = [_open_data(o) for o in outpoints]
+            results.append({
+                'root': i,
+                'split_tx': split_tx,
+                'open_data': open_data,
+                'eth_txns': [_eth_tx(root['nonces'][0] + j, d)
+                             for j, d in enumerate(open_data)],
+                'nonces': root['nonces']})
+        outputs.append({'job_id': 'j',
+                        'manifest_hash': shards.manifest_hash(manifest),
+                        'shard': shard['shard'],
+                        'results': results})
+    return outputs
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.job = _job([_root(i, 1 + i % 4) for i in range(6)]
+                        + [_leaf(i) for i in range(3)])
+
+    def test_shards_cover_roots_and_nonces(self) -> None:
+        for num_shards in range(1, 12):
+            manifest = shards.plan(self.job, num_shards)
+            ranges = [s['roots'] for s in manifest['shards']]
+            self.assertEqual(len(ranges), min(num_shards, 9))
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], 9)
+            for a, b in zip(ranges, ranges[1:]):
+                self.assertLess(a[0], a[1])
+                self.assertEqual(a[1], b[0])
+            nonces = [s['nonces'] for s in manifest['shards']]
+            self.assertEqual(nonces[0][0], 120)
+            self.assertEqual(nonces[-1][1], 120 + 13 + 3)
+            for a, b in zip(nonces, nonces[1:]):
+                self.assertEqual(a[1], b[0])
+
+    def test_rejects_bad_jobs(self) -> None:
+        for roots in [[], [_root(0, 1), _root(0, 2)], [_root(0, 0)]]:
+            with self.assertRaises(ValueError):
+                shards.plan(_job(roots), 1)
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.manifest = shards.plan(
+            _job([_root(i, 1 + i % 3) for i in range(5)]
+                 + [_leaf(i) for i in range(2)]), 3)
+        self.outputs = _outputs(self.manifest)
+
+    def test_merge(self) -> None:
+        merged = shards.merge(self.manifest, self.outputs[::-1])
+        self.assertEqual([r['root'] for r in merged['results']],
+                         list(range(7)))
+        nonces = [transactions.SignedEthTx.deserialize(
+            bytes.fromhex(t)).nonce for t in merged['eth_txns']]
+        self.assertEqual(nonces, list(range(120, 120 + len(nonces))))
+
+    def test_problems(self) -> None:
+        bad = copy.deepcopy(self.outputs)
+        first = bad[0]['results'][0]
+        first['eth_txns'][0] = _eth_tx(120, first['open_data'][0], value=2)
+        second = bad[1]['results'][0]
+        second['eth_txns'][0] = _eth_tx(120, second['open_data'][0])
+        bad.pop()
+        with self.assertRaises(shards.ShardError) as e:
+            shards.merge(self.manifest, bad)
+        self.assertEqual(e.exception.problems, [
+            'shard 2 is missing',
+            'root 0 eth tx 0 pays the wrong contract or value',
+            'root {} eth tx 0 has nonce 120, expected {}'.format(
+                second['root'], second['nonces'][0]),
+            'nonce 120 is used twice'])
+
+    def test_single_sender(self) -> None:
+        bad = copy.deepcopy(self.outputs)
+        last = bad[-1]['results'][-1]
+        last['eth_txns'][0] = _eth_tx(
+            last['nonces'][0], last['open_data'][0], key=OTHER_ETH_KEY)
+        (problem,) = shards.verify(self.manifest, bad)
+        self.assertTrue(problem.startswith(
+            'root {} eth tx 0 is signed by'.format(last['root'])))
+
+    def test_unknown_shard(self) -> None:
+        bad = copy.deepcopy(self.outputs)
+        bad[0]['shard'] = 7
+        problems = shards.verify(self.manifest, bad)
+        self.assertIn('shard 7 is not in the manifest', problems)
+        self.assertIn('shard 0 is missing', problems)
+
+
+def _patch_abi(test: unittest.TestCase) -> None:
+    if not os.path.exists(iw.BUILD_FILE):
+        # NB: patched before the pool forks, so the workers see it too
+        patcher = mock.patch.object(iw, 'ABI', benchmarks.OPEN_ABI)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+@unittest.skipUnless(
+    os.path.exists(iw.BUILD_FILE)
+    or multiprocessing.get_start_method() == 'fork',
+    'workers need the contract build')
+class TestSimulate(unittest.TestCase):
+
+    def setUp(self) -> None:
+        _patch_abi(self)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.out_dir = tmp.name
+        self.manifest = shards.plan(
+            _job([_root(0, 2), _root(1, 1), _leaf(0)]), 2)
+
+    def _simulate(self) -> Tuple[Dict[str, Any], List[int]]:
+        merged = shards.simulate(
+            self.manifest, {'k': KEYPAIR}, ETH_KEY.hex(), self.out_dir)
+        nonces = [transactions.SignedEthTx.deserialize(
+            bytes.fromhex(t)).nonce for t in merged['eth_txns']]
+        return merged, nonces
+
+    def test_simulate(self) -> None:
+        merged, nonces = self._simulate()
+        self.assertEqual(nonces, [120, 121, 122, 123])
+        self.assertEqual([r['root'] for r in merged['results']], [0, 1, 2])
+        self.assertIsNone(merged['results'][2]['split_tx'])
+
+        # NB: a rerun is served from each shard's cache
+        again, _ = self._simulate()
+        self.assertEqual(again, merged)
+
+
+if __name__ == '__main__':
+    unittest.main()
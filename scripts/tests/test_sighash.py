@@ -0,0 +1,86 @@
+import hashlib
+import unittest
+
+import scripts.sighash as sighash
+
+from riemann import simple
+from riemann import utils as rutils
+from riemann.tx import Tx
+
+from typing import List
+
+ADDRESSES = ['bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4',
+             'bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3',
+             '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2']
+PKH = hashlib.sha256(b'sighash-test-pkh').digest()[:20]
+
+# NB: length-prefixed script codes, and one without its prefix, which
+#     riemann hashes as it is given
+SCRIPTS = [
+    b'\x19\x76\xa9\x14' + PKH + b'\x88\xac',
+    b'\x47\x52\x21' + b'\x02' * 33 + b'\x21' + b'\x03' * 33 + b'\x52\xae',
+    b'\xfd\x2c\x01' + b'\x51' * 300,
+    b'\x76\xa9\x14' + PKH + b'\x88\xac']
+
+
+def _witness_tx(num_ins: int, num_outs: int) -> Tx:
+    tx_ins = [simple.unsigned_input(
+        simple.outpoint(hashlib.sha256(bytes([i])).hexdigest(), i),
+        sequence=0xfffffffd - i) for i in range(num_ins)]
+    tx_outs = [simple.output(10000 * (i + 1), ADDRESSES[i % len(ADDRESSES)])
+               for i in range(num_outs)]
+    return simple.unsigned_witness_tx(tx_ins, tx_outs, lock_time=500000)
+
+
+def _values(num_ins: int) -> List[bytes]:
+    return [rutils.i2le_padded(100000 + 7 * i, 8) for i in range(num_ins)]
+
+
+class TestSighashContext(unittest.TestCase):
+
+    def assertMatchesRiemann(self, t: Tx, single: bool) -> None:
+        ctx = sighash.SighashContext(t)
+        values = _values(len(t.tx_ins))
+        for index in range(len(t.tx_ins)):
+            for script in SCRIPTS:
+                for anyone_can_pay in [False, True]:
+                    args = (index, script, values[index], anyone_can_pay)
+                    with self.subTest(index=index, script=script[:4],
+                                      anyone_can_pay=anyone_can_pay):
+                        self.assertEqual(ctx.sighash_all(*args),
+                                         t.sighash_all(*args))
+                        if single:
+                            self.assertEqual(ctx.sighash_single(*args),
+                                             t.sighash_single(*args))
+
+    def test_multi_input(self) -> None:
+        for num_ins, num_outs in [(1, 1), (3, 3), (3, 5), (5, 2)]:
+            t = _witness_tx(num_ins, num_outs)
+            self.assertMatchesRiemann(t, single=num_ins <= num_outs)
+
+    def test_single_without_matching_output(self) -> None:
+        t = _witness_tx(3, 2)
+        ctx = sighash.SighashContext(t)
+        self.assertEqual(
+            ctx.sighash_single(1, SCRIPTS[0], _values(3)[1]),
+            t.sighash_single(1, SCRIPTS[0], _values(3)[1]))
+        for anyone_can_pay in [False, True]:
+            with self.assertRaises(NotImplementedError):
+                ctx.sighash_single(
+                    2, SCRIPTS[0], _values(3)[2], anyone_can_pay)
+            with self.assertRaises(NotImplementedError):
+                t.sighash_single(2, SCRIPTS[0], _values(3)[2], anyone_can_pay)
+
+    def test_witnesses_do_not_change_digests(self) -> None:
+        t = _witness_tx(2, 2)
+        ctx = sighash.SighashContext(t)
+        before = ctx.sighash_all(1, SCRIPTS[0], _values(2)[1])
+        witnessed = t.copy(tx_witnesses=[
+            simple.tx.make_witness([b'\x01' * 71, b'\x02' * 33])
+            for _ in range(2)])
+        self.assertEqual(before,
+                         witnessed.sighash_all(1, SCRIPTS[0], _values(2)[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import random
+import unittest
+
+import scripts.tier_index as tier_index
+
+from typing import Dict, List
+
+KEY = ('aa' * 32, 0)
+OTHER = ('bb' * 32, 1)
+
+
+class TestTierIndex(unittest.TestCase):
+
+    def assertMatchesSchedules(
+            self,
+            index: tier_index.TierIndex,
+            tiers: Dict[tier_index.AuctionKey, List[tier_index.Tier]]) \
+            -> None:
+        schedules = {k: tier_index.Schedule.from_tiers(t)
+                     for k, t in tiers.items()}
+        for key, schedule in schedules.items():
+            self.assertEqual(index.price(key), schedule.price(index.height))
+        changes = [c for c in (s.next_change(index.height)
+                               for s in schedules.values()) if c is not None]
+        self.assertEqual(index.next_change(), min(changes, default=None))
+
+    def test_advance(self) -> None:
+        index = tier_index.TierIndex(5)
+        index.add(KEY, [(30, 10), (20, 20), (10, 30)])
+        index.add(OTHER, [(40, 5), (35, 25)])
+        self.assertIsNone(index.price(KEY))
+        self.assertEqual(index.price(OTHER), 40)
+        self.assertEqual(index.next_change(), 10)
+
+        self.assertEqual(index.advance(9), [])
+        self.assertEqual(index.advance(20), [KEY])
+        self.assertEqual(index.price(KEY), 20)
+        self.assertEqual(index.next_change(), 25)
+        self.assertEqual(sorted(index.advance(40)), [KEY, OTHER])
+        self.assertEqual(dict(index.prices()), {KEY: 10, OTHER: 35})
+        self.assertIsNone(index.next_change())
+
+    def test_re_add_replaces_tiers(self) -> None:
+        index = tier_index.TierIndex()
+        index.add(KEY, [(1, 10), (2, 20)])
+        index.add(KEY, [(5, 30), (6, 40)])
+        self.assertEqual(index.next_change(), 30)
+        self.assertEqual(index.advance(10), [])
+        self.assertIsNone(index.price(KEY))
+        self.assertEqual(index.advance(30), [KEY])
+        self.assertEqual(index.price(KEY), 5)
+
+    def test_remove_then_add(self) -> None:
+        index = tier_index.TierIndex()
+        index.add(KEY, [(1, 10), (2, 20)])
+        index.remove(KEY)
+        self.assertIsNone(index.next_change())
+        self.assertNotIn(KEY, index)
+        index.add(KEY, [(5, 30)])
+        self.assertEqual(index.next_change(), 30)
+        self.assertEqual(index.advance(20), [])
+        self.assertEqual(index.advance(30), [KEY])
+
+    def test_rewind(self) -> None:
+        index = tier_index.TierIndex()
+        index.add(KEY, [(3, 10), (2, 20), (1, 30)])
+        index.add(OTHER, [(9, 15)])
+        index.advance(25)
+        self.assertEqual(sorted(index.advance(12)), [KEY, OTHER])
+        self.assertEqual(index.price(KEY), 3)
+        self.assertIsNone(index.price(OTHER))
+        self.assertEqual(index.next_change(), 15)
+        self.assertEqual(sorted(index.advance(20)), [KEY, OTHER])
+        self.assertEqual(index.price(KEY), 2)
+
+    def test_duplicate_lock_times(self) -> None:
+        index = tier_index.TierIndex()
+        index.add(KEY, [(3, 10), (2, 10), (1, 20)])
+        self.assertEqual(index.next_change(), 10)
+        self.assertEqual(index.advance(10), [KEY])
+        self.assertEqual(index.price(KEY),
+                         tier_index.Schedule.from_tiers(
+                             [(3, 10), (2, 10), (1, 20)]).price(10))
+        self.assertEqual(index.next_change(), 20)
+
+    def test_random_operations(self) -> None:
+        rng = random.Random(49)
+        keys = [('{:064x}'.format(n), n) for n in range(6)]
+        index = tier_index.TierIndex()
+        tiers: Dict[tier_index.AuctionKey, List[tier_index.Tier]] = {}
+        for _ in range(2000):
+            op = rng.random()
+            key = rng.choice(keys)
+            if op < 0.3:
+                tiers[key] = [(rng.randrange(1, 100), rng.randrange(60))
+                              for _ in range(rng.randrange(1, 5))]
+                index.add(key, tiers[key])
+            elif op < 0.4:
+                index.remove(key)
+                tiers.pop(key, None)
+            else:
+                height = max(0, index.height + rng.randrange(-8, 12))
+                schedules = {k: tier_index.Schedule.from_tiers(t)
+                             for k, t in tiers.items()}
+                before = {k: s.active_tier(index.height)
+                          for k, s in schedules.items()}
+                changed = index.advance(height)
+                self.assertEqual(len(changed), len(set(changed)))
+                self.assertEqual(
+                    set(changed),
+                    {k for k, s in schedules.items()
+                     if s.active_tier(height) != before[k]})
+            self.assertMatchesSchedules(index, tiers)
+
+
+if __name__ == '__main__':
+    unittest.main()
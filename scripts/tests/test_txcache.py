@@ -0,0 +1,123 @@
+import asyncio
+import itertools
+import unittest
+from unittest import mock
+
+import scripts.merkle as merkle
+import scripts.txcache as txcache
+
+from riemann import simple, tx
+
+from typing import Any, Dict, List
+
+ADDRESS = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+
+
+def _raw_tx(n: int) -> bytes:
+    '''A distinct tx per n, all the same size'''
+    ins = [simple.unsigned_input(simple.outpoint('ab' * 32, n))]
+    outs = [simple.output(1000 + n, ADDRESS)]
+    return bytes(simple.unsigned_legacy_tx(ins, outs).to_bytes())
+
+
+def _tx_id(raw: bytes) -> str:
+    return tx.Tx.from_bytes(raw).tx_id.hex()
+
+
+class TestTxCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # NB: every call is one tick later, so last_used never ties
+        clock = itertools.count(1)
+        patcher = mock.patch.object(
+            txcache.time, 'time', lambda: float(next(clock)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.raws = [_raw_tx(n) for n in range(4)]
+        self.ids = [_tx_id(raw) for raw in self.raws]
+        self.size = len(self.raws[0])
+
+    def _cache(self, num_txns: int) -> txcache.TxCache:
+        cache = txcache.TxCache(':memory:', max_bytes=self.size * num_txns)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get(self) -> None:
+        cache = self._cache(4)
+        self.assertIsNone(cache.get(self.ids[0]))
+        cache.put(self.ids[0], self.raws[0], 100)
+        for _ in range(2):
+            hit = cache.get(self.ids[0])
+            assert hit is not None
+            self.assertEqual(hit[0].to_bytes(), self.raws[0])
+            self.assertEqual(hit[1], 100)
+
+    def test_evicts_least_recently_used(self) -> None:
+        cache = self._cache(3)
+        for i in range(3):
+            cache.put(self.ids[i], self.raws[i], 100)
+        cache.get(self.ids[0])
+        cache.put(self.ids[3], self.raws[3], 100)
+        self.assertIsNone(cache.get(self.ids[1]))
+        for i in [0, 2, 3]:
+            self.assertIsNotNone(cache.get(self.ids[i]))
+        self.assertEqual(cache.size, 3 * self.size)
+
+    def test_memo_hits_count_as_use(self) -> None:
+        cache = self._cache(2)
+        for i in range(3):
+            cache.put(self.ids[i], self.raws[i], 100)
+        # NB: 0 was evicted. 1 is read from disk, then 2, then 1 from memory
+        cache.get(self.ids[1])
+        cache.get(self.ids[2])
+        cache.get(self.ids[1])
+        cache.put(self.ids[3], self.raws[3], 100)
+        self.assertIsNone(cache.get(self.ids[2]))
+        self.assertIsNotNone(cache.get(self.ids[1]))
+
+
+class TestConfirmations(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        cache = txcache.TxCache(':memory:')
+        self.addCleanup(cache.close)
+        self.raw = _raw_tx(0)
+        self.tx_id = _tx_id(self.raw)
+        self.confirmations = 0
+        self.calls: List[str] = []
+        for name, value in [('TX_CACHE', cache), ('_rpc', self._rpc),
+                            ('get_latest_blockheight', self._tip)]:
+            patcher = mock.patch.object(merkle, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def _rpc(self, method: str, *params: Any) -> Dict[str, Any]:
+        self.calls.append(method)
+        return {'hex': self.raw.hex(), 'confirmations': self.confirmations}
+
+    async def _tip(self) -> int:
+        return 700000
+
+    def _get(self) -> Dict[str, Any]:
+        tx_json, _ = self.loop.run_until_complete(
+            merkle.get_tx_from_api(self.tx_id))
+        return tx_json
+
+    def test_caches_only_deep_txns(self) -> None:
+        for confirmations in [0, 1, txcache.MIN_CONFIRMATIONS - 1]:
+            self.confirmations = confirmations
+            self._get()
+        self.assertEqual(len(self.calls), 3)
+
+        self.confirmations = txcache.MIN_CONFIRMATIONS
+        fetched = self._get()
+        cached = self._get()
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual(cached['block_height'], fetched['block_height'])
+        self.assertEqual(cached['hex'], self.raw.hex())
+
+
+if __name__ == '__main__':
+    unittest.main()
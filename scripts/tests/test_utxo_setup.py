@@ -0,0 +1,34 @@
+import unittest
+
+import scripts.fees as fees
+import scripts.utxo_setup as us
+
+from riemann import utils as rutils
+
+ADDR = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+TX_ID = 'ab' * 32
+
+
+class TestGenerateSmallUtxos(unittest.TestCase):
+
+    def test_change_pays_the_fee(self) -> None:
+        t = us.generate_small_utxos(
+            TX_ID, 0, 100000, ADDR, 10, None, ADDR, feerate=2)
+        values = [rutils.le2i(o.value) for o in t.tx_outs]
+        self.assertEqual(values[:10], [550] * 10)
+        self.assertEqual(values[10], 100000 - 5500 - fees.fee_for(t, 2))
+
+    def test_dust_change_is_rejected(self) -> None:
+        fee = 200
+        us.generate_small_utxos(
+            TX_ID, 0, 5500 + fee + us.DUST_LIMIT, ADDR, 10, fee, ADDR)
+        for prevout_value in [5500 + fee + us.DUST_LIMIT - 1, 5500, 1000]:
+            with self.assertRaises(ValueError):
+                us.generate_small_utxos(
+                    TX_ID, 0, prevout_value, ADDR, 10, fee, ADDR)
+        with self.assertRaises(ValueError):
+            us.generate_small_utxos(TX_ID, 0, 5600, ADDR, 10, None, ADDR)
+
+
+if __name__ == '__main__':
+    unittest.main()
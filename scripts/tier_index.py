@@ -0,0 +1,197 @@
+'''
+Tracks the current price of every open dutch auction as blocks arrive.
+
+Each auction keeps its tiers' lock_times sorted, so its price at any
+height is a bisect. One heap holds each auction's next tier activation,
+so advancing to a new tip only touches auctions whose price changes.
+Current prices at the tip are then a dict lookup, and the next change
+anywhere is the top of the heap.
+
+A tier is active at height H once its lock_time is at or below H, i.e.
+once its tx can be mined in the next block.
+
+Example:
+    index = TierIndex.from_ledger(ledger, height)
+    index.advance(new_height)
+    price = index.price(('<split txid>', 3))
+'''
+import heapq
+import bisect
+
+import scripts.ledger as ledger_db
+
+from typing import (Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Sequence, Tuple)
+
+AuctionKey = Tuple[str, int]  # split txid, output index
+Tier = Tuple[int, int]        # value, lock_time
+
+
+class Schedule(NamedTuple):
+    '''An auction's tiers, sorted by lock_time'''
+    lock_times: Tuple[int, ...]
+    values: Tuple[int, ...]
+
+    @classmethod
+    def from_tiers(cls, tiers: Iterable[Tier]) -> 'Schedule':
+        ordered = sorted(tiers, key=lambda t: t[1])
+        return cls(tuple(t[1] for t in ordered),
+                   tuple(t[0] for t in ordered))
+
+    def active_tier(self, height: int) -> int:
+        '''The index of the active tier at a height. -1 if none is yet'''
+        return bisect.bisect_right(self.lock_times, height) - 1
+
+    def price(self, height: int) -> Optional[int]:
+        i = self.active_tier(height)
+        return self.values[i] if i >= 0 else None
+
+    def next_change(self, height: int) -> Optional[int]:
+        '''The lock_time of the next tier after a height, if any'''
+        i = self.active_tier(height) + 1
+        return self.lock_times[i] if i < len(self.lock_times) else None
+
+
+class TierIndex:
+    '''
+    The active tier of many auctions at the current tip
+
+    Args:
+        height (int): the current tip height
+    '''
+
+    def __init__(self, height: int = 0) -> None:
+        self.height = height
+        self.schedules: Dict[AuctionKey, Schedule] = {}
+        self._tiers: Dict[AuctionKey, int] = {}
+        # NB: each add gets a new generation, so entries pushed for an
+        #     earlier add of the same key never match again
+        self._generations: Dict[AuctionKey, int] = {}
+        self._next_generation = 0
+        # NB: (lock_time, key, tier, generation). entries for removed or
+        #     re-added auctions, or from before a rewind, are skipped
+        self._heap: List[Tuple[int, AuctionKey, int, int]] = []
+
+    @classmethod
+    def from_ledger(
+            cls,
+            ledger: ledger_db.AuctionLedger,
+            height: int) -> 'TierIndex':
+        '''Indexes every open auction in a ledger'''
+        index = cls(height)
+        key: Optional[AuctionKey] = None
+        tiers: List[Tier] = []
+        for split_tx_id, output_index, value, lock_time in \
+                ledger.open_tiers():
+            if (split_tx_id, output_index) != key:
+                if key is not None:
+                    index.add(key, tiers)
+                key, tiers = (split_tx_id, output_index), []
+            tiers.append((value, lock_time))
+        if key is not None:
+            index.add(key, tiers)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.schedules)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.schedules
+
+    def _schedule_next(self, key: AuctionKey) -> None:
+        schedule = self.schedules[key]
+        tier = self._tiers[key] + 1
+        if tier < len(schedule.lock_times):
+            heapq.heappush(
+                self._heap,
+                (schedule.lock_times[tier], key, tier,
+                 self._generations[key]))
+
+    def _is_current(self, entry: Tuple[int, AuctionKey, int, int]) -> bool:
+        '''Whether a heap entry is the pending activation of its auction'''
+        _, key, tier, generation = entry
+        return self._generations.get(key) == generation \
+            and self._tiers[key] == tier - 1
+
+    def add(self, key: AuctionKey, tiers: Sequence[Tier]) -> None:
+        '''
+        Indexes an auction from its (value, lock_time) tiers. Adding a
+        key again replaces its tiers
+        '''
+        schedule = Schedule.from_tiers(tiers)
+        self.schedules[key] = schedule
+        self._tiers[key] = schedule.active_tier(self.height)
+        self._generations[key] = self._next_generation
+        self._next_generation += 1
+        self._schedule_next(key)
+
+    def remove(self, key: AuctionKey) -> None:
+        '''Stops tracking an auction, e.g. once filled or closed'''
+        self.schedules.pop(key, None)
+        self._tiers.pop(key, None)
+        self._generations.pop(key, None)
+
+    def advance(self, height: int) -> List[AuctionKey]:
+        '''
+        Moves the tip to a new height. Heights below the current one, as
+        after a reorg, recompute every auction
+
+        Returns:
+            (list(tuple)): the auctions whose price changed
+        '''
+        if height < self.height:
+            return self.rewind(height)
+        self.height = height
+        changed = []
+        heap = self._heap
+        while heap and heap[0][0] <= height:
+            entry = heapq.heappop(heap)
+            if not self._is_current(entry):
+                continue  # NB: stale, from a removed or re-added auction
+            key = entry[1]
+            self._tiers[key] = self.schedules[key].active_tier(height)
+            self._schedule_next(key)
+            changed.append(key)
+        return changed
+
+    def rewind(self, height: int) -> List[AuctionKey]:
+        '''Moves the tip back, rebuilding the activation heap'''
+        self.height = height
+        self._heap = []
+        changed = []
+        for key, schedule in self.schedules.items():
+            tier = schedule.active_tier(height)
+            if tier != self._tiers[key]:
+                changed.append(key)
+            self._tiers[key] = tier
+            self._schedule_next(key)
+        return changed
+
+    def price(self, key: AuctionKey) -> Optional[int]:
+        '''An auction's price at the tip. None before its first tier'''
+        tier = self._tiers[key]
+        return self.schedules[key].values[tier] if tier >= 0 else None
+
+    def price_at(self, key: AuctionKey, height: int) -> Optional[int]:
+        '''An auction's price at any height'''
+        return self.schedules[key].price(height)
+
+    def next_change(
+            self,
+            key: Optional[AuctionKey] = None) -> Optional[int]:
+        '''
+        The next height at which a price changes. For one auction, or for
+        any auction if key is None
+        '''
+        if key is not None:
+            return self.schedules[key].next_change(self.height)
+        heap = self._heap
+        while heap and not self._is_current(heap[0]):
+            heapq.heappop(heap)  # NB: drop stale entries
+        return heap[0][0] if heap else None
+
+    def prices(self) -> Iterator[Tuple[AuctionKey, int]]:
+        '''Each auction's price at the tip, skipping those not yet active'''
+        for key, tier in self._tiers.items():
+            if tier >= 0:
+                yield key, self.schedules[key].values[tier]
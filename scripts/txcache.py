@@ -0,0 +1,143 @@
+import os
+import time
+import sqlite3
+
+import scripts.utils as utils
+import scripts.metrics as metrics
+
+from riemann import tx
+
+from collections import OrderedDict
+from typing import cast, Dict, Optional, Tuple
+
+TX_CACHE_PATH = os.path.join(utils.PATH, 'txcache.sqlite')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MEMO_SIZE = 1024
+
+# NB: a tx's bytes never change, but a shallow block can be reorged out,
+#     moving the tx to a new height. only cache once this deep
+MIN_CONFIRMATIONS = 6
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS txs (
+    tx_id       TEXT PRIMARY KEY,
+    raw         BLOB NOT NULL,
+    height      INTEGER NOT NULL,
+    last_used   REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS txs_by_last_used ON txs (last_used);
+'''
+
+
+class TxCache:
+    '''
+    A persistent LRU cache of confirmed transactions, keyed by txid.
+    Stores raw bytes and the confirmed height on disk, up to max_bytes of
+    raw txns, and memoizes parsed Tx objects in memory. Memo hits are
+    written back to last_used in batches, before evicting and on close,
+    so that a tx used only from memory is not evicted as stale.
+
+    Args:
+        path       (str): the database file. ':memory:' for a throwaway cache
+        max_bytes  (int): the most raw tx bytes to keep on disk
+        memo_size  (int): the most parsed txns to keep in memory
+    '''
+
+    def __init__(
+            self,
+            path: str = TX_CACHE_PATH,
+            max_bytes: int = DEFAULT_MAX_BYTES,
+            memo_size: int = DEFAULT_MEMO_SIZE) -> None:
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.max_bytes = max_bytes
+        self.memo_size = memo_size
+        self._memo: 'OrderedDict[str, Tuple[tx.Tx, int]]' = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self.size = self.conn.execute(
+            'SELECT COALESCE(SUM(LENGTH(raw)), 0) FROM txs').fetchone()[0]
+
+    def close(self) -> None:
+        with self.conn:
+            self._flush_touched()
+        self.conn.close()
+
+    def _flush_touched(self) -> None:
+        '''Writes memo hits' last_used to disk. Call in a transaction'''
+        self.conn.executemany(
+            'UPDATE txs SET last_used = ? WHERE tx_id = ?',
+            [(used, tx_id) for tx_id, used in self._touched.items()])
+        self._touched.clear()
+
+    def _remember(self, tx_id: str, t: tx.Tx, height: int) -> None:
+        self._memo[tx_id] = (t, height)
+        self._memo.move_to_end(tx_id)
+        while len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+
+    def get(self, tx_id: str) -> Optional[Tuple[tx.Tx, int]]:
+        '''Looks up a tx and its confirmed height
+
+        Args:
+            tx_id (str): the txid, as hex
+        Returns:
+            (riemann.tx.Tx, int): the tx and its height, or None if missing
+        '''
+        hit = self._memo.get(tx_id)
+        if hit is not None:
+            self._memo.move_to_end(tx_id)
+            self._touched[tx_id] = time.time()
+            metrics.incr('tx_cache', result='memo_hit')
+            return hit
+
+        row = self.conn.execute(
+            'SELECT raw, height FROM txs WHERE tx_id = ?',
+            (tx_id,)).fetchone()
+        if row is None:
+            metrics.incr('tx_cache', result='miss')
+            return None
+        with self.conn:
+            self.conn.execute(
+                'UPDATE txs SET last_used = ? WHERE tx_id = ?',
+                (time.time(), tx_id))
+        t = cast(tx.Tx, tx.Tx.from_bytes(row[0]))
+        self._remember(tx_id, t, row[1])
+        metrics.incr('tx_cache', result='hit')
+        return t, row[1]
+
+    def put(self, tx_id: str, raw: bytes, height: int) -> None:
+        '''Stores a confirmed tx, evicting the least recently used'''
+        if len(raw) > self.max_bytes:
+            return
+        self._touched.pop(tx_id, None)
+        with self.conn:
+            old = self.conn.execute(
+                'SELECT LENGTH(raw) FROM txs WHERE tx_id = ?',
+                (tx_id,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO txs VALUES (?, ?, ?, ?)',
+                (tx_id, raw, height, time.time()))
+            self.size += len(raw) - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+        self._memo.pop(tx_id, None)
+
+    def _evict(self) -> None:
+        self._flush_touched()
+        cur = self.conn.execute(
+            'SELECT tx_id, LENGTH(raw) FROM txs ORDER BY last_used')
+        evicted = []
+        for tx_id, size in cur:
+            if self.size <= self.max_bytes:
+                break
+            evicted.append((tx_id,))
+            self.size -= size
+            self._memo.pop(tx_id, None)
+            self._touched.pop(tx_id, None)
+        self.conn.executemany('DELETE FROM txs WHERE tx_id = ?', evicted)
+        metrics.incr('tx_cache_evictions', len(evicted))
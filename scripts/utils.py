@@ -1,25 +1,42 @@
+import io
 import os
 import sys
+import hmac
 import json
+import struct
 import ecdsa
 import signal
 import hashlib
 import logging
 
+import scripts.metrics as metrics
+
 from ecdsa.util import sigencode_der_canonize
 from ecdsa.ecdsa import int_to_string
 from Cryptodome.Cipher import AES
+from Cryptodome.Hash import keccak
 from Cryptodome.Util.Padding import pad, unpad
 from riemann import utils as rutils
 
 from riemann.tx import Tx
-from typing import Any, Tuple
+from typing import (Any, BinaryIO, Callable, NamedTuple, Optional, TextIO,
+                    Tuple, cast)
 
 # TODO: CHANGE FOR WINDOWS
 PATH = os.path.expanduser('~/.integral/bidder/')
 DB_PBKDF_SALT = b'integral-bidder-key-stretching'
 PBKDF_ITERATIONS = 100000
 SIGHASH_ALL = 0x01
+SIGHASH_SINGLE = 0x03
+SIGHASH_ANYONECANPAY = 0x80
+
+# v2 encrypted file envelope. see encrypt_stream
+ENVELOPE_MAGIC = b'INTGRL'
+ENVELOPE_VERSION = 2
+ENVELOPE_KDF_PBKDF2_SHA256 = 1
+ENVELOPE_HEADER = struct.Struct('>6sBBI16sI16s')
+ENVELOPE_CHUNK_SIZE = 64 * 1024
+ENVELOPE_TAG_SIZE = 16
 
 
 def get_value_and_lock_time(tx: Tx) -> Tuple[int, int]:
@@ -34,6 +51,18 @@ def get_value_and_lock_time(tx: Tx) -> Tuple[int, int]:
             rutils.le2i(tx.lock_time))
 
 
+def keccak256(data: bytes) -> bytes:
+    '''Hashes data with Ethereum's keccak256
+
+    Args:
+        data (bytes): the data to hash
+    Returns:
+        (bytes): the 32-byte digest
+    '''
+    return cast(bytes, keccak.new(digest_bits=256, data=data).digest())
+
+
+@metrics.timed('sign_hash')
 def sign_hash(hash_bytes: bytes, privkeydata):  # type: ignore
     '''Signs a hash with a private key
 
@@ -69,29 +98,171 @@ def coerce_key(data) -> ecdsa.SigningKey:  # type: ignore
 def write_to_file(data: bytes, filename: str) -> bool:
     '''
     writes bytes to a file with termination protection
+    the file is replaced atomically, so readers never see a partial write
     '''
+    return write_file_with(lambda outfile: outfile.write(data), filename)
+
+
+def write_file_with(write: Callable[[BinaryIO], Any], filename: str) -> bool:
+    '''
+    like write_to_file, but for writers that stream into the file object
+    if the write fails, the tmp file is removed and the target is untouched
+    '''
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
     with TerminateProtected():
-        with open(filename, 'wb') as outfile:
-            outfile.write(data)
-            return True
+        try:
+            with open(tmp_filename, 'wb') as outfile:
+                write(outfile)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            raise
+        return True
 
 
 def write_encrypted_json_file(
         data_dict: dict,
         filename: str,
-        secret_phrase: str) -> None:
+        secret_phrase: str,
+        key: Optional['StretchedKey'] = None) -> None:
+    '''
+    writes a dict as JSON in a v2 envelope
+    pass a key from stretch_phrase to skip key stretching when writing
+    many files with one phrase
+    '''
     msg = json.dumps(data_dict).encode('utf-8')
-    msg = encode_aes(msg, secret_phrase)
-    write_to_file(msg, filename)
-
+    write_file_with(
+        lambda outfile: encrypt_stream(
+            io.BytesIO(msg), outfile, secret_phrase, key=key),
+        filename)
 
-def read_encrypted_json_file(filename: str, secret_phrase: str) -> Any:
-        with open(filename, 'rb') as datafile:
-            content = datafile.read()
-            content = decode_aes(content, secret_phrase).decode('utf-8')
-            return json.loads(content)
 
+def read_encrypted_json_file(
+        filename: str,
+        secret_phrase: str,
+        key: Optional['StretchedKey'] = None) -> Any:
+    '''
+    reads a JSON file in a v1 or a v2 envelope
+    v2 files are decrypted, authenticated and parsed a chunk at a time.
+    only the parsed object is held whole, never its plaintext
+    '''
+    with open(filename, 'rb') as datafile:
+        if is_envelope_v2(datafile.read(len(ENVELOPE_MAGIC) + 1)):
+            datafile.seek(0)
+            reader = io.TextIOWrapper(
+                io.BufferedReader(
+                    DecryptingReader(datafile, secret_phrase, key=key)),
+                encoding='utf-8')
+            return load_json_stream(reader)
+        datafile.seek(0)
+        content = datafile.read()
+        content = decode_aes(content, secret_phrase).decode('utf-8')
+        return json.loads(content)
+
+
+def load_json_stream(
+        reader: TextIO,
+        chunk_size: int = ENVELOPE_CHUNK_SIZE) -> Any:
+    '''
+    Parses JSON from a text stream. A top-level object or array is parsed
+    one member at a time, so at most one member and one chunk of its text
+    are held. Other values are parsed whole
 
+    Args:
+        reader     (TextIO): the JSON text
+        chunk_size    (int): characters to read at a time
+    Returns:
+        (any): the parsed value, as from json.load
+    '''
+    decoder = json.JSONDecoder()
+    text = ''
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal text, pos, eof
+        if eof:
+            return False
+        # NB: drop what is parsed, and read more the longer a member gets
+        text = text[pos:]
+        pos = 0
+        more = reader.read(max(chunk_size, len(text)))
+        eof = not more
+        text += more
+        return not eof
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(text) and text[pos] in ' \t\n\r':
+                pos += 1
+            if pos < len(text) or not fill():
+                return text[pos:pos + 1]
+
+    def decode() -> Any:
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                if fill():
+                    continue
+                raise
+            # NB: a number cut by the end of the buffer may continue
+            if (end == len(text) or text[end] in '.eE+-0123456789') \
+                    and fill():
+                continue
+            pos = end
+            return value
+
+    def expect(chars: str) -> str:
+        nonlocal pos
+        c = peek()
+        if not c or c not in chars:
+            raise json.JSONDecodeError(
+                'Expecting one of {!r}'.format(chars), text, pos)
+        pos += 1
+        return c
+
+    first = peek()
+    if first == '{':
+        pos += 1
+        result: Any = {}
+        if peek() == '}':
+            pos += 1
+        else:
+            while True:
+                if peek() != '"':
+                    raise json.JSONDecodeError(
+                        'Expecting property name enclosed in double quotes',
+                        text, pos)
+                key = decode()
+                expect(':')
+                result[key] = decode()
+                if expect(',}') == '}':
+                    break
+    elif first == '[':
+        pos += 1
+        result = []
+        if peek() == ']':
+            pos += 1
+        else:
+            while True:
+                result.append(decode())
+                if expect(',]') == ']':
+                    break
+    else:
+        result = decode()
+    if peek():
+        raise json.JSONDecodeError('Extra data', text, pos)
+    return result
+
+
+@metrics.timed('pbkdf2')
 def pbkdf2_hmac(
         data: bytes,
         salt: bytes = b'',
@@ -141,6 +312,16 @@ def _aes_decrypt_with_iv(key: bytes, iv: bytes, data_bytes: bytes) -> bytes:
         raise e
 
 
+def v1_secret(secret_phrase: str) -> bytes:
+    '''Stretches a passphrase as encode_aes and decode_aes do'''
+    return pbkdf2_hmac(
+        data=secret_phrase.encode('utf-8'),
+        salt=DB_PBKDF_SALT,
+        hash_name='sha256',
+        iterations=PBKDF_ITERATIONS)
+
+
+@metrics.timed('encode_aes')
 def encode_aes(message_bytes: bytes, secret_phrase: str) -> bytes:
     '''Encrypts a message with a phrase
     Args:
@@ -149,11 +330,7 @@ def encode_aes(message_bytes: bytes, secret_phrase: str) -> bytes:
     Returns:
         (bytes): the encrypted message, prepended with its iv and ephemeral key
     '''
-    secret = pbkdf2_hmac(
-        data=secret_phrase.encode('utf-8'),
-        salt=DB_PBKDF_SALT,
-        hash_name='sha256',
-        iterations=PBKDF_ITERATIONS)
+    secret = v1_secret(secret_phrase)
 
     # NB: New iv and ephemeral key are created each time we encrypt
     iv = os.urandom(16)
@@ -168,20 +345,21 @@ def encode_aes(message_bytes: bytes, secret_phrase: str) -> bytes:
     return encrypted_message_bytes
 
 
-def decode_aes(encrypted_message_bytes, secret_phrase):  # type: ignore
+@metrics.timed('decode_aes')
+def decode_aes(  # type: ignore
+        encrypted_message_bytes, secret_phrase, secret=None):
     '''Decrypts a message with a phrase
     Args:
         encrypted_message_bytes (bytes): the encrypted message, prepended with
                                          its iv and ephemeral key
         secret_phrase             (str): the user's db encryption phrase
+        secret                  (bytes): the phrase, already stretched by
+                                         v1_secret. skips key stretching
     Returns:
         (bytes): the decrypted message
     '''
-    secret = pbkdf2_hmac(
-        data=secret_phrase.encode('utf-8'),
-        salt=DB_PBKDF_SALT,
-        hash_name='sha256',
-        iterations=PBKDF_ITERATIONS)
+    if secret is None:
+        secret = v1_secret(secret_phrase)
 
     # NB: Extract the iv and encrypted key from the message
     iv = encrypted_message_bytes[:16]
@@ -195,6 +373,188 @@ def decode_aes(encrypted_message_bytes, secret_phrase):  # type: ignore
     return message_bytes
 
 
+class StretchedKey(NamedTuple):
+    '''A passphrase stretched with PBKDF2, and the parameters used'''
+    salt: bytes
+    iterations: int
+    secret: bytes
+
+
+def stretch_phrase(
+        secret_phrase: str,
+        salt: Optional[bytes] = None,
+        iterations: int = PBKDF_ITERATIONS) -> StretchedKey:
+    '''Stretches a passphrase for the v2 envelope. salt is random if None'''
+    salt = os.urandom(16) if salt is None else salt
+    secret = pbkdf2_hmac(
+        data=secret_phrase.encode('utf-8'),
+        salt=salt,
+        hash_name='sha256',
+        iterations=iterations)
+    return StretchedKey(salt, iterations, secret)
+
+
+def is_envelope_v2(prefix: bytes) -> bool:
+    '''Checks the leading bytes of encrypted data for the v2 magic'''
+    return prefix[:len(ENVELOPE_MAGIC) + 1] \
+        == ENVELOPE_MAGIC + bytes([ENVELOPE_VERSION])
+
+
+def _file_key(secret: bytes, file_nonce: bytes) -> bytes:
+    # NB: a fresh key per file, so one stretched key can encrypt many files
+    #     while each file numbers its chunk nonces from 0
+    return hmac.new(secret, b'integral-envelope-v2' + file_nonce,
+                    hashlib.sha256).digest()
+
+
+def _chunk_cipher(file_key: bytes, counter: int, header: bytes,
+                  final: bool) -> Any:
+    cipher = AES.new(file_key, AES.MODE_GCM,
+                     nonce=counter.to_bytes(12, 'big'))
+    # NB: binding the header and final flag stops truncation and splicing
+    cipher.update(header + (b'\x01' if final else b'\x00'))
+    return cipher
+
+
+def _read_exactly(stream: BinaryIO, n: int) -> bytes:
+    data = stream.read(n)
+    while len(data) < n:
+        more = stream.read(n - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def encrypt_stream(
+        src: BinaryIO,
+        dst: BinaryIO,
+        secret_phrase: str,
+        key: Optional[StretchedKey] = None,
+        chunk_size: int = ENVELOPE_CHUNK_SIZE) -> None:
+    '''Encrypts a stream into a v2 envelope, one chunk at a time
+
+    The envelope is a header holding the KDF parameters, then chunks of
+    AES-256-GCM ciphertext and tags. Every chunk but the last holds
+    chunk_size bytes of plaintext. The last is shorter, possibly empty.
+
+    Args:
+        src            (BinaryIO): the plaintext
+        dst            (BinaryIO): where to write the envelope
+        secret_phrase       (str): the user's db encryption phrase
+        key      (StretchedKey): secret_phrase, already stretched
+        chunk_size          (int): plaintext bytes per chunk
+    '''
+    if key is None:
+        key = stretch_phrase(secret_phrase)
+    file_nonce = os.urandom(16)
+    header = ENVELOPE_HEADER.pack(
+        ENVELOPE_MAGIC, ENVELOPE_VERSION, ENVELOPE_KDF_PBKDF2_SHA256,
+        key.iterations, key.salt, chunk_size, file_nonce)
+    file_key = _file_key(key.secret, file_nonce)
+    dst.write(header)
+
+    counter = 0
+    while True:
+        chunk = _read_exactly(src, chunk_size)
+        final = len(chunk) < chunk_size
+        cipher = _chunk_cipher(file_key, counter, header, final)
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        dst.write(ciphertext)
+        dst.write(tag)
+        if final:
+            return
+        counter += 1
+
+
+class DecryptingReader(io.RawIOBase):
+    '''
+    Reads the plaintext of a v2 envelope. Each chunk is authenticated
+    before any of it is returned, and a truncated envelope raises at the
+    point where it ends.
+
+    Args:
+        src            (BinaryIO): the envelope
+        secret_phrase       (str): the user's db encryption phrase
+        key      (StretchedKey): secret_phrase, already stretched. used if
+                                 its salt and iterations match the header
+    '''
+
+    def __init__(
+            self,
+            src: BinaryIO,
+            secret_phrase: str,
+            key: Optional[StretchedKey] = None) -> None:
+        self.src = src
+        self.header = _read_exactly(src, ENVELOPE_HEADER.size)
+        if len(self.header) < ENVELOPE_HEADER.size \
+                or not is_envelope_v2(self.header):
+            raise ValueError('Not a v2 envelope')
+        (_, _, kdf, iterations, salt, self.chunk_size,
+         file_nonce) = ENVELOPE_HEADER.unpack(self.header)
+        if kdf != ENVELOPE_KDF_PBKDF2_SHA256:
+            raise ValueError('Unknown KDF: {}'.format(kdf))
+        if key is None or key.salt != salt or key.iterations != iterations:
+            key = stretch_phrase(secret_phrase, salt, iterations)
+        self.file_key = _file_key(key.secret, file_nonce)
+        self.counter = 0
+        self.done = False
+        self.buffer = b''
+        self.offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_chunk(self) -> None:
+        block = _read_exactly(
+            self.src, self.chunk_size + ENVELOPE_TAG_SIZE)
+        final = len(block) < self.chunk_size + ENVELOPE_TAG_SIZE
+        if len(block) < ENVELOPE_TAG_SIZE:
+            raise ValueError('Truncated envelope')
+        cipher = _chunk_cipher(self.file_key, self.counter, self.header, final)
+        try:
+            self.buffer = cipher.decrypt_and_verify(
+                block[:-ENVELOPE_TAG_SIZE], block[-ENVELOPE_TAG_SIZE:])
+        except ValueError as e:
+            e.args += ('Invalid passphrase or corrupted envelope',)
+            raise e
+        self.offset = 0
+        self.counter += 1
+        if final:
+            if self.src.read(1):
+                raise ValueError('Data after the final chunk')
+            self.done = True
+
+    def readinto(self, b: Any) -> int:
+        while self.offset == len(self.buffer):
+            if self.done:
+                return 0
+            self._next_chunk()
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+
+def encode_envelope(
+        message_bytes: bytes,
+        secret_phrase: str,
+        key: Optional[StretchedKey] = None) -> bytes:
+    '''Encrypts a message into a v2 envelope in memory'''
+    out = io.BytesIO()
+    encrypt_stream(io.BytesIO(message_bytes), out, secret_phrase, key=key)
+    return out.getvalue()
+
+
+def decode_envelope(
+        envelope: bytes,
+        secret_phrase: str,
+        key: Optional[StretchedKey] = None) -> bytes:
+    '''Decrypts and authenticates a v2 envelope in memory'''
+    reader = DecryptingReader(io.BytesIO(envelope), secret_phrase, key=key)
+    return reader.readall()
+
+
 class TerminateProtected:
     """ Protect a piece of code from being killed by SIGINT or SIGTERM.
     It can still be killed by a force kill.
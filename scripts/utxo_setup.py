@@ -1,30 +1,50 @@
-from riemann import simple
+import scripts.fees as fees
+import scripts.utils as utils
+import scripts.network as net
+import scripts.sighash as sighash
+import scripts.partial_tx as pt
 
-from typing import cast
+from riemann import simple, tx
+from riemann import utils as rutils
+
+from collections import deque
+from typing import (cast, Deque, Dict, List, Optional, Sequence, Tuple,
+                    Union)
 from riemann.tx import Tx
 
+DUST_LIMIT = 546
+
 
 def generate_small_utxos(
         tx_id: str,
         index: int,
         prevout_value: int,
-        recipient_addr: str,
+        recipient_addr: Union[str, Sequence[str]],
         num_outputs: int,
-        fee: int,
+        fee: Optional[int],
         change_addr: str,
-        size: int = 550) -> Tx:
+        size: int = 550,
+        feerate: int = fees.DEFAULT_FEERATE,
+        network: net.NetworkLike = None) -> Tx:
     '''
     Makes new utxos.
-    All utxos have the same address (i.e. the same keypair)
+    All utxos have the same address (i.e. the same keypair), unless an
+    address is given for each
 
     Args:
         tx_id          (str): txid of parent tx
         index          (int): index of input in parent tx
         prevout_value  (int): value in satoshi of the input
-        recipient_addr (str): address of the recipient
+        recipient_addr (str): address of the recipient, or a list of
+                              num_outputs addresses, one per UTXO
         num_outputs    (int): how many new small UTXOs to make
-        fee            (int): fee to pay in satoshi
+        fee            (int): fee to pay in satoshi. None to compute it
+                              from the estimated vsize and feerate
         change_addr    (str): address to send change to
+        size           (int): the value of each new UTXO
+        feerate        (int): fee rate in sat/vbyte, if fee is None
+        network        (str): the bitcoin network name. riemann's current
+                              network if None
     Returns:
         (rieman.tx.Tx): The unsigned tx making num_outputs new UTXOs
     '''
@@ -33,10 +53,261 @@ def generate_small_utxos(
     tx_ins = [simple.unsigned_input(outpoint)]
 
     # make small outputs
-    tx_outs = [simple.output(size, recipient_addr) for i in range(num_outputs)]
+    if isinstance(recipient_addr, str):
+        small = net.output(size, recipient_addr, network)
+        tx_outs = [small for i in range(num_outputs)]
+    else:
+        if len(recipient_addr) != num_outputs:
+            raise ValueError('Expected {} addresses, got {}.'.format(
+                num_outputs, len(recipient_addr)))
+        tx_outs = [net.output(size, a, network) for a in recipient_addr]
 
     # Make a change output
-    change = prevout_value - (size * num_outputs) - fee
-    tx_outs.append(simple.output(change, change_addr))
+    change = prevout_value - (size * num_outputs)
+    if fee is None:
+        # NB: the change value does not affect the size of the tx
+        unfunded = simple.unsigned_witness_tx(
+            tx_ins,
+            tx_outs + [net.output(max(change, 0), change_addr, network)])
+        fee = fees.fee_for(unfunded, feerate)
+    if change - fee < DUST_LIMIT:
+        raise ValueError(
+            'Change of {} sat after a {} sat fee is below the dust '
+            'limit.'.format(change - fee, fee))
+    tx_outs.append(net.output(change - fee, change_addr, network))
 
     return cast(Tx, simple.unsigned_witness_tx(tx_ins, tx_outs))
+
+
+def _split_evenly(n: int, parts: int) -> List[int]:
+    q, r = divmod(n, parts)
+    return [q + 1] * r + [q] * (parts - r)
+
+
+def _min_depth(num_leaves: int, fanout: int) -> int:
+    depth = 1
+    while fanout ** depth < num_leaves:
+        depth += 1
+    return depth
+
+
+def _children(num_leaves: int, depth: int, fanout: int) -> List[int]:
+    '''
+    Splits the leaves below a node into as few subtrees as possible
+    '''
+    capacity = fanout ** (depth - 1)
+    return _split_evenly(num_leaves, -(-num_leaves // capacity))
+
+
+def sign_p2wpkh_inputs(
+        t: Tx,
+        prevout_values: List[int],
+        keypair: pt.KeyPair) -> Tx:
+    '''
+    Signs every input of a tx with SIGHASH_ALL. All inputs must be P2WPKH
+    outputs controlled by the same keypair.
+
+    Args:
+        t               (riemann.tx.Tx): the unsigned tx
+        prevout_values      (list(int)): the value of each input's prevout
+        keypair      (tuple(str, str)): privkey as hex, pubkey as hex
+    Returns:
+        (riemann.tx.Tx): the signed tx
+    '''
+    pub = bytes.fromhex(keypair[1])
+    prevout_script = b'\x19\x76\xa9\x14' + rutils.hash160(pub) + b'\x88\xac'
+    ctx = sighash.SighashContext(t)
+
+    tx_witnesses = []
+    for i, value in enumerate(prevout_values):
+        sighash_bytes = ctx.sighash_all(
+            index=i,
+            script=prevout_script,
+            prevout_value=rutils.i2le_padded(value, 8))
+        sig = utils.sign_hash(sighash_bytes, keypair[0])
+        sig = '{}{}'.format(sig, '01')
+        tx_witnesses.append(tx.make_witness([bytes.fromhex(sig), pub]))
+
+    return cast(Tx, t.copy(tx_witnesses=tx_witnesses))
+
+
+def generate_split_tree(
+        prevouts: List[pt.Prevout],
+        control_addr: str,
+        change_addr: str,
+        num_leaves: int,
+        feerate: int,
+        fanout: int = 1000,
+        depth: Optional[int] = None,
+        size: int = 550,
+        network: net.NetworkLike = None) -> Tuple[
+            List[Tx], List[List[int]], List[pt.Prevout]]:
+    '''
+    Plans a tree of unsigned split txns. The root spends every funding
+    prevout and pays change. Each other tx spends one output of its parent.
+    The txns at the bottom of the tree make the small leaf UTXOs.
+    Fees are computed from the estimated vsize of each tx.
+
+    Args:
+        prevouts    (list(tuple(str, int, int))): funding txid, index, value
+        control_addr                       (str): the address that controls
+                                                  the funding prevouts, and
+                                                  receives all tree outputs
+        change_addr                        (str): address to send change to
+        num_leaves                         (int): how many leaf UTXOs to make
+        feerate                            (int): fee rate in sat/vbyte
+        fanout                             (int): max outputs per split tx
+        depth                              (int): the number of tx levels.
+                                                  the smallest that fits if
+                                                  None
+        size                               (int): the value of each leaf
+        network                            (str): the bitcoin network name
+    Returns:
+        (list(riemann.tx.Tx), list(list(int)), list(tuple(str, int, int))):
+            the unsigned txns in parent-first order,
+            the value of each input of each tx,
+            and the leaf prevouts, ready for partial_tx.multidutch
+    '''
+    if num_leaves < 1 or fanout < 2:
+        raise ValueError('Need at least 1 leaf and a fanout of at least 2.')
+    if depth is None:
+        depth = _min_depth(num_leaves, fanout)
+    if fanout ** depth < num_leaves:
+        raise ValueError('{} levels of {} outputs cannot hold {} leaves.'
+                         .format(depth, fanout, num_leaves))
+
+    # NB: every output in a tree pays to the same address. Make it once
+    #     and reuse it, instead of re-decoding the address per output
+    out_size = len(net.output(size, control_addr, network).to_bytes())
+    outputs: Dict[int, tx.TxOut] = {}
+
+    def output(value: int) -> tx.TxOut:
+        if value not in outputs:
+            outputs[value] = net.output(value, control_addr, network)
+        return outputs[value]
+
+    values: Dict[Tuple[int, int], int] = {}
+
+    def subtree_value(n: int, d: int) -> int:
+        '''The value needed to make n leaves in a subtree d txns deep'''
+        if (n, d) not in values:
+            children = [n] if d == 1 else _children(n, d, fanout)
+            fee = feerate * fees.estimate_p2wpkh_vsize(
+                1, [out_size] * (n if d == 1 else len(children)))
+            if d == 1:
+                values[(n, d)] = n * size + fee
+            else:
+                values[(n, d)] = fee + sum(
+                    subtree_value(c, d - 1) for c in children)
+        return values[(n, d)]
+
+    # Make the root, which may have several inputs and a change output
+    if depth == 1:
+        root_outs = [output(size)] * num_leaves
+        spent = size * num_leaves
+    else:
+        subtrees = _children(num_leaves, depth, fanout)
+        root_outs = [output(subtree_value(c, depth - 1)) for c in subtrees]
+        spent = sum(subtree_value(c, depth - 1) for c in subtrees)
+
+    total = sum(p[2] for p in prevouts)
+    sizes = [out_size] * len(root_outs)
+    change_size = len(net.output(0, change_addr, network).to_bytes())
+    fee = feerate * fees.estimate_p2wpkh_vsize(len(prevouts), sizes)
+    if total - spent - fee < 0:
+        raise ValueError('Funding prevouts hold {} sat. Not enough to make '
+                         'the tree.'.format(total))
+
+    # NB: if change would be dust, leave it to the miner
+    change = total - spent - feerate * fees.estimate_p2wpkh_vsize(
+        len(prevouts), sizes + [change_size])
+    if change >= DUST_LIMIT:
+        root_outs = root_outs + [net.output(change, change_addr, network)]
+
+    root = simple.unsigned_witness_tx(
+        [simple.unsigned_input(simple.outpoint(p[0], p[1])) for p in prevouts],
+        root_outs)
+
+    txns = [root]
+    input_values = [[p[2] for p in prevouts]]
+    leaves: List[pt.Prevout] = []
+
+    # Walk the tree top down. Entries are the parent's txid, the output
+    # index, the output value, and the leaves and depth below it
+    queue: Deque[Tuple[str, int, int, int, int]] = deque()
+    root_id = root.tx_id.hex()
+    if depth == 1:
+        leaves.extend((root_id, i, size) for i in range(num_leaves))
+    else:
+        for i, c in enumerate(subtrees):
+            queue.append((root_id, i, subtree_value(c, depth - 1),
+                          c, depth - 1))
+
+    while queue:
+        parent_id, idx, value, n, d = queue.popleft()
+        tx_ins = [simple.unsigned_input(simple.outpoint(parent_id, idx))]
+        if d == 1:
+            children = [1] * n
+            tx_outs = [output(size)] * n
+        else:
+            children = _children(n, d, fanout)
+            tx_outs = [output(subtree_value(c, d - 1)) for c in children]
+
+        split_tx = simple.unsigned_witness_tx(tx_ins, tx_outs)
+        txns.append(split_tx)
+        input_values.append([value])
+
+        split_id = split_tx.tx_id.hex()
+        if d == 1:
+            leaves.extend((split_id, i, size) for i in range(n))
+        else:
+            for i, c in enumerate(children):
+                queue.append((split_id, i, subtree_value(c, d - 1),
+                              c, d - 1))
+
+    return txns, input_values, leaves
+
+
+def make_and_sign_split_tree(
+        prevouts: List[pt.Prevout],
+        control_addr: str,
+        control_addr_keypair: pt.KeyPair,
+        change_addr: str,
+        num_leaves: int,
+        feerate: int,
+        fanout: int = 1000,
+        depth: Optional[int] = None,
+        size: int = 550,
+        network: net.NetworkLike = None) -> Tuple[List[Tx], List[pt.Prevout]]:
+    '''
+    Makes and signs a tree of split txns. See generate_split_tree.
+
+    Args:
+        prevouts    (list(tuple(str, int, int))): funding txid, index, value
+        control_addr                       (str): the funding prevouts' addr
+        control_addr_keypair   (tuple(str, str)): the control addr's keypair
+        change_addr                        (str): address to send change to
+        num_leaves                         (int): how many leaf UTXOs to make
+        feerate                            (int): fee rate in sat/vbyte
+        fanout                             (int): max outputs per split tx
+        depth                              (int): the number of tx levels
+        size                               (int): the value of each leaf
+        network                            (str): the bitcoin network name
+    Returns:
+        (list(riemann.tx.Tx), list(tuple(str, int, int))):
+            the signed txns in parent-first order,
+            and the leaf prevouts, ready for partial_tx.multidutch
+    '''
+    txns, input_values, leaves = generate_split_tree(
+        prevouts=prevouts,
+        control_addr=control_addr,
+        change_addr=change_addr,
+        num_leaves=num_leaves,
+        feerate=feerate,
+        fanout=fanout,
+        depth=depth,
+        size=size,
+        network=network)
+    signed = [sign_p2wpkh_inputs(t, v, control_addr_keypair)
+              for t, v in zip(txns, input_values)]
+    return signed, leaves
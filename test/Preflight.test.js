@@ -0,0 +1,82 @@
+/* global artifacts contract before describe it assert web3 */
+
+const BN = require('bn.js');
+const constants = require('./constants.js');
+const cases = require('./preflight_cases.json');
+
+const DummySwap = artifacts.require('DummySwap');
+
+// These cases pin scripts/preflight.py to the contract. Each case's
+// expected outcome is what the Python mirror reports for it, checked with
+// `python -m scripts.preflight test/preflight_cases.json`.
+contract('Preflight parity', (accounts) => {
+  let developer;
+  let seller;
+
+  before(async () => {
+    [developer, seller] = accounts;
+  });
+
+  async function revertReason(promise) {
+    try {
+      await promise;
+    } catch (e) {
+      return e.message;
+    }
+    return null;
+  }
+
+  describe('#makeAllChecks', async () => {
+    let iac;
+
+    before(async () => {
+      iac = await DummySwap.new(developer);
+    });
+
+    cases.filter(c => c.listing === null).forEach((c) => {
+      it(c.name, async () => {
+        const call = iac.makeAllChecks(
+          c.proof, c.index, c.version, c.vin, c.vout, c.locktime, c.headers
+        );
+        if (c.expected.reason === null) {
+          const res = await call;
+          assert(res.eq(new BN(c.expected.diff, 10)));
+        } else {
+          assert.include(await revertReason(call), c.expected.reason);
+        }
+      });
+    });
+  });
+
+  describe('#claim', async () => {
+    cases.filter(c => c.listing !== null).forEach((c) => {
+      it(c.name, async () => {
+        const iac = await DummySwap.new(developer);
+        await iac.open(
+          c.listing.partial_tx,
+          new BN(c.listing.req_diff, 10),
+          constants.ADDR0,
+          0,
+          { from: seller }
+        );
+        const blockNumber = await web3.eth.getBlock('latest').number;
+        const call = iac.claim(
+          c.proof, c.index, c.version, c.vin, c.vout, c.locktime, c.headers,
+          { from: seller }
+        );
+        if (c.expected.reason !== null) {
+          assert.include(await revertReason(call), c.expected.reason);
+          return;
+        }
+        await call;
+        const eventList = await iac.getPastEvents(
+          'ListingClosed',
+          { fromBlock: blockNumber, toBlock: 'latest' }
+        );
+        /* eslint-disable-next-line no-underscore-dangle */
+        const bidder = eventList[0].returnValues._bidder.toLowerCase();
+        assert.strictEqual(bidder, c.expected.bidder || seller.toLowerCase());
+      });
+    });
+  });
+});